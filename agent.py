@@ -1,15 +1,44 @@
 import json
 import re
+import threading
+import uuid
+from collections import OrderedDict
 from typing import Annotated, Sequence, TypedDict
 
 from langchain_core.messages import AIMessage, BaseMessage, HumanMessage, ToolMessage
+from langchain_core.runnables import RunnableConfig
+from langgraph.config import get_stream_writer
 from langgraph.graph import END, StateGraph
 from langgraph.graph.message import add_messages
 
-from config import CRITIC_MODEL, MODEL
+from config import (
+    CONTEXT_CACHE_MAX_MESSAGES,
+    CONTEXT_IMAGE_TOKEN_ESTIMATE,
+    CONTEXT_MAX_MESSAGES,
+    CONTEXT_TOKEN_BUDGET,
+    CRITIC_MODEL,
+    CRITIC_PRESCREEN_ENABLED,
+    EXPRESS_GRAPH_ENABLED,
+    EXPRESS_MAX_QUERY_CHARS,
+    EXPRESS_MAX_TOOLS,
+    EXPRESS_MULTI_STEP_MARKERS,
+    TOOL_EARLY_START_ENABLED,
+)
+from image_store import image_data_url
 from mistral_client import collect_streamed_response, safe_chat_complete, safe_chat_stream
-from tools import execute_tool_by_name_and_args, infer_required_tools_from_plan, tools
-from utils import is_math_query, normalize_reply_content
+from prescreen import log_decision, prescreen_answer, rejection_feedback
+from routing import route_model
+from scheduler import PRIORITY_BACKGROUND, PRIORITY_INTERACTIVE
+from tracing import traced_node
+from tools import execute_tool_calls, infer_required_tools_from_plan, start_tool_call, tools
+from utils import (
+    clean_final_reply,
+    estimate_tokens,
+    evaluate_arithmetic,
+    extract_arithmetic_expression,
+    is_math_query,
+    normalize_reply_content,
+)
 
 
 class AgentState(TypedDict):
@@ -34,7 +63,58 @@ def is_internal_control_message(text: str) -> bool:
     return any(t.startswith(prefix) for prefix in internal_prefixes)
 
 
-def planner_node(state: AgentState):
+def session_id_from_config(config):
+    return ((config or {}).get("configurable") or {}).get("session_id")
+
+
+def priority_from_config(config, default):
+    # A run-level priority (e.g. batch jobs) can only lower a call's priority.
+    configured = ((config or {}).get("configurable") or {}).get("priority")
+    return default if configured is None else max(default, configured)
+
+
+def last_user_text(messages):
+    for msg in reversed(messages or []):
+        if isinstance(msg, HumanMessage):
+            candidate = normalize_reply_content(msg.content)
+            if not is_internal_control_message(candidate):
+                return candidate
+    return ""
+
+
+def turn_tool_outputs(messages):
+    # Tool results since the latest real user message.
+    outputs = []
+    for msg in reversed(messages or []):
+        if isinstance(msg, HumanMessage) and not is_internal_control_message(normalize_reply_content(msg.content)):
+            break
+        if isinstance(msg, ToolMessage):
+            outputs.append(normalize_reply_content(msg.content))
+    return outputs[::-1]
+
+
+def model_for_node(node, state, required_tools=None):
+    model, _ = route_model(
+        node,
+        has_image=bool(state.get("image_data")),
+        required_tools=state.get("required_tools") if required_tools is None else required_tools,
+        query_text=last_user_text(state.get("messages")),
+        retry_count=int(state.get("retry_count", 0) or 0),
+    )
+    return model
+
+
+PLANNING_RULES = (
+    "- For pure math questions: use ONLY calculator. No web_search, no code_interpreter.\n"
+    "- For coding/plotting requests: use ONLY code_interpreter.\n"
+    "- For fact/news/current-events requests: use ONLY web_search.\n"
+    "- NEVER suggest web_search for arithmetic or symbolic math.\n"
+    "- NEVER suggest code_interpreter just to verify calculator output.\n"
+    "- For simple requests, use 1-2 steps maximum.\n"
+)
+
+
+def planner_node(state: AgentState, config: RunnableConfig):
     summary = state.get("summary", "New conversation")
     query = state["messages"][-1].content if state["messages"] else ""
     if isinstance(query, list):
@@ -43,19 +123,18 @@ def planner_node(state: AgentState):
     planning_text = (
         "You are a helpful multimodal agent. Create a minimal step-by-step plan.\n"
         "IMPORTANT RULES:\n"
-        "- For pure math questions: use ONLY calculator. No web_search, no code_interpreter.\n"
-        "- For coding/plotting requests: use ONLY code_interpreter.\n"
-        "- For fact/news/current-events requests: use ONLY web_search.\n"
-        "- NEVER suggest web_search for arithmetic or symbolic math.\n"
-        "- NEVER suggest code_interpreter just to verify calculator output.\n"
-        "- For simple requests, use 1-2 steps maximum.\n\n"
+        f"{PLANNING_RULES}\n"
         f"Conversation summary: {summary or 'New conversation'}\n"
         f"User query: {query}\n\n"
         "Output ONLY the plan as numbered steps."
     )
     try:
         plan = safe_chat_complete(
-            model=MODEL,
+            hedge=True,
+            cache=True,
+            priority=priority_from_config(config, PRIORITY_INTERACTIVE),
+            session_id=session_id_from_config(config),
+            model=model_for_node("planner", state),
             messages=[{"role": "user", "content": planning_text}],
             max_tokens=300,
             temperature=0.2,
@@ -82,14 +161,151 @@ def used_tools_from_messages(messages):
     return used
 
 
-def build_mistral_messages(state: AgentState):
+_converted_messages = OrderedDict()
+_converted_messages_lock = threading.Lock()
+
+
+def convert_message(msg):
+    # Returns (mistral_message, token_estimate); memoized by message id so the
+    # tool loop only converts messages added since the previous agent call.
+    msg_id = getattr(msg, "id", None)
+    if msg_id:
+        with _converted_messages_lock:
+            cached = _converted_messages.get(msg_id)
+            if cached is not None:
+                _converted_messages.move_to_end(msg_id)
+                return cached
+
+    if isinstance(msg, HumanMessage):
+        converted = {"role": "user", "content": normalize_reply_content(msg.content)}
+    elif isinstance(msg, AIMessage):
+        ai_content = ""
+        if msg.content is not None:
+            ai_content = normalize_reply_content(msg.content)
+            if ai_content == "(No text response)":
+                ai_content = ""
+
+        tool_calls = msg.additional_kwargs.get("tool_calls", [])
+        if tool_calls:
+            formatted_tool_calls = []
+            for tc in tool_calls:
+                formatted_tool_calls.append(
+                    {
+                        "id": tc.get("id", ""),
+                        "type": "function",
+                        "function": {
+                            "name": tc.get("name", ""),
+                            "arguments": tc.get("arguments", "{}"),
+                        },
+                    }
+                )
+            converted = {
+                "role": "assistant",
+                "content": ai_content,
+                "tool_calls": formatted_tool_calls,
+            }
+        else:
+            converted = {"role": "assistant", "content": ai_content}
+    elif isinstance(msg, ToolMessage):
+        converted = {
+            "role": "tool",
+            "content": normalize_reply_content(msg.content),
+            "tool_call_id": getattr(msg, "tool_call_id", ""),
+        }
+    else:
+        return None
+
+    tokens = estimate_tokens(converted["content"]) + sum(
+        estimate_tokens(tc["function"]["name"]) + estimate_tokens(tc["function"]["arguments"])
+        for tc in converted.get("tool_calls", [])
+    ) + 4
+    result = (converted, tokens)
+    if msg_id:
+        with _converted_messages_lock:
+            _converted_messages[msg_id] = result
+            while len(_converted_messages) > CONTEXT_CACHE_MAX_MESSAGES:
+                _converted_messages.popitem(last=False)
+    return result
+
+
+def pack_history(messages, token_budget):
+    # Walk back from the newest message, grouping each assistant tool_call with
+    # its tool results (Mistral rejects a tool message without its call), and
+    # keep whole groups until the token budget is spent. The latest user message
+    # is always kept: when this turn's tool groups alone exceed the budget, its
+    # older groups are dropped instead.
+    groups = []
+    pending_tools = []
+    last_idx = len(messages) - 1
+    pinned_idx = None
+    for idx in range(last_idx, -1, -1):
+        msg = messages[idx]
+        if isinstance(msg, ToolMessage):
+            pending_tools.insert(0, msg)
+            continue
+        if isinstance(msg, AIMessage) and msg.additional_kwargs.get("tool_calls"):
+            groups.append((idx, [msg] + pending_tools))
+            pending_tools = []
+            continue
+        # Tool results whose assistant call is missing cannot be sent.
+        pending_tools = []
+        if isinstance(msg, HumanMessage):
+            # Keep internal control prompts only when they are the immediate latest
+            # message (active retry instruction). Otherwise they pollute future turns.
+            if is_internal_control_message(normalize_reply_content(msg.content)):
+                if idx != last_idx:
+                    continue
+            elif pinned_idx is None:
+                pinned_idx = idx
+        groups.append((idx, [msg]))
+
+    converted = []
+    for idx, group in groups:
+        converted_group = [(msg, convert_message(msg)) for msg in group]
+        converted.append((idx, [(msg, c) for msg, c in converted_group if c is not None]))
+    pinned = [group for idx, group in converted if idx == pinned_idx]
+    reserved_tokens = sum(c[1] for group in pinned for _, c in group)
+    reserved_messages = sum(len(group) for group in pinned)
+
+    packed = []
+    used_tokens = 0
+    current_turn_full = False
+    for idx, converted_group in converted:
+        is_pinned = idx == pinned_idx
+        if is_pinned:
+            reserved_tokens, reserved_messages = 0, 0
+        elif current_turn_full and pinned_idx is not None and idx > pinned_idx:
+            continue
+        group_tokens = sum(c[1] for _, c in converted_group)
+        if packed and not is_pinned and (
+            used_tokens + group_tokens + reserved_tokens > token_budget
+            or len(packed) + len(converted_group) + reserved_messages > CONTEXT_MAX_MESSAGES
+        ):
+            if pinned_idx is not None and idx > pinned_idx:
+                current_turn_full = True
+                continue
+            break
+        used_tokens += group_tokens
+        packed = [(msg, c[0]) for msg, c in converted_group] + packed
+    return packed
+
+
+def build_mistral_messages(state: AgentState, express=False):
+    # In the express graph there is no planner; the model plans and acts in one call.
     messages = state.get("messages", [])
     summary = state.get("summary", "")
     plan = state.get("plan", "")
     image_data = state.get("image_data", "")
 
+    if express:
+        plan_instructions = "First decide the minimal steps needed, following these rules:\n" + PLANNING_RULES
+        plan_section = ""
+    else:
+        plan_instructions = "You MUST follow the plan step-by-step. Do not skip or combine steps unless explicitly allowed.\n"
+        plan_section = f"\nPlan:\n{plan}"
+
     system_prompt = (
-        "You MUST follow the plan step-by-step. Do not skip or combine steps unless explicitly allowed.\n"
+        plan_instructions +
         "Follow the plan and complete the task end-to-end in this turn. "
         "Do not say you will do a step later; either do it now with tool calls or explain the concrete tool error.\n"
         "Do not print raw tool-call JSON in your final answer.\n"
@@ -111,96 +327,41 @@ def build_mistral_messages(state: AgentState):
         "Output requirements for final answer:\n"
         "1) If web_search was used, include source links from tool output.\n"
         "2) Keep metric consistency with the uploaded image; if you switch metric, explain why.\n\n"
-        f"Conversation summary: {summary or 'New conversation'}\n"
-        f"Plan:\n{plan}"
+        f"Conversation summary: {summary or 'New conversation'}"
+        f"{plan_section}"
     )
 
     mistral_messages = [{"role": "system", "content": system_prompt}]
-    history_window = list(messages[-20:])
-    # Mistral requires a tool role to follow an assistant tool_call message.
-    # If truncation starts on a tool message, drop leading tools.
-    while history_window and isinstance(history_window[0], ToolMessage):
-        history_window.pop(0)
-    if len(history_window) > 12:
-        history_window = history_window[-12:]
-    while history_window and isinstance(history_window[0], ToolMessage):
-        history_window.pop(0)
-
-    last_human_idx = None
-    last_idx = len(history_window) - 1
-    for idx, msg in enumerate(history_window):
-        if isinstance(msg, HumanMessage):
-            text = normalize_reply_content(msg.content)
-            is_internal = is_internal_control_message(text)
-            # Keep internal control prompts only when they are the immediate latest
-            # message (active retry instruction). Otherwise they pollute future turns.
-            if (not is_internal) or idx == last_idx:
-                last_human_idx = idx
+    image_url = image_data_url(image_data)
+    budget = CONTEXT_TOKEN_BUDGET - (CONTEXT_IMAGE_TOKEN_ESTIMATE if image_url else 0)
+    history = pack_history(messages, budget)
 
-    for idx, msg in enumerate(history_window):
+    last_human_pos = None
+    for pos, (msg, converted) in enumerate(history):
         if isinstance(msg, HumanMessage):
-            text = normalize_reply_content(msg.content)
-            is_internal = is_internal_control_message(text)
-            if is_internal and idx != last_idx:
-                continue
-            if image_data and idx == last_human_idx:
-                mistral_messages.append(
-                    {
-                        "role": "user",
-                        "content": [
-                            {"type": "text", "text": text},
-                            {
-                                "type": "image_url",
-                                "image_url": f"data:image/jpeg;base64,{image_data}",
-                            },
-                        ],
-                    }
-                )
-            else:
-                mistral_messages.append({"role": "user", "content": text})
-        elif isinstance(msg, AIMessage):
-            ai_content = ""
-            if msg.content is not None:
-                ai_content = normalize_reply_content(msg.content)
-                if ai_content == "(No text response)":
-                    ai_content = ""
-
-            tool_calls = msg.additional_kwargs.get("tool_calls", [])
-            if tool_calls:
-                formatted_tool_calls = []
-                for tc in tool_calls:
-                    formatted_tool_calls.append(
-                        {
-                            "id": tc.get("id", ""),
-                            "type": "function",
-                            "function": {
-                                "name": tc.get("name", ""),
-                                "arguments": tc.get("arguments", "{}"),
-                            },
-                        }
-                    )
-                mistral_messages.append(
-                    {
-                        "role": "assistant",
-                        "content": ai_content,
-                        "tool_calls": formatted_tool_calls,
-                    }
-                )
-            else:
-                mistral_messages.append({"role": "assistant", "content": ai_content})
-        elif isinstance(msg, ToolMessage):
+            last_human_pos = pos
+
+    for pos, (msg, converted) in enumerate(history):
+        if image_url and pos == last_human_pos:
             mistral_messages.append(
                 {
-                    "role": "tool",
-                    "content": normalize_reply_content(msg.content),
-                    "tool_call_id": getattr(msg, "tool_call_id", ""),
+                    "role": "user",
+                    "content": [
+                        {"type": "text", "text": converted["content"]},
+                        {
+                            "type": "image_url",
+                            "image_url": image_url,
+                        },
+                    ],
                 }
             )
+        else:
+            mistral_messages.append(converted)
 
     return mistral_messages
 
 
-def agent_node(state: AgentState):
+def agent_node(state: AgentState, config: RunnableConfig, express=False):
     messages = state["messages"]
     plan = state.get("plan", "")
 
@@ -215,16 +376,40 @@ def agent_node(state: AgentState):
         else "auto"
     )
 
-    mistral_messages = build_mistral_messages(state)
+    mistral_messages = build_mistral_messages(state, express=express)
+
+    # Content deltas are pushed to stream_mode="custom" consumers (the Gradio UI)
+    # as they arrive; invoke() callers get a no-op writer.
+    writer = get_stream_writer()
+    writer({"event": "agent_start"})
+
+    # Tool calls are started as soon as their arguments are complete; tools_node
+    # picks up the running handles from the run config.
+    configurable = (config or {}).get("configurable") or {}
+    early_tool_calls = configurable.get("early_tool_calls")
+
+    def start_early(call):
+        early_tool_calls[call["id"]] = start_tool_call(
+            call, configurable.get("prefetcher"), configurable.get("session_id"), configurable.get("tool_memo")
+        )
+        writer({"event": "tools_start", "names": [call["name"]]})
+
+    on_tool_call = start_early if TOOL_EARLY_START_ENABLED and early_tool_calls is not None else None
 
     stream = safe_chat_stream(
-        model=MODEL,
+        priority=priority_from_config(config, PRIORITY_INTERACTIVE),
+        session_id=session_id_from_config(config),
+        model=model_for_node("agent", state, required_tools),
         messages=mistral_messages,
         tools=tools,
         tool_choice=tool_choice,
         max_tokens=1024
     )
-    content_text, tool_calls = collect_streamed_response(stream)
+    content_text, tool_calls = collect_streamed_response(
+        stream,
+        on_delta=lambda text: writer({"event": "delta", "text": text}),
+        on_tool_call=on_tool_call,
+    )
 
     if tool_calls:
         return {
@@ -239,7 +424,26 @@ def agent_node(state: AgentState):
     return {"messages": [AIMessage(content=content_text)]}
 
 
-def tools_node(state: AgentState):
+def build_run_config(prefetcher=None, session_id=None, priority=None):
+    return {
+        "recursion_limit": 80,
+        "configurable": {
+            "prefetcher": prefetcher,
+            "trace_id": uuid.uuid4().hex,
+            "session_id": session_id,
+            "priority": priority,
+            "early_tool_calls": {},
+            # Results of this run's tool calls, reused when a retry repeats a call.
+            "tool_memo": {},
+        },
+    }
+
+
+def express_agent_node(state: AgentState, config: RunnableConfig):
+    return agent_node(state, config, express=True)
+
+
+def tools_node(state: AgentState, config: RunnableConfig):
     last_message = state["messages"][-1]
     tool_calls = []
     if isinstance(last_message, AIMessage):
@@ -247,35 +451,42 @@ def tools_node(state: AgentState):
     if not tool_calls:
         return state
 
+    writer = get_stream_writer()
+    writer({"event": "tools_start", "names": [tc.get("name", "") for tc in tool_calls]})
+
     tool_results = []
-    for tool_call in tool_calls:
-        result, plot_base64 = execute_tool_by_name_and_args(
-            tool_call.get("name", ""),
-            tool_call.get("arguments", "{}"),
-        )
+    configurable = config.get("configurable") or {}
+    results = execute_tool_calls(
+        tool_calls,
+        configurable.get("prefetcher"),
+        configurable.get("session_id"),
+        configurable.get("early_tool_calls"),
+        configurable.get("tool_memo"),
+    )
+    for tool_call, (result, artifacts) in zip(tool_calls, results):
         tool_results.append(ToolMessage(
             content=result if (isinstance(result, str) and not result.startswith("Tool execution failed")) else "Tool unavailable - proceeding without this step.",
             tool_call_id=tool_call.get("id", ""),
             name=tool_call.get("name", ""),
-            additional_kwargs={"plot_base64": plot_base64} if plot_base64 else {}
+            # Figures travel as artifact references, never inline image data.
+            additional_kwargs={"artifacts": artifacts} if artifacts else {}
         ))
 
     return {"messages": tool_results}
 
 
-def critic_node(state: AgentState):
+CRITIC_MAX_RETRIES = 2
+
+
+def rule_critique(state: AgentState):
+    # The deterministic critic checks (tool usage, math verbosity, stray links).
+    # Returns the critic's state update when one fails, or None when all pass.
     last_answer = state["messages"][-1].content
     retry_count = int(state.get("retry_count", 0))
-    max_retries = 2
+    max_retries = CRITIC_MAX_RETRIES
     normalized_last_answer = normalize_reply_content(last_answer)
 
-    last_user_text = ""
-    for msg in reversed(state["messages"]):
-        if isinstance(msg, HumanMessage):
-            candidate = normalize_reply_content(msg.content)
-            if not is_internal_control_message(candidate):
-                last_user_text = candidate
-                break
+    user_text = last_user_text(state["messages"])
 
     required_tools = list(dict.fromkeys(
         (state.get("required_tools") or []) + infer_required_tools_from_plan(state.get("plan", ""))
@@ -284,7 +495,7 @@ def critic_node(state: AgentState):
     web_search_used = "web_search" in used_tools
     missing_tools = [t for t in required_tools if t not in used_tools]
     extra_tools = [t for t in used_tools if t not in required_tools]
-    is_pure_math = is_math_query(last_user_text) and set(required_tools) == {"calculator"}
+    is_pure_math = is_math_query(user_text) and set(required_tools) == {"calculator"}
 
     if is_pure_math:
         disallowed_tools_used = [t for t in used_tools if t in {"web_search", "code_interpreter"}]
@@ -380,6 +591,62 @@ def critic_node(state: AgentState):
             "retry_count": retry_count + 1,
         }
 
+    return None
+
+
+def revision_request(state: AgentState, critique):
+    # Sends the answer back to the agent with the critique, or keeps it once the
+    # retry budget is spent.
+    retry_count = int(state.get("retry_count", 0))
+    if retry_count >= CRITIC_MAX_RETRIES:
+        return {
+            "messages": [AIMessage(content=normalize_reply_content(state["messages"][-1].content))],
+            "needs_retry": False,
+            "retry_count": retry_count,
+        }
+    return {
+        "messages": [
+            HumanMessage(
+                content=(
+                    "Revise and improve the previous answer based on this critique, "
+                    "then continue execution if any planned step is incomplete. "
+                    "Provide the final answer directly without headings like 'Revised Answer':\n"
+                    f"{critique}"
+                )
+            )
+        ],
+        "plan": state.get("plan", ""),
+        "needs_retry": True,
+        "retry_count": retry_count + 1,
+    }
+
+
+def prescreen_state(state: AgentState):
+    return prescreen_answer(
+        normalize_reply_content(state["messages"][-1].content),
+        last_user_text(state["messages"]),
+        turn_tool_outputs(state["messages"]),
+        has_image=bool(state.get("image_data")),
+    )
+
+
+def critic_node(state: AgentState, config: RunnableConfig):
+    ruled = rule_critique(state)
+    if ruled is not None:
+        return ruled
+
+    retry_count = int(state.get("retry_count", 0))
+    accepted = {"messages": [], "needs_retry": False, "retry_count": retry_count}
+    # Local scoring settles clear cases; only low-confidence answers go to the model.
+    screened = prescreen_state(state) if CRITIC_PRESCREEN_ENABLED else None
+    if screened is not None and screened["decision"] != "escalate":
+        log_decision(screened)
+        if screened["decision"] == "accept":
+            return accepted
+        return revision_request(state, rejection_feedback(screened))
+
+    normalized_last_answer = normalize_reply_content(state["messages"][-1].content)
+    web_search_used = "web_search" in used_tools_from_messages(state["messages"])
     has_image = bool(state.get("image_data"))
     tool_criteria = (
         "2. Were required tools used appropriately? (Note: pure image description needs NO tools)"
@@ -403,84 +670,130 @@ Otherwise say "GOOD".
 web_search_used={web_search_used}"""
 
     critique = safe_chat_complete(
+        hedge=True,
+        cache=True,
+        priority=priority_from_config(config, PRIORITY_BACKGROUND),
+        session_id=session_id_from_config(config),
         model=CRITIC_MODEL,
         messages=[{"role": "user", "content": critic_prompt}],
         max_tokens=300
     ).choices[0].message.content
 
-    if "GOOD" in critique.upper():
-        return {
-            "messages": [],
-            "needs_retry": False,
-            "retry_count": retry_count,
-        }
-
-    if retry_count >= max_retries:
-        return {
-            "messages": [AIMessage(content=normalized_last_answer)],
-            "needs_retry": False,
-            "retry_count": retry_count,
-        }
+    good = "GOOD" in critique.upper()
+    if screened is not None:
+        screened["model_verdict"] = "GOOD" if good else "NEEDS IMPROVEMENT"
+        log_decision(screened)
+    if good:
+        return accepted
+    return revision_request(state, critique)
+
+
+def express_critic_node(state: AgentState, config: RunnableConfig):
+    # Accepts the first answer when the rule checks and the pre-screen's hard
+    # checks pass, with no model call. Once a check has failed and the answer was
+    # revised, the full critic (including the model review) takes over.
+    if int(state.get("retry_count", 0) or 0) > 0:
+        return critic_node(state, config)
+    ruled = rule_critique(state)
+    if ruled is not None:
+        return ruled
+    if CRITIC_PRESCREEN_ENABLED:
+        screened = prescreen_state(state)
+        log_decision(screened, graph="express")
+        if screened["decision"] == "reject":
+            return revision_request(state, rejection_feedback(screened))
+    return {"messages": [], "needs_retry": False, "retry_count": 0}
+
+
+def is_simple_request(query_text, required_tools):
+    t = (query_text or "").lower()
+    if len(t) > EXPRESS_MAX_QUERY_CHARS or len(required_tools or []) > EXPRESS_MAX_TOOLS:
+        return False
+    return not any(marker in t for marker in EXPRESS_MULTI_STEP_MARKERS)
+
+
+def select_graph(state: AgentState):
+    # Per-request choice between the full planner/critic graph and the express one.
+    if not EXPRESS_GRAPH_ENABLED:
+        return "full"
+    query = last_user_text(state.get("messages"))
+    return "express" if is_simple_request(query, state.get("required_tools")) else "full"
+
+
+def final_reply_from_messages(messages):
+    # The user-facing answer for a finished run: the last message, cleaned up,
+    # falling back to the latest tool output when the model returned nothing.
+    final_reply = clean_final_reply(normalize_reply_content(messages[-1].content)) if messages else ""
+    if not final_reply.strip():
+        for msg_obj in reversed(messages):
+            if isinstance(msg_obj, ToolMessage):
+                tool_text = normalize_reply_content(msg_obj.content).strip()
+                if tool_text:
+                    final_reply = tool_text
+                    break
+    if not final_reply.strip():
+        final_reply = "I couldn't generate a final response, but I can retry if you send the same request again."
+    return final_reply
+
+
+def fast_math_lane(state: AgentState):
+    # Plain arithmetic ("Compute 12 * (3 + 4)") is answered locally without
+    # planner/agent/critic/summary model calls. Returns None to use the graph.
+    messages = list(state.get("messages") or [])
+    if not messages or not isinstance(messages[-1], HumanMessage):
+        return None
+    expression = extract_arithmetic_expression(normalize_reply_content(messages[-1].content))
+    if expression is None:
+        return None
+    value = evaluate_arithmetic(expression)
+    if value is None:
+        return None
+
+    answer = f"{expression} = {value}"
     return {
-        "messages": [
-            HumanMessage(
-                content=(
-                    "Revise and improve the previous answer based on this critique, "
-                    "then continue execution if any planned step is incomplete. "
-                    "Provide the final answer directly without headings like 'Revised Answer':\n"
-                    f"{critique}"
-                )
-            )
-        ],
-        "plan": state.get("plan", ""),
-        "needs_retry": True,
-        "retry_count": retry_count + 1,
+        **state,
+        "messages": messages + [AIMessage(content=answer)],
+        "plan": "1. Evaluate the arithmetic expression locally (no model call).",
+        "needs_retry": False,
     }
 
 
-def summarize_memory(state: AgentState):
-    messages = state["messages"]
-    readable = []
-    for m in messages[-5:]:
-        if isinstance(m, HumanMessage):
-            text = normalize_reply_content(m.content)
-            if not is_internal_control_message(text):
-                readable.append(f"User: {text}")
-        elif isinstance(m, AIMessage):
-            readable.append(f"Assistant: {normalize_reply_content(m.content)}")
-
-    summary_prompt = "Summarize key points in 2-3 sentences:\n" + "\n".join(readable)
-
-    summary = safe_chat_complete(
-        model=MODEL,
-        messages=[
-            {"role": "system", "content": "You are a helpful summarizer."},
-            {"role": "user", "content": summary_prompt},
-        ],
-        max_tokens=150
-    ).choices[0].message.content
+def _after_agent(state):
+    last = state["messages"][-1]
+    return "tools" if isinstance(last, AIMessage) and last.additional_kwargs.get("tool_calls") else "critic"
+
 
-    return {"summary": summary}
+def _after_critic(state):
+    # The conversation summary is updated after the turn, off the critical path (summarizer.py).
+    return "agent" if state.get("needs_retry") else END
 
 
 workflow = StateGraph(AgentState)
-workflow.add_node("planner", planner_node)
-workflow.add_node("agent", agent_node)
-workflow.add_node("tools", tools_node)
-workflow.add_node("critic", critic_node)
-workflow.add_node("summarize", summarize_memory)
+workflow.add_node("planner", traced_node("planner", planner_node))
+workflow.add_node("agent", traced_node("agent", agent_node))
+workflow.add_node("tools", traced_node("tools", tools_node))
+workflow.add_node("critic", traced_node("critic", critic_node))
 
 workflow.set_entry_point("planner")
 workflow.add_edge("planner", "agent")
-workflow.add_conditional_edges(
-    "agent",
-    lambda s: "tools" if isinstance(s["messages"][-1], AIMessage) and s["messages"][-1].additional_kwargs.get("tool_calls") else "critic"
-)
+workflow.add_conditional_edges("agent", _after_agent)
 workflow.add_edge("tools", "agent")
-workflow.add_conditional_edges(
-    "critic",
-    lambda s: "agent" if s.get("needs_retry") else "summarize"
-)
-workflow.add_edge("summarize", END)
+workflow.add_conditional_edges("critic", _after_critic)
 
 app = workflow.compile()
+
+# Express graph for simple requests: the agent plans and acts in one call and the
+# critic only calls the model after a deterministic check has failed.
+express_workflow = StateGraph(AgentState)
+express_workflow.add_node("agent", traced_node("express_agent", express_agent_node))
+express_workflow.add_node("tools", traced_node("tools", tools_node))
+express_workflow.add_node("critic", traced_node("express_critic", express_critic_node))
+
+express_workflow.set_entry_point("agent")
+express_workflow.add_conditional_edges("agent", _after_agent)
+express_workflow.add_edge("tools", "agent")
+express_workflow.add_conditional_edges("critic", _after_critic)
+
+express_app = express_workflow.compile()
+
+GRAPHS = {"full": app, "express": express_app}
@@ -0,0 +1,149 @@
+import hashlib
+import os
+import shutil
+import threading
+import time
+import uuid
+
+from config import ARTIFACT_MAX_BYTES, ARTIFACT_TTL_SECONDS, CACHE_DIR
+
+
+ARTIFACT_DIR = os.path.join(CACHE_DIR, "artifacts")
+ARTIFACT_ID_PREFIX = "art_"
+ARTIFACT_MIME_TYPES = {
+    "png": "image/png",
+    "webp": "image/webp",
+    "svg": "image/svg+xml",
+    "txt": "text/plain",
+}
+ARTIFACT_SWEEP_EVERY = 100
+# Temp files left behind by a crashed writer are removed after this long.
+ARTIFACT_TMP_MAX_AGE_SECONDS = 60 * 60
+
+_sweep_lock = threading.Lock()
+_puts = 0
+
+
+def _artifact_id(digest):
+    return ARTIFACT_ID_PREFIX + digest[:32]
+
+
+def _file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 16), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def artifact_path(ref):
+    # Accepts an artifact reference dict as stored in ToolMessage additional_kwargs.
+    if not isinstance(ref, dict) or not str(ref.get("id", "")).startswith(ARTIFACT_ID_PREFIX):
+        return None
+    path = os.path.join(ARTIFACT_DIR, f"{ref['id']}.{ref.get('format', '')}")
+    return path if os.path.exists(path) else None
+
+
+def write_atomically(dest, write):
+    # Calls write(tmp_path), then renames the temp file over dest. The temp name
+    # is unique per writer, so concurrent writes of the same file never share one.
+    os.makedirs(os.path.dirname(dest) or ".", exist_ok=True)
+    tmp = f"{dest}.{uuid.uuid4().hex}.tmp"
+    try:
+        write(tmp)
+        os.replace(tmp, dest)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def _store(dest, write):
+    # Writes via `write(tmp_path)` unless the artifact already exists; a hit
+    # refreshes its mtime, which the sweep uses as last use.
+    global _puts
+    if os.path.exists(dest):
+        try:
+            os.utime(dest)
+        except OSError:
+            pass
+    else:
+        write_atomically(dest, write)
+    with _sweep_lock:
+        _puts += 1
+        if _puts % ARTIFACT_SWEEP_EVERY == 0:
+            sweep_artifacts()
+
+
+def sweep_artifacts(now=None):
+    return sweep_directory(ARTIFACT_DIR, ARTIFACT_TTL_SECONDS, ARTIFACT_MAX_BYTES, now)
+
+
+def sweep_directory(directory, ttl_seconds, max_bytes, now=None):
+    # Deletes files unused (by mtime) for ttl_seconds, then the least recently
+    # used ones while the directory is over max_bytes, plus stale temp files.
+    # Returns the number of files removed.
+    now = time.time() if now is None else now
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        return 0
+    entries = []
+    for name in names:
+        try:
+            stat = os.stat(os.path.join(directory, name))
+        except OSError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, name))
+    entries.sort()
+    total = sum(size for _, size, _ in entries)
+    removed = 0
+    for mtime, size, name in entries:
+        age = now - mtime
+        if name.endswith(".tmp"):
+            expired = age > ARTIFACT_TMP_MAX_AGE_SECONDS
+        else:
+            expired = age > ttl_seconds or total > max_bytes
+        if not expired:
+            continue
+        try:
+            os.remove(os.path.join(directory, name))
+        except OSError:
+            continue
+        total -= size
+        removed += 1
+    return removed
+
+
+def _make_ref(artifact_id, extension, size):
+    return {
+        "id": artifact_id,
+        "format": extension,
+        "mime": ARTIFACT_MIME_TYPES.get(extension, "application/octet-stream"),
+        "bytes": size,
+    }
+
+
+def put_artifact_file(src_path, extension):
+    # Moves a file into the content-addressed store and returns its reference.
+    extension = extension.lower().lstrip(".")
+    artifact_id = _artifact_id(_file_digest(src_path))
+    size = os.path.getsize(src_path)
+    dest = os.path.join(ARTIFACT_DIR, f"{artifact_id}.{extension}")
+    _store(dest, lambda tmp: shutil.move(src_path, tmp))
+    if os.path.exists(src_path):
+        os.remove(src_path)
+    return _make_ref(artifact_id, extension, size)
+
+
+def put_artifact_bytes(data, extension):
+    extension = extension.lower().lstrip(".")
+    artifact_id = _artifact_id(hashlib.sha256(data).hexdigest())
+    dest = os.path.join(ARTIFACT_DIR, f"{artifact_id}.{extension}")
+
+    def write(tmp):
+        with open(tmp, "wb") as f:
+            f.write(data)
+
+    _store(dest, write)
+    return _make_ref(artifact_id, extension, len(data))
+
@@ -0,0 +1,268 @@
+import argparse
+import json
+import os
+import shutil
+import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+
+DEFAULT_CONCURRENCY = 8
+
+
+def load_records(path):
+    # One JSON object per line: {"query": ..., "image": optional path, "id": optional}.
+    # Records without an ID are keyed by line number so a resumed run can match them.
+    base_dir = os.path.dirname(os.path.abspath(path))
+    records = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line_number, line in enumerate(f, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            record["id"] = str(record.get("id") or f"line-{line_number}")
+            image = record.get("image")
+            if image and not os.path.isabs(image):
+                record["image"] = os.path.join(base_dir, image)
+            records.append(record)
+    return records
+
+
+def is_directory_output(output_path):
+    return output_path.endswith(("/", os.sep)) or os.path.isdir(output_path)
+
+
+def _safe_file_stem(record_id):
+    return "".join(c if c.isalnum() or c in "-_." else "_" for c in record_id)[:100]
+
+
+def _previous_entries(output_path):
+    if is_directory_output(output_path):
+        if not os.path.isdir(output_path):
+            return
+        for name in os.listdir(output_path):
+            if name.endswith(".json"):
+                try:
+                    with open(os.path.join(output_path, name), "r", encoding="utf-8") as f:
+                        yield json.load(f)
+                except (OSError, ValueError):
+                    continue
+        return
+    if not os.path.exists(output_path):
+        return
+    with open(output_path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                yield json.loads(line)
+            except ValueError:
+                continue  # partial line from an interrupted write
+
+
+def completed_ids(output_path, retry_failed=False):
+    # The output doubles as the checkpoint: every finished record is already there.
+    # With retry_failed, a failed record is run again and its new result appended.
+    done = set()
+    for entry in _previous_entries(output_path):
+        if entry.get("ok") or not retry_failed:
+            done.add(str(entry.get("id")))
+    return done
+
+
+def _write_plots(messages, plots_dir, record_id):
+    from artifacts import artifact_path
+    from langchain_core.messages import ToolMessage
+
+    paths = []
+    for msg_obj in messages:
+        if not isinstance(msg_obj, ToolMessage):
+            continue
+        for ref in msg_obj.additional_kwargs.get("artifacts") or []:
+            source = artifact_path(ref)
+            if source is None or not str(ref.get("mime", "")).startswith("image/"):
+                continue
+            os.makedirs(plots_dir, exist_ok=True)
+            path = os.path.join(plots_dir, f"{_safe_file_stem(record_id)}_{len(paths) + 1}.{ref['format']}")
+            shutil.copyfile(source, path)
+            paths.append(path)
+    return paths
+
+
+def run_record(record, plots_dir):
+    import agent
+    from image_store import put_image
+    from prefetch import SpeculativePrefetcher
+    from scheduler import PRIORITY_BATCH
+    from summarizer import fold_summary
+    from tools import infer_required_tools
+    from langchain_core.messages import HumanMessage
+    from PIL import Image
+
+    started = time.perf_counter()
+    entry = {"id": record["id"], "query": record.get("query", ""), "image": record.get("image")}
+    try:
+        image_id = ""
+        if record.get("image"):
+            with Image.open(record["image"]) as image:
+                image_id = put_image(image)
+        query = record.get("query") or ""
+        required_tools = infer_required_tools(query)
+        inputs = {
+            "messages": [HumanMessage(content=query)],
+            "summary": "",
+            "image_data": image_id,
+            "plan": "",
+            "needs_retry": False,
+            "retry_count": 0,
+            "required_tools": required_tools,
+        }
+        result = agent.fast_math_lane(inputs)
+        if result is None:
+            prefetcher = SpeculativePrefetcher()
+            prefetcher.start_for_query(query, required_tools)
+            try:
+                result = agent.GRAPHS[agent.select_graph(inputs)].invoke(
+                    inputs,
+                    config=agent.build_run_config(prefetcher, session_id=f"batch-{record['id']}", priority=PRIORITY_BATCH),
+                )
+            finally:
+                prefetcher.finish()
+        messages = result["messages"]
+        entry.update(
+            ok=True,
+            error=None,
+            answer=agent.final_reply_from_messages(messages),
+            plan=result.get("plan", ""),
+            summary=fold_summary("", messages, priority=PRIORITY_BATCH, session_id=f"batch-{record['id']}") or "",
+            tools_used=agent.used_tools_from_messages(messages),
+            critic_retries=int(result.get("retry_count", 0) or 0),
+            plots=_write_plots(messages, plots_dir, record["id"]),
+        )
+    except Exception as e:
+        entry.update(ok=False, error=str(e))
+    entry["latency_seconds"] = round(time.perf_counter() - started, 4)
+    return entry
+
+
+class _ResultWriter:
+    # Appends to a JSONL file, or writes <id>.json files when the output is a directory.
+    def __init__(self, output_path):
+        self.directory = output_path if is_directory_output(output_path) else None
+        self._lock = threading.Lock()
+        self._file = None
+        if self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+        else:
+            os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+            self._file = open(output_path, "a", encoding="utf-8")
+
+    def write(self, entry):
+        payload = json.dumps(entry, default=str)
+        with self._lock:
+            if self._file is not None:
+                self._file.write(payload + "\n")
+                self._file.flush()
+                return
+            path = os.path.join(self.directory, _safe_file_stem(entry["id"]) + ".json")
+            with open(path + ".tmp", "w", encoding="utf-8") as f:
+                f.write(payload)
+            os.replace(path + ".tmp", path)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+
+
+def default_plots_dir(output_path):
+    if is_directory_output(output_path):
+        return os.path.join(output_path, "plots")
+    return os.path.splitext(output_path)[0] + "_plots"
+
+
+def run_batch(records, output_path, plots_dir=None, concurrency=DEFAULT_CONCURRENCY, retry_failed=False, progress=None):
+    # Runs records concurrently (the request scheduler sets the real pace) and
+    # writes each result as soon as it finishes. Returns (succeeded, failed, skipped).
+    plots_dir = plots_dir or default_plots_dir(output_path)
+    done = completed_ids(output_path, retry_failed=retry_failed)
+    todo = [r for r in records if r["id"] not in done]
+    skipped = len(records) - len(todo)
+    counts = {"ok": 0, "failed": 0}
+    counts_lock = threading.Lock()
+    writer = _ResultWriter(output_path)
+
+    def finish(entry):
+        writer.write(entry)
+        with counts_lock:
+            counts["ok" if entry["ok"] else "failed"] += 1
+            finished = counts["ok"] + counts["failed"]
+        if progress:
+            progress(finished, len(todo), entry)
+
+    executor = ThreadPoolExecutor(max_workers=max(1, concurrency), thread_name_prefix="batch")
+    pending = set()
+    try:
+        # Keep at most `concurrency` records in flight so an interrupt loses little work.
+        for record in todo:
+            pending.add(executor.submit(run_record, record, plots_dir))
+            if len(pending) >= concurrency:
+                finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    finish(future.result())
+        for future in pending:
+            finish(future.result())
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+        writer.close()
+    return counts["ok"], counts["failed"], skipped
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run a JSONL corpus of (query, image) records through the agent.")
+    parser.add_argument("input", help="JSONL file with one {\"query\", \"image\"?, \"id\"?} object per line.")
+    parser.add_argument(
+        "--output",
+        default="batch_results.jsonl",
+        help="Results JSONL, or a directory (trailing /) for one JSON file per record; also used to resume.",
+    )
+    parser.add_argument("--plots-dir", help="Where to write figures (default: <output>_plots or <output>/plots).")
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY, help="Records in flight at once.")
+    parser.add_argument("--retry-failed", action="store_true", help="Re-run records that failed in a previous run.")
+    parser.add_argument("--restart", action="store_true", help="Ignore previous results and start over.")
+    args = parser.parse_args(argv)
+
+    records = load_records(args.input)
+    if args.restart and os.path.exists(args.output):
+        if os.path.isdir(args.output):
+            shutil.rmtree(args.output)
+        else:
+            os.remove(args.output)
+    started = time.perf_counter()
+
+    def progress(finished, total, entry):
+        elapsed = time.perf_counter() - started
+        status = "ok" if entry["ok"] else f"error: {entry['error']}"
+        print(
+            f"[{finished}/{total}] {entry['id']:<20} {entry['latency_seconds']:>7.2f}s  "
+            f"{finished / elapsed if elapsed else 0.0:.2f} rec/s  {status}",
+            file=sys.stderr,
+        )
+
+    try:
+        ok, failed, skipped = run_batch(
+            records,
+            args.output,
+            args.plots_dir,
+            concurrency=args.concurrency,
+            retry_failed=args.retry_failed,
+            progress=progress,
+        )
+    except KeyboardInterrupt:
+        print(f"\nInterrupted; finished records are in {args.output}. Re-run to resume.", file=sys.stderr)
+        return 130
+    print(f"{ok} succeeded, {failed} failed, {skipped} already done. Results in {args.output}")
+    return 0 if failed == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
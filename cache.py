@@ -0,0 +1,107 @@
+import collections
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from config import CACHE_DB_PATH
+from tracing import increment
+
+
+class PersistentTTLCache:
+    # In-memory LRU in front of a shared SQLite table; entries expire after
+    # ttl_seconds and may still be served as stale for stale_seconds more.
+    def __init__(self, namespace, max_entries, ttl_seconds, stale_seconds=0, db_path=CACHE_DB_PATH):
+        self.namespace = namespace
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.stale_seconds = stale_seconds
+        self._memory = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._sets = 0
+        self._db = None
+        if db_path:
+            try:
+                os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+                self._db = sqlite3.connect(db_path, check_same_thread=False, timeout=5)
+                self._db.execute("PRAGMA journal_mode=WAL")
+                self._db.execute(
+                    "CREATE TABLE IF NOT EXISTS cache_entries ("
+                    "namespace TEXT NOT NULL, key TEXT NOT NULL, stored_at REAL NOT NULL, value TEXT NOT NULL, "
+                    "PRIMARY KEY (namespace, key))"
+                )
+                self._db.commit()
+            except sqlite3.Error:
+                self._db = None
+
+    def _remember(self, key, stored_at, value):
+        self._memory[key] = (stored_at, value)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+            increment("agent_cache_evictions_total", namespace=self.namespace)
+
+    def _load_from_disk(self, key):
+        if self._db is None:
+            return None
+        try:
+            row = self._db.execute(
+                "SELECT stored_at, value FROM cache_entries WHERE namespace = ? AND key = ?",
+                (self.namespace, key),
+            ).fetchone()
+        except sqlite3.Error:
+            return None
+        if row is None:
+            return None
+        try:
+            return row[0], json.loads(row[1])
+        except ValueError:
+            return None
+
+    def get(self, key, allow_stale=False):
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            from_disk = False
+            if entry is None:
+                entry = self._load_from_disk(key)
+                from_disk = entry is not None
+            if entry is not None:
+                stored_at, value = entry
+                age = now - stored_at
+                if age <= self.ttl_seconds or (allow_stale and age <= self.ttl_seconds + self.stale_seconds):
+                    self._remember(key, stored_at, value)
+                    stale = age > self.ttl_seconds
+                    increment(
+                        "agent_cache_lookups_total",
+                        namespace=self.namespace,
+                        result="stale_hit" if stale else "hit",
+                        source="disk" if from_disk else "memory",
+                    )
+                    return value, stale
+                self._memory.pop(key, None)
+            increment("agent_cache_lookups_total", namespace=self.namespace, result="miss", source="none")
+            return None
+
+    def set(self, key, value):
+        stored_at = time.time()
+        with self._lock:
+            self._remember(key, stored_at, value)
+            self._sets += 1
+            increment("agent_cache_sets_total", namespace=self.namespace)
+            if self._db is None:
+                return
+            try:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO cache_entries (namespace, key, stored_at, value) VALUES (?, ?, ?, ?)",
+                    (self.namespace, key, stored_at, json.dumps(value)),
+                )
+                if self._sets % 100 == 0:
+                    self._db.execute(
+                        "DELETE FROM cache_entries WHERE namespace = ? AND stored_at < ?",
+                        (self.namespace, stored_at - self.ttl_seconds - self.stale_seconds),
+                    )
+                self._db.commit()
+            except sqlite3.Error:
+                pass
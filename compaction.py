@@ -0,0 +1,168 @@
+import re
+import statistics
+
+from config import (
+    DEFAULT_TOOL_OUTPUT_LIMIT,
+    TOOL_OUTPUT_HEAD_FRACTION,
+    TOOL_OUTPUT_LIMITS,
+    TOOL_OUTPUT_TABLE_MAX_ROWS,
+)
+from utils import estimate_tokens
+
+
+TABLE_HEAD_ROWS = 5
+TABLE_TAIL_ROWS = 3
+MIN_REPEATED_LINES = 3
+
+_ELLIPSIS_ROW = re.compile(r"^[\s.…]+$")
+
+
+def tool_output_limit(name):
+    return TOOL_OUTPUT_LIMITS.get(name, DEFAULT_TOOL_OUTPUT_LIMIT)
+
+
+def within_limit(text, limit):
+    return len(text.encode("utf-8")) <= limit["max_bytes"] and estimate_tokens(text) <= limit["max_tokens"]
+
+
+def dedupe_lines(lines):
+    # Collapses runs of identical lines (progress bars, loop prints, recursion frames).
+    out = []
+    i = 0
+    while i < len(lines):
+        j = i
+        while j + 1 < len(lines) and lines[j + 1] == lines[i]:
+            j += 1
+        run = j - i + 1
+        if run >= MIN_REPEATED_LINES and lines[i].strip():
+            out.append(lines[i])
+            out.append(f"[previous line repeated {run - 1} more times]")
+        else:
+            out.extend(lines[i:j + 1])
+        i = j + 1
+    return out
+
+
+def _is_number(token):
+    try:
+        float(token.replace(",", ""))
+        return True
+    except ValueError:
+        return False
+
+
+def _token_ends(line):
+    return {match.end() for match in re.finditer(r"\S+", line)}
+
+
+def _column_stats(header, first_row, rows):
+    # Min/mean/max for numeric columns of the printed rows. The header must name
+    # every column, or every column but the index (pandas' layout), right-aligned
+    # with the first row.
+    width = len(rows[0])
+    names = header.split() if header else []
+    if len(names) == width - 1:
+        names = [None] + names
+    if len(names) != width or not _token_ends(header) <= _token_ends(first_row):
+        return []
+    stats = []
+    for col, name in enumerate(names):
+        values = [row[col] for row in rows]
+        if name is None or not all(_is_number(v) for v in values):
+            continue
+        numbers = [float(v.replace(",", "")) for v in values]
+        stats.append(f"{name}: min={min(numbers):g} mean={statistics.fmean(numbers):g} max={max(numbers):g}")
+    return stats
+
+
+def summarize_tables(lines):
+    # Long runs of rows with the same number of whitespace-separated fields
+    # (DataFrame/array prints) are cut to their first and last rows, plus the row
+    # count and numeric column stats of the printed rows.
+    out = []
+    i = 0
+    while i < len(lines):
+        width = len(lines[i].split())
+        j = i
+        while (
+            width >= 2
+            and j + 1 < len(lines)
+            and (len(lines[j + 1].split()) == width or _ELLIPSIS_ROW.match(lines[j + 1]))
+        ):
+            j += 1
+        if width < 2 or j - i + 1 <= TOOL_OUTPUT_TABLE_MAX_ROWS:
+            out.append(lines[i])
+            i += 1
+            continue
+        block = lines[i:j + 1]
+        rows = [line.split() for line in block if not _ELLIPSIS_ROW.match(line)]
+        header = out[-1] if out else ""
+        out.extend(block[:TABLE_HEAD_ROWS])
+        out.append(f"... [{len(block) - TABLE_HEAD_ROWS - TABLE_TAIL_ROWS} rows omitted] ...")
+        out.extend(block[-TABLE_TAIL_ROWS:])
+        out.append(f"[table: {len(rows)} printed rows x {width} fields]")
+        out.extend(f"[{line}]" for line in _column_stats(header, block[0], rows))
+        i = j + 1
+    return out
+
+
+def truncate_middle(text, limit):
+    # Keeps the head and tail (where errors and final results usually are), on
+    # line boundaries when possible.
+    budget = min(limit["max_bytes"], limit["max_tokens"] * 4)
+    while True:
+        head_budget = int(budget * TOOL_OUTPUT_HEAD_FRACTION)
+        tail_budget = budget - head_budget
+        lines = text.splitlines()
+        head, tail = [], []
+        used = 0
+        for line in lines:
+            if used + len(line) + 1 > head_budget:
+                break
+            head.append(line)
+            used += len(line) + 1
+        used = 0
+        for line in reversed(lines[len(head):]):
+            if used + len(line) + 1 > tail_budget:
+                break
+            tail.insert(0, line)
+            used += len(line) + 1
+        if head or tail:
+            omitted = len(lines) - len(head) - len(tail)
+            head_text, tail_text = "\n".join(head), "\n".join(tail)
+            omitted_chars = len(text) - len(head_text) - len(tail_text)
+            marker = f"... [{omitted} lines, {omitted_chars} characters omitted] ..."
+        else:
+            # A few very long lines: cut by characters instead.
+            head_text, tail_text = text[:head_budget], text[-tail_budget:] if tail_budget else ""
+            marker = f"... [{len(text) - len(head_text) - len(tail_text)} characters omitted] ..."
+        result = "\n".join(part for part in (head_text, marker, tail_text) if part)
+        if within_limit(result, limit) or budget < 64:
+            return result
+        budget = int(budget * 0.8)
+
+
+def _compaction_note(original_chars, compacted_chars, full_output_saved):
+    note = f"\n[Output compacted from {original_chars} to {compacted_chars} characters"
+    return note + ("; the full output is shown to the user.]" if full_output_saved else ".]")
+
+
+def compact_tool_output(name, text, full_output_saved=True):
+    # Returns the text to put in the ToolMessage. Output within the tool's limit
+    # is returned unchanged; otherwise lines are deduplicated, tables summarized
+    # and, if still too large, the middle is cut. The closing note counts toward
+    # the limit; it only mentions the full output when the caller saved it.
+    if not isinstance(text, str):
+        return text
+    limit = tool_output_limit(name)
+    if within_limit(text, limit):
+        return text
+    longest_note = _compaction_note(len(text), len(text), full_output_saved)
+    body_limit = {
+        "max_bytes": max(limit["max_bytes"] - len(longest_note.encode("utf-8")), 0),
+        "max_tokens": max(limit["max_tokens"] - estimate_tokens(longest_note), 0),
+    }
+    compacted = "\n".join(summarize_tables(dedupe_lines(text.splitlines())))
+    if not within_limit(compacted, body_limit):
+        compacted = truncate_middle(compacted, body_limit)
+    return compacted + _compaction_note(len(text), len(compacted), full_output_saved)
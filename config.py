@@ -9,7 +9,141 @@ api_key = (os.getenv("MISTRAL_API_KEY") or "").strip().strip('"').strip("'")
 if not api_key:
     raise ValueError("MISTRAL_API_KEY not found in .env")
 
+# Point the client at another endpoint (e.g. the local mock used by eval.py).
+MISTRAL_SERVER_URL = os.getenv("MISTRAL_SERVER_URL") or None
+
 MODEL = "pixtral-large-latest"
 CRITIC_MODEL = "mistral-small-latest"
+SMALL_MODEL = "mistral-small-latest"
+# Per-node model routing (routing.py). A listed node uses its "model" when the
+# request fits the route; anything else, and every call after the critic has
+# rejected an answer, goes to MODEL. Set AGENT_MODEL_ROUTING=0 to always use MODEL.
+MODEL_ROUTING_ENABLED = os.getenv("AGENT_MODEL_ROUTING", "1") == "1"
+MODEL_ROUTES = {
+    # Plans for short text-only requests are a few numbered lines.
+    "planner": {"model": SMALL_MODEL, "allow_image": False, "max_query_chars": 600, "tools": ["calculator", "web_search"]},
+    # The answering step needs the large model for images, code and long prompts.
+    "agent": {"model": SMALL_MODEL, "allow_image": False, "max_query_chars": 300, "tools": ["calculator", "web_search"]},
+    # The summary prompt is always text-only.
+    "summarize": {"model": SMALL_MODEL, "allow_image": True, "max_query_chars": None, "tools": None, "escalate": False},
+}
 SANDBOX_TIMEOUT_SECONDS = 12
 
+SANDBOX_PYTHON = ["py", "-3.11"]
+SANDBOX_POOL_SIZE = 2
+SANDBOX_MAX_JOBS_PER_WORKER = 25
+SANDBOX_WORKER_START_TIMEOUT_SECONDS = 60
+# Figures are written to temp files by the sandbox and kept in the artifact store.
+SANDBOX_FIGURE_FORMAT = os.getenv("AGENT_FIGURE_FORMAT", "png")  # png, webp or svg
+SANDBOX_FIGURE_DPI = 100
+SANDBOX_MAX_FIGURES = 8
+# Optional per-session kernels: code_interpreter keeps its namespace between calls.
+SANDBOX_PERSISTENT_KERNELS = os.getenv("AGENT_PERSISTENT_KERNELS", "0") == "1"
+SANDBOX_KERNEL_MAX_SESSIONS = 8
+SANDBOX_KERNEL_IDLE_SECONDS = 10 * 60
+SANDBOX_KERNEL_MEMORY_LIMIT_MB = 1024
+TOOL_MAX_WORKERS = 8
+TOOL_CONCURRENCY_LIMITS = {
+    "calculator": 4,
+    "web_search": 3,
+    "code_interpreter": max(1, SANDBOX_POOL_SIZE),
+}
+TOOL_CALL_TIMEOUT_SECONDS = {
+    "calculator": 5,
+    "web_search": 20,
+    "code_interpreter": SANDBOX_TIMEOUT_SECONDS + SANDBOX_WORKER_START_TIMEOUT_SECONDS,
+}
+DEFAULT_TOOL_CALL_TIMEOUT_SECONDS = 30
+# Local answer scoring before the critic model: answers scoring at least the
+# threshold are accepted without a CRITIC_MODEL call (prescreen.py).
+CRITIC_PRESCREEN_ENABLED = os.getenv("AGENT_CRITIC_PRESCREEN", "1") == "1"
+CRITIC_PRESCREEN_ACCEPT_SCORE = 0.75
+CRITIC_PRESCREEN_LOG_SIZE = 1000
+# Simple requests (short, at most one inferred tool, no multi-step wording) run
+# on the express graph: no planner call, and no critic model call unless a
+# deterministic check fails. Set AGENT_EXPRESS_GRAPH=0 to always use the full graph.
+EXPRESS_GRAPH_ENABLED = os.getenv("AGENT_EXPRESS_GRAPH", "1") == "1"
+EXPRESS_MAX_QUERY_CHARS = 300
+EXPRESS_MAX_TOOLS = 1
+EXPRESS_MULTI_STEP_MARKERS = (" then ", "compare", "step by step", "verify", "and also", "analyze")
+# Start each tool call as soon as its arguments finish streaming.
+TOOL_EARLY_START_ENABLED = True
+# Tool output larger than its limit is compacted before it enters the prompt
+# (compaction.py); the full text is kept as an artifact for the UI.
+TOOL_OUTPUT_LIMITS = {
+    "calculator": {"max_bytes": 2000, "max_tokens": 500},
+    "web_search": {"max_bytes": 4000, "max_tokens": 1000},
+    "code_interpreter": {"max_bytes": 4000, "max_tokens": 1000},
+}
+DEFAULT_TOOL_OUTPUT_LIMIT = {"max_bytes": 4000, "max_tokens": 1000}
+TOOL_OUTPUT_HEAD_FRACTION = 0.6
+TOOL_OUTPUT_TABLE_MAX_ROWS = 10
+# Identical tool calls (same name and arguments) within one run reuse the first
+# result. Tools with side effects opt out; a persistent kernel's state changes
+# with every run, so repeated code must execute again.
+TOOL_MEMO_ENABLED = True
+TOOL_MEMO_EXCLUDED_TOOLS = {"code_interpreter"} if SANDBOX_PERSISTENT_KERNELS else set()
+MISTRAL_TIMEOUT_SECONDS = 60
+MISTRAL_HTTP_MAX_CONNECTIONS = 50
+MISTRAL_HTTP_MAX_KEEPALIVE_CONNECTIONS = 20
+MISTRAL_HTTP_KEEPALIVE_EXPIRY_SECONDS = 30
+MISTRAL_MAX_RETRIES = 3
+MISTRAL_BACKOFF_BASE_SECONDS = 0.5
+MISTRAL_BACKOFF_MAX_SECONDS = 8.0
+MISTRAL_HEDGE_AFTER_SECONDS = 4.0
+# Client-side rate limits per model, shared by every session in this process.
+MISTRAL_RATE_LIMITS = {
+    MODEL: {"requests_per_second": 5.0, "tokens_per_minute": 500_000},
+    CRITIC_MODEL: {"requests_per_second": 5.0, "tokens_per_minute": 500_000},
+}
+DEFAULT_MISTRAL_RATE_LIMIT = {"requests_per_second": 1.0, "tokens_per_minute": 500_000}
+SCHEDULER_MAX_QUEUE = 256
+SCHEDULER_MAX_WAIT_SECONDS = 60
+CACHE_DIR = os.getenv("AGENT_CACHE_DIR", ".cache")
+CACHE_DB_PATH = os.path.join(CACHE_DIR, "cache.sqlite3")
+# Content-addressed figures and full tool outputs. Files unused for
+# ARTIFACT_TTL_SECONDS are deleted, then the least recently used ones while the
+# store is over ARTIFACT_MAX_BYTES; sessions may outlive neither.
+ARTIFACT_TTL_SECONDS = 2 * 24 * 60 * 60
+ARTIFACT_MAX_BYTES = 1024 * 1024 * 1024
+WEB_SEARCH_CACHE_MAX_ENTRIES = 512
+WEB_SEARCH_CACHE_TTL_SECONDS = 30 * 60
+WEB_SEARCH_CACHE_STALE_SECONDS = 60 * 60
+# Exact-match cache for opted-in chat.complete calls (planner, critic, summary).
+LLM_CACHE_MAX_ENTRIES = 1024
+LLM_CACHE_TTL_SECONDS = 24 * 60 * 60
+PREFETCH_ENABLED = True
+PREFETCH_MAX_WORKERS = 4
+PREFETCH_MATCH_THRESHOLD = 0.75
+IMAGE_MAX_SIDE = 1024
+IMAGE_JPEG_QUALITY = 90
+IMAGE_STORE_MAX_BYTES = 64 * 1024 * 1024
+# Stored uploads on disk, swept like the artifact store.
+IMAGE_DISK_TTL_SECONDS = 2 * 24 * 60 * 60
+IMAGE_DISK_MAX_BYTES = 512 * 1024 * 1024
+CONTEXT_TOKEN_BUDGET = 8000
+CONTEXT_MAX_MESSAGES = 40
+CONTEXT_IMAGE_TOKEN_ESTIMATE = 1500
+CONTEXT_CACHE_MAX_MESSAGES = 4096
+TRACE_LOG_PATH = os.getenv("AGENT_TRACE_LOG", "")
+TRACE_METRICS_PORT = int(os.getenv("AGENT_METRICS_PORT", "0") or 0)
+SESSION_DB_PATH = os.getenv("AGENT_SESSION_DB", os.path.join(CACHE_DIR, "sessions.sqlite3"))
+SESSION_MAX_IN_MEMORY = 256
+SESSION_TTL_SECONDS = 24 * 60 * 60
+# Messages older than the prompt window are moved to the session database and
+# only read back when the full history is needed. Each session keeps at most
+# SESSION_MAX_MEMORY_BYTES of messages and transcript in memory, and the process at most
+# SESSION_GLOBAL_MAX_MEMORY_BYTES across sessions (least recently used go first).
+SESSION_LIVE_TOKEN_BUDGET = CONTEXT_TOKEN_BUDGET
+SESSION_LIVE_MAX_MESSAGES = CONTEXT_MAX_MESSAGES
+SESSION_MAX_MEMORY_BYTES = 1024 * 1024
+# Chat transcript entries kept in memory (and shown) per session; older ones
+# are spilled too and loaded by "Show Earlier Messages". They share the
+# session's byte ceiling with the messages.
+SESSION_LIVE_UI_ENTRIES = 100
+SESSION_GLOBAL_MAX_MEMORY_BYTES = 128 * 1024 * 1024
+# Rolling conversation summary, updated in the background after each turn.
+# Messages are folded in once they add up to SUMMARY_MIN_NEW_CHARS of text.
+SUMMARY_MIN_NEW_CHARS = 200
+SUMMARY_MAX_MESSAGE_CHARS = 1500
+SUMMARY_MAX_WORKERS = 2
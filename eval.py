@@ -1,14 +1,373 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+
+DEFAULT_SEARCH_RESULTS = [
+    {
+        "title": "Consumer Price Index Summary",
+        "body": "The Consumer Price Index for All Urban Consumers rose 0.2 percent on a seasonally adjusted basis.",
+        "href": "https://www.bls.gov/news.release/cpi.nr0.htm",
+    },
+    {
+        "title": "CPI Home",
+        "body": "The Consumer Price Index (CPI) is a measure of the average change over time in prices.",
+        "href": "https://www.bls.gov/cpi/",
+    },
+]
+DEFAULT_SANDBOX_OUTPUT = "Code output:\nExecuted (no output)"
+
+
 def smoke_cases():
     return [
         {
             "name": "basic_math",
             "query": "Compute 12 * (3 + 4)",
+            # Plain arithmetic is answered by the local fast lane, without tools.
+            "expects_tool": None,
+        },
+        {
+            "name": "nested_power",
+            "query": "((9^1000)^1000)^1000",
+            # Too large for the fast lane: it must give up at once and leave it to the graph.
             "expects_tool": "calculator",
+            "script": {
+                "agent": [
+                    {"tool_calls": [{"name": "calculator", "arguments": {"expression": "1000 ** 3 * log10(9)"}}]},
+                    {"content": "The result has about 954 million digits."},
+                ],
+            },
         },
         {
             "name": "recent_fact",
             "query": "Find the latest CPI release and summarize it",
             "expects_tool": "web_search",
+            "script": {
+                "planner": ["1. Use web_search to find the latest CPI release.\n2. Summarize it with sources."],
+                "agent": [
+                    {"tool_calls": [{"name": "web_search", "arguments": {"query": "latest CPI release"}}]},
+                    {"content": "CPI rose 0.2% in the latest release. Source: https://www.bls.gov/news.release/cpi.nr0.htm"},
+                ],
+                "critic": ["GOOD"],
+            },
         },
     ]
 
+
+def benchmark_cases():
+    return smoke_cases() + [
+        {
+            "name": "word_math",
+            "query": "Calculate the area of a circle with radius 3",
+            "expects_tool": "calculator",
+            "script": {
+                "planner": ["1. Use calculator to compute pi * 3^2."],
+                "agent": [
+                    {"tool_calls": [{"name": "calculator", "arguments": {"expression": "pi * 3 ** 2"}}]},
+                    {"content": "The area is about 28.27."},
+                ],
+            },
+        },
+        {
+            "name": "plot",
+            "query": "Plot y = x^2 for x from 0 to 10",
+            "expects_tool": "code_interpreter",
+            "script": {
+                "planner": ["1. Use code_interpreter to plot y = x^2 for x in [0, 10]."],
+                "agent": [
+                    {
+                        "tool_calls": [
+                            {
+                                "name": "code_interpreter",
+                                "arguments": {
+                                    "code": "import numpy as np\nimport matplotlib.pyplot as plt\n"
+                                    "x = np.linspace(0, 10, 50)\nplt.plot(x, x ** 2)"
+                                },
+                            }
+                        ]
+                    },
+                    {"content": "Plotted y = x^2 for x from 0 to 10."},
+                ],
+            },
+        },
+        {
+            "name": "critic_retry",
+            "query": "Explain what the CPI measures",
+            "expects_tool": None,
+            # The express graph skips the model critic on a first answer.
+            "graph": "full",
+            "script": {
+                "agent": [
+                    {"content": "It measures prices."},
+                    {"content": "The CPI measures the average change over time in prices paid by urban consumers for a basket of goods and services."},
+                ],
+                "critic": ["NEEDS IMPROVEMENT: the answer is too vague.", "GOOD"],
+            },
+        },
+        {
+            "name": "image_describe",
+            "query": "Describe this image",
+            "image": "generated:chart",
+            "expects_tool": None,
+            "script": {
+                "agent": [{"content": "A line chart rising steadily from left to right."}],
+            },
+        },
+    ]
+
+
+def load_corpus(path):
+    cases = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                cases.append(json.loads(line))
+    return cases
+
+
+def _percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    k = (len(ordered) - 1) * pct / 100.0
+    lower = int(k)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (k - lower)
+
+
+def _load_case_image(image_ref):
+    from PIL import Image, ImageDraw
+
+    if image_ref == "generated:chart":
+        image = Image.new("RGB", (800, 500), "white")
+        draw = ImageDraw.Draw(image)
+        draw.line([(50, 450), (250, 350), (450, 300), (650, 150), (750, 80)], fill="blue", width=4)
+        draw.line([(50, 450), (750, 450)], fill="black", width=2)
+        draw.line([(50, 450), (50, 50)], fill="black", width=2)
+        return image
+    return Image.open(image_ref)
+
+
+def _git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, timeout=10
+        ).stdout.strip()
+    except Exception:
+        return ""
+
+
+class _StubDDGS:
+    results = DEFAULT_SEARCH_RESULTS
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def text(self, query, max_results=3):
+        return list(self.results)[:max_results]
+
+
+def run_case(case, server):
+    import agent
+    import tools
+    from image_store import put_image
+    from prefetch import SpeculativePrefetcher
+    from prescreen import drain_decisions
+    from langchain_core.messages import HumanMessage
+
+    server.reset(case.get("script"))
+    _StubDDGS.results = case.get("search_results") or DEFAULT_SEARCH_RESULTS
+    sandbox_output = case.get("sandbox_output") or DEFAULT_SANDBOX_OUTPUT
+    tools.run_code_in_sandbox = lambda code, *args, **kwargs: (sandbox_output, None)
+
+    query = case["query"]
+    image_id = put_image(_load_case_image(case["image"])) if case.get("image") else ""
+    required_tools = tools.infer_required_tools(query)
+    inputs = {
+        "messages": [HumanMessage(content=query)],
+        "summary": "",
+        "image_data": image_id,
+        "plan": "",
+        "needs_retry": False,
+        "retry_count": 0,
+        "required_tools": required_tools,
+    }
+
+    node_latency = {}
+    node_calls = {}
+    error = None
+    # A case may pin the graph ("full" or "express"); otherwise the per-request selector picks.
+    graph = case.get("graph") or agent.select_graph(inputs)
+    drain_decisions()
+    started = time.perf_counter()
+    result = agent.fast_math_lane(inputs)
+    if result is not None:
+        graph = "fast_math"
+    else:
+        prefetcher = SpeculativePrefetcher()
+        prefetcher.start_for_query(query, required_tools)
+        last_step_at = started
+        try:
+            for mode, chunk in agent.GRAPHS[graph].stream(
+                inputs,
+                config=agent.build_run_config(prefetcher),
+                stream_mode=["updates", "values"],
+            ):
+                if mode == "values":
+                    result = chunk
+                    continue
+                now = time.perf_counter()
+                for node in chunk:
+                    node_latency[node] = node_latency.get(node, 0.0) + (now - last_step_at)
+                    node_calls[node] = node_calls.get(node, 0) + 1
+                last_step_at = now
+        except Exception as e:
+            error = str(e)
+        finally:
+            prefetcher.finish()
+    elapsed = time.perf_counter() - started
+
+    calls = server.calls_snapshot()
+    llm_calls_by_kind = {}
+    llm_calls_by_model = {}
+    for call in calls:
+        llm_calls_by_kind[call["kind"]] = llm_calls_by_kind.get(call["kind"], 0) + 1
+        llm_calls_by_model[call["model"]] = llm_calls_by_model.get(call["model"], 0) + 1
+    used_tools = agent.used_tools_from_messages(result["messages"]) if result else []
+    expected_tool = case.get("expects_tool")
+    return {
+        "name": case.get("name", query[:40]),
+        "ok": error is None and result is not None,
+        "error": error,
+        "graph": graph,
+        "latency_seconds": round(elapsed, 4),
+        "node_latency_seconds": {k: round(v, 4) for k, v in node_latency.items()},
+        "node_calls": node_calls,
+        "llm_calls": len(calls),
+        "llm_calls_by_kind": llm_calls_by_kind,
+        "llm_calls_by_model": llm_calls_by_model,
+        # Critic pre-screen decisions with their scores and, when escalated, the model's verdict.
+        "critic_prescreen": drain_decisions(),
+        "critic_retries": int((result or {}).get("retry_count", 0)),
+        "tokens_sent": sum(call["tokens_sent"] for call in calls),
+        "request_bytes": sum(call["request_bytes"] for call in calls),
+        "tools_used": used_tools,
+        "expected_tool_used": (expected_tool in used_tools) if expected_tool else not used_tools,
+    }
+
+
+def aggregate_results(case_results):
+    latencies = [r["latency_seconds"] for r in case_results]
+    node_totals = {}
+    for r in case_results:
+        for node, seconds in r["node_latency_seconds"].items():
+            node_totals.setdefault(node, []).append(seconds)
+    count = len(case_results)
+    return {
+        "cases": count,
+        "failures": sum(1 for r in case_results if not r["ok"]),
+        "latency_mean_seconds": round(statistics.mean(latencies), 4) if latencies else 0.0,
+        "latency_p50_seconds": round(_percentile(latencies, 50), 4),
+        "latency_p95_seconds": round(_percentile(latencies, 95), 4),
+        "latency_max_seconds": round(max(latencies), 4) if latencies else 0.0,
+        "node_latency_mean_seconds": {
+            node: round(statistics.mean(values), 4) for node, values in sorted(node_totals.items())
+        },
+        "llm_calls_total": sum(r["llm_calls"] for r in case_results),
+        "llm_calls_by_model": {
+            model: sum(r["llm_calls_by_model"].get(model, 0) for r in case_results)
+            for model in sorted({m for r in case_results for m in r["llm_calls_by_model"]})
+        },
+        "llm_calls_mean": round(sum(r["llm_calls"] for r in case_results) / count, 3) if count else 0.0,
+        "critic_retries_total": sum(r["critic_retries"] for r in case_results),
+        "critic_prescreen_decisions": {
+            decision: sum(1 for r in case_results for d in r["critic_prescreen"] if d["decision"] == decision)
+            for decision in ("accept", "reject", "escalate")
+        },
+        "tokens_sent_total": sum(r["tokens_sent"] for r in case_results),
+        "tokens_sent_mean": round(sum(r["tokens_sent"] for r in case_results) / count, 1) if count else 0.0,
+        "expected_tool_rate": round(sum(1 for r in case_results if r["expected_tool_used"]) / count, 3) if count else 0.0,
+    }
+
+
+def run_benchmark(cases, latency_scale=1.0, stream_chunk_seconds=None):
+    from mock_mistral import DEFAULT_LATENCY_SECONDS, DEFAULT_STREAM_CHUNK_SECONDS, MockMistralServer
+
+    server = MockMistralServer(
+        latency_seconds={k: v * latency_scale for k, v in DEFAULT_LATENCY_SECONDS.items()},
+        stream_chunk_seconds=DEFAULT_STREAM_CHUNK_SECONDS if stream_chunk_seconds is None else stream_chunk_seconds,
+    ).start()
+    # The Mistral client reads these at import time, so they must be set first.
+    os.environ["MISTRAL_SERVER_URL"] = server.url
+    os.environ.setdefault("MISTRAL_API_KEY", "benchmark")
+
+    import mistral_client
+    import tools
+    from cache import PersistentTTLCache
+
+    tools.DDGS = _StubDDGS
+    # Fresh, memory-only caches so runs don't depend on earlier ones.
+    tools.web_search_cache = PersistentTTLCache(
+        "web_search",
+        max_entries=tools.web_search_cache.max_entries,
+        ttl_seconds=tools.web_search_cache.ttl_seconds,
+        db_path=None,
+    )
+    mistral_client.llm_response_cache = PersistentTTLCache(
+        "llm_response",
+        max_entries=mistral_client.llm_response_cache.max_entries,
+        ttl_seconds=mistral_client.llm_response_cache.ttl_seconds,
+        db_path=None,
+    )
+
+    try:
+        case_results = [run_case(case, server) for case in cases]
+    finally:
+        server.stop()
+    return {
+        "commit": _git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "latency_scale": latency_scale,
+        "aggregate": aggregate_results(case_results),
+        "cases": case_results,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Offline agent benchmark against a local mock Mistral server.")
+    parser.add_argument("--corpus", help="JSONL file of cases (query, optional image, script, expects_tool).")
+    parser.add_argument("--output", default="bench_results.json", help="Where to write the JSON report.")
+    parser.add_argument("--latency-scale", type=float, default=1.0, help="Multiplier for mock model latency.")
+    parser.add_argument("--stream-chunk-seconds", type=float, default=None, help="Delay between streamed chunks.")
+    args = parser.parse_args(argv)
+
+    cases = load_corpus(args.corpus) if args.corpus else benchmark_cases()
+    report = run_benchmark(cases, latency_scale=args.latency_scale, stream_chunk_seconds=args.stream_chunk_seconds)
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+
+    for r in report["cases"]:
+        status = "ok" if r["ok"] else f"error: {r['error']}"
+        print(
+            f"{r['name']:<20} {r['graph']:<9} {r['latency_seconds']:>8.3f}s  llm_calls={r['llm_calls']:<3} "
+            f"retries={r['critic_retries']} tokens={r['tokens_sent']:<6} {status}"
+        )
+    agg = report["aggregate"]
+    print(
+        f"\n{agg['cases']} cases, p50={agg['latency_p50_seconds']}s p95={agg['latency_p95_seconds']}s, "
+        f"llm_calls={agg['llm_calls_total']}, tokens_sent={agg['tokens_sent_total']}, failures={agg['failures']}"
+    )
+    print(f"Report written to {args.output}")
+    return 0 if agg["failures"] == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
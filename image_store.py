@@ -0,0 +1,146 @@
+import base64
+import collections
+import hashlib
+import os
+import threading
+from io import BytesIO
+
+from PIL import Image
+
+from artifacts import sweep_directory, write_atomically
+from config import (
+    CACHE_DIR,
+    IMAGE_DISK_MAX_BYTES,
+    IMAGE_DISK_TTL_SECONDS,
+    IMAGE_JPEG_QUALITY,
+    IMAGE_MAX_SIDE,
+    IMAGE_STORE_MAX_BYTES,
+)
+
+
+IMAGE_DIR = os.path.join(CACHE_DIR, "images")
+IMAGE_ID_PREFIX = "img_"
+_FORMATS = {"png": "image/png", "jpg": "image/jpeg"}
+IMAGE_SWEEP_EVERY = 100
+# Charts and screenshots: this many colors cover at least this share of the pixels.
+DOMINANT_COLORS = 32
+DOMINANT_COLOR_SHARE = 0.8
+
+_lock = threading.Lock()
+_data_urls = collections.OrderedDict()
+_data_url_bytes = 0
+_puts = 0
+
+
+def _image_id(image):
+    digest = hashlib.sha256()
+    digest.update(f"{image.mode}:{image.size}".encode("utf-8"))
+    digest.update(image.tobytes())
+    return IMAGE_ID_PREFIX + digest.hexdigest()[:32]
+
+
+def _has_alpha(image):
+    return image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info)
+
+
+def _choose_extension(image):
+    # Charts, screenshots and diagrams are mostly a few flat colors (anti-aliasing
+    # adds hundreds more, but on few pixels) and compress losslessly; photos,
+    # whose pixels spread over many colors, go to JPEG.
+    if _has_alpha(image):
+        return "png"
+    rgb = image.convert("RGB")
+    colors = rgb.getcolors(maxcolors=rgb.width * rgb.height)
+    dominant = sum(count for count, _ in sorted(colors, reverse=True)[:DOMINANT_COLORS])
+    return "png" if dominant >= DOMINANT_COLOR_SHARE * rgb.width * rgb.height else "jpg"
+
+
+def _encode(image):
+    prepared = image.copy()
+    prepared.thumbnail((IMAGE_MAX_SIDE, IMAGE_MAX_SIDE), Image.LANCZOS)
+    extension = _choose_extension(prepared)
+    buffered = BytesIO()
+    if extension == "png":
+        if prepared.mode not in ("RGB", "RGBA", "L", "LA", "P"):
+            prepared = prepared.convert("RGBA" if _has_alpha(prepared) else "RGB")
+        prepared.save(buffered, format="PNG", optimize=True)
+    else:
+        prepared.convert("RGB").save(buffered, format="JPEG", quality=IMAGE_JPEG_QUALITY, optimize=True)
+    return extension, buffered.getvalue()
+
+
+def _path_for(image_id, extension):
+    return os.path.join(IMAGE_DIR, f"{image_id}.{extension}")
+
+
+def _remember(image_id, data_url):
+    global _data_url_bytes
+    with _lock:
+        if image_id in _data_urls:
+            _data_urls.move_to_end(image_id)
+            return
+        _data_urls[image_id] = data_url
+        _data_url_bytes += len(data_url)
+        while _data_url_bytes > IMAGE_STORE_MAX_BYTES and len(_data_urls) > 1:
+            _, evicted = _data_urls.popitem(last=False)
+            _data_url_bytes -= len(evicted)
+
+
+def _touch(image_id):
+    # Returns True if the image is on disk, refreshing its mtime for the sweep.
+    for ext in _FORMATS:
+        try:
+            os.utime(_path_for(image_id, ext))
+            return True
+        except OSError:
+            continue
+    return False
+
+
+def _write(path, payload):
+    global _puts
+
+    def write(tmp):
+        with open(tmp, "wb") as f:
+            f.write(payload)
+
+    write_atomically(path, write)
+    with _lock:
+        _puts += 1
+        sweep = _puts % IMAGE_SWEEP_EVERY == 0
+    if sweep:
+        sweep_directory(IMAGE_DIR, IMAGE_DISK_TTL_SECONDS, IMAGE_DISK_MAX_BYTES)
+
+
+def put_image(image):
+    # Raises OSError when the image cannot be written.
+    image_id = _image_id(image)
+    if _touch(image_id):
+        return image_id
+
+    extension, payload = _encode(image)
+    _write(_path_for(image_id, extension), payload)
+    _remember(image_id, f"data:{_FORMATS[extension]};base64,{base64.b64encode(payload).decode('utf-8')}")
+    return image_id
+
+
+def image_data_url(image_ref):
+    if not image_ref:
+        return None
+    if not image_ref.startswith(IMAGE_ID_PREFIX):
+        # Raw base64 JPEG from sessions created before the image store existed.
+        return f"data:image/jpeg;base64,{image_ref}"
+
+    with _lock:
+        data_url = _data_urls.get(image_ref)
+        if data_url is not None:
+            _data_urls.move_to_end(image_ref)
+            return data_url
+    for extension, mime in _FORMATS.items():
+        path = _path_for(image_ref, extension)
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                data_url = f"data:{mime};base64,{base64.b64encode(f.read()).decode('utf-8')}"
+            _remember(image_ref, data_url)
+            return data_url
+    return None
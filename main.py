@@ -1,7 +1,5 @@
 import base64
-import logging
-import math
-import re
+import time
 import warnings
 from io import BytesIO
 
@@ -9,9 +7,17 @@ import gradio as gr
 from PIL import Image
 from langchain_core.messages import HumanMessage, ToolMessage
 
-from agent import app
+from agent import GRAPHS, build_run_config, fast_math_lane, final_reply_from_messages, select_graph
+from artifacts import ARTIFACT_DIR, artifact_path
+from config import TRACE_METRICS_PORT
+from image_store import put_image
+from prefetch import SpeculativePrefetcher
+from sandbox import reset_session_kernel
+from session_store import session_store
+from summarizer import schedule_summary
 from tools import infer_required_tools
-from utils import encode_image, normalize_reply_content
+from tracing import start_metrics_server
+from utils import clean_final_reply
 
 
 warnings.filterwarnings(
@@ -29,8 +35,108 @@ warnings.filterwarnings(
     message=".*FigureCanvasAgg is non-interactive, and thus cannot be shown.*",
     category=UserWarning,
 )
-logging.getLogger("primp").setLevel(logging.ERROR)
-logging.getLogger("ddgs").setLevel(logging.ERROR)
+
+STREAM_YIELD_INTERVAL_SECONDS = 0.05
+
+
+def stream_agent_run(graph, inputs, base_ui_history, run_config):
+    # Relays plan, tool progress and answer deltas to the UI while the graph runs;
+    # returns the final graph state.
+    result = None
+    plan = ""
+    live_reply = ""
+    reset_live_reply = False
+    dirty = False
+    last_yield_at = 0.0
+
+    for mode, chunk in graph.stream(
+        inputs,
+        config=run_config,
+        stream_mode=["values", "custom"],
+    ):
+        force = False
+        if mode == "values":
+            result = chunk
+            if chunk.get("plan") and chunk["plan"] != plan:
+                plan = chunk["plan"]
+                dirty = True
+            force = True
+        else:
+            event = chunk.get("event")
+            if event == "agent_start":
+                reset_live_reply = True
+                continue
+            if event == "delta":
+                live_reply = chunk.get("text", "") if reset_live_reply else live_reply + chunk.get("text", "")
+                reset_live_reply = False
+            elif event == "tools_start":
+                live_reply = f"_Running {', '.join(chunk.get('names') or ['tools'])}..._"
+                reset_live_reply = True
+                force = True
+            dirty = True
+
+        now = time.monotonic()
+        if not dirty or (not force and now - last_yield_at < STREAM_YIELD_INTERVAL_SECONDS):
+            continue
+        dirty = False
+        last_yield_at = now
+        live_text = clean_final_reply(live_reply)
+        live_ui_history = base_ui_history + ([{"role": "assistant", "content": live_text}] if live_text else [])
+        yield "", gr.update(), live_ui_history, plan, gr.update(), gr.update(), gr.update()
+    if result is None:
+        raise RuntimeError("agent produced no result")
+    return result
+
+
+def _artifact_paths(msg_obj, images):
+    # Figures (images=True) or full tool outputs kept when the prompt copy was compacted.
+    refs = msg_obj.additional_kwargs.get("artifacts") or []
+    paths = [artifact_path(ref) for ref in refs if str(ref.get("mime", "")).startswith("image/") == images]
+    return [path for path in paths if path]
+
+
+def _message_figures(msg_obj):
+    figures = _artifact_paths(msg_obj, images=True)
+    plot_b64 = msg_obj.additional_kwargs.get("plot_base64")  # sessions saved before the artifact store
+    if plot_b64:
+        try:
+            with BytesIO(base64.b64decode(plot_b64)) as bio:
+                figures.append(Image.open(bio).copy())
+        except Exception:
+            pass
+    return figures
+
+
+def latest_figures(messages, turn_start):
+    # All figures produced during this turn; otherwise keep showing the most recent ones.
+    figures = [
+        figure
+        for msg_obj in messages[turn_start:]
+        if isinstance(msg_obj, ToolMessage)
+        for figure in _message_figures(msg_obj)
+    ]
+    if figures:
+        return figures
+    for msg_obj in reversed(messages[:turn_start]):
+        if isinstance(msg_obj, ToolMessage):
+            figures = _message_figures(msg_obj)
+            if figures:
+                return figures
+    return []
+
+
+def turn_output_files(messages, turn_start):
+    return [
+        path
+        for msg_obj in messages[turn_start:]
+        if isinstance(msg_obj, ToolMessage)
+        for path in _artifact_paths(msg_obj, images=False)
+    ]
+
+
+def _unspilled(ui_history, current, loaded):
+    # Drops transcript entries spilled to disk since the turn loaded the session.
+    return ui_history[max(current["ui_spilled_count"] - loaded["ui_spilled_count"], 0):]
 
 
 with gr.Blocks(title="Pixtral Multimodal Agent") as demo:
@@ -42,23 +148,46 @@ with gr.Blocks(title="Pixtral Multimodal Agent") as demo:
         with gr.Column(scale=1):
             plan_display = gr.Textbox(label="Current Agent Plan", interactive=False, lines=10)
             summary_display = gr.Textbox(label="Conversation Summary", interactive=False, lines=5)
-            plot_display = gr.Image(label="Generated Plot", type="pil")
+            plot_display = gr.Gallery(label="Generated Plots", columns=2, height="auto")
+            output_files = gr.File(label="Full Tool Output", file_count="multiple", interactive=False)
 
     msg = gr.Textbox(placeholder="Ask about the image (e.g., 'What trends do you see here?')", label="Your question")
     img_input = gr.Image(type="pil", label="Upload Image (JPEG/PNG)")
-    clear = gr.Button("Clear Conversation")
+    with gr.Row():
+        show_earlier = gr.Button("Show Earlier Messages")
+        clear = gr.Button("Clear Conversation")
 
-    api_state = gr.State([])
-    chat_state = gr.State([])
-    summary_state = gr.State("")
-    image_state = gr.State("")
+    # Only the session ID lives in the browser; history stays in the session store.
+    session_state = gr.State(None)
 
-    def respond(message, image, api_history, ui_history, running_summary, stored_image):
-        current_image = encode_image(image) if image is not None else (stored_image or "")
+    def respond(message, image, session_id):
+        session_id = session_id or session_store.new_session_id()
+        session = session_store.load(session_id)
+        running_summary = session["summary"]
+        base_ui_history = session["ui_history"] + [{"role": "user", "content": message or ""}]
+
+        def failure(error, image_ref):
+            error_reply = f"Temporary failure: {error}"
+            new_ui_history = base_ui_history + [{"role": "assistant", "content": error_reply}]
+            session_store.update(
+                session_id,
+                lambda current: {
+                    "ui_history": _unspilled(new_ui_history, current, session),
+                    "image_data": image_ref,
+                },
+            )
+            return "", session_id, new_ui_history, "", [], None, running_summary
+
+        try:
+            current_image = put_image(image) if image is not None else session["image_data"]
+        except OSError as e:
+            # The upload could not be stored; keep the session's previous image.
+            yield failure(e, session["image_data"])
+            return
         original_required_tools = infer_required_tools(message or "")
         inputs = {
-            "messages": (api_history or []) + [HumanMessage(content=message or "")],
-            "summary": running_summary or "",
+            "messages": session["messages"] + [HumanMessage(content=message or "")],
+            "summary": running_summary,
             "image_data": current_image,
             "plan": "",
             "needs_retry": False,
@@ -66,96 +195,76 @@ with gr.Blocks(title="Pixtral Multimodal Agent") as demo:
             "required_tools": original_required_tools,
         }
 
-        try:
-            result = app.invoke(inputs, config={"recursion_limit": 80})
-        except Exception as e:
-            error_reply = f"Temporary failure: {e}"
-            new_ui_history = (ui_history or []) + [
-                {"role": "user", "content": message or ""},
-                {"role": "assistant", "content": error_reply},
-            ]
-            yield "", api_history or [], new_ui_history, new_ui_history, running_summary or "", "", None, running_summary or "", current_image
-            return
+        result = fast_math_lane(inputs)
+        if result is None:
+            # Start likely tool work (e.g. web_search on the raw query) while the planner runs.
+            prefetcher = SpeculativePrefetcher()
+            prefetcher.start_for_query(message or "", original_required_tools)
+            try:
+                result = yield from stream_agent_run(
+                    GRAPHS[select_graph(inputs)], inputs, base_ui_history, build_run_config(prefetcher, session_id)
+                )
+            except Exception as e:
+                yield failure(e, current_image)
+                return
+            finally:
+                prefetcher.finish()
 
-        final_reply = normalize_reply_content(result["messages"][-1].content)
-
-        final_reply = re.sub(r"\n?\[Critique:.*?\)]", "", final_reply, flags=re.DOTALL)
-        final_reply = re.sub(r"\n?Stopped after retry limit.*", "", final_reply, flags=re.DOTALL)
-        final_reply = re.sub(r'\[\{\"name\".*?\}\]', "", final_reply, flags=re.DOTALL)
-        final_reply = re.sub(r'\[?\{\"name\": \"code_interpreter\".*', "", final_reply, flags=re.DOTALL)
-        final_reply = re.sub(r"^\s*\*{0,2}revised answer:?\*{0,2}\s*", "", final_reply, flags=re.IGNORECASE)
-        final_reply = re.sub(r"!\[[^\]]*\]\(attachment:[^)]+\)", "", final_reply, flags=re.IGNORECASE)
-        final_reply = re.sub(r"\n{3,}", "\n\n", final_reply).strip()
         new_api_history = result["messages"]
-        if not final_reply.strip():
-            for msg_obj in reversed(new_api_history):
-                if isinstance(msg_obj, ToolMessage):
-                    tool_text = normalize_reply_content(msg_obj.content).strip()
-                    if tool_text:
-                        final_reply = tool_text
-                        break
-        if not final_reply.strip():
-            final_reply = "I couldn't generate a final response, but I can retry if you send the same request again."
-        new_summary = result.get("summary", running_summary or "")
-        base_ui_history = (ui_history or []) + [{"role": "user", "content": message or ""}]
-
-        plot_image = None
-        for msg_obj in reversed(new_api_history):
-            if isinstance(msg_obj, ToolMessage):
-                plot_b64 = msg_obj.additional_kwargs.get("plot_base64")
-                if plot_b64:
-                    try:
-                        img_data = base64.b64decode(plot_b64)
-                        with BytesIO(img_data) as bio:
-                            plot_image = Image.open(bio).copy()
-                        break
-                    except Exception:
-                        pass
-
-        tokens = re.split(r"(\s+)", final_reply)
-        chunk_count = min(80, max(1, len(tokens)))
-        step = max(1, math.ceil(len(tokens) / chunk_count))
-
-        for i in range(step, len(tokens) + step, step):
-            current_reply = "".join(tokens[:i]).strip()
-            streaming_ui_history = base_ui_history + [{"role": "assistant", "content": current_reply}]
-            yield (
-                "",
-                new_api_history,
-                streaming_ui_history,
-                streaming_ui_history,
-                new_summary,
-                result.get("plan", ""),
-                None,
-                new_summary,
-                current_image,
-            )
+        final_reply = final_reply_from_messages(new_api_history)
+
+        figures = latest_figures(new_api_history, len(session["messages"]))
 
         final_ui_history = base_ui_history + [{"role": "assistant", "content": final_reply}]
+        # The summary belongs to the background summarizer; only the turn's fields are written here.
+        # Messages spilled to disk since the turn started are not written back to memory.
+        saved = session_store.update(
+            session_id,
+            lambda current: {
+                "messages": list(new_api_history)[max(current["spilled_count"] - session["spilled_count"], 0):],
+                "ui_history": _unspilled(final_ui_history, current, session),
+                "image_data": current_image,
+            },
+        )
+        schedule_summary(session_id)
         yield (
             "",
-            new_api_history,
+            session_id,
             final_ui_history,
-            final_ui_history,
-            new_summary,
             result.get("plan", ""),
-            plot_image,
-            new_summary,
-            current_image,
+            figures,
+            turn_output_files(new_api_history, len(session["messages"])) or None,
+            saved["summary"],
         )
 
+    def show_earlier_messages(session_id):
+        # Older transcript entries are only read back from disk when asked for.
+        return session_store.load_transcript(session_id) if session_id else []
+
+    def clear_conversation(session_id):
+        if session_id:
+            session_store.clear(session_id)
+            reset_session_kernel(session_id)
+        return "", None, [], "", [], None, ""
+
     msg.submit(
         respond,
-        inputs=[msg, img_input, api_state, chat_state, summary_state, image_state],
-        outputs=[msg, api_state, chat_state, chatbot, summary_state, plan_display, plot_display, summary_display, image_state],
+        inputs=[msg, img_input, session_state],
+        outputs=[msg, session_state, chatbot, plan_display, plot_display, output_files, summary_display],
     )
 
+    show_earlier.click(show_earlier_messages, [session_state], [chatbot])
+
     clear.click(
-        lambda: ("", [], [], [], "", "", None, "", ""),
-        None,
-        [msg, api_state, chat_state, chatbot, summary_state, plan_display, plot_display, summary_display, image_state],
+        clear_conversation,
+        [session_state],
+        [msg, session_state, chatbot, plan_display, plot_display, output_files, summary_display],
     )
 
 
+if TRACE_METRICS_PORT:
+    start_metrics_server(TRACE_METRICS_PORT)
+
+
 if __name__ == "__main__":
-    demo.launch(share=False)
+    demo.launch(share=False, allowed_paths=[ARTIFACT_DIR])
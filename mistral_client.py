@@ -1,81 +1,479 @@
+import asyncio
+import collections
+import hashlib
+import json
+import random
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
 import httpx
 from mistralai import Mistral
+from mistralai.models import ChatCompletionResponse
+
+from cache import PersistentTTLCache
+from config import (
+    CONTEXT_IMAGE_TOKEN_ESTIMATE,
+    LLM_CACHE_MAX_ENTRIES,
+    LLM_CACHE_TTL_SECONDS,
+    MISTRAL_BACKOFF_BASE_SECONDS,
+    MISTRAL_BACKOFF_MAX_SECONDS,
+    MISTRAL_HEDGE_AFTER_SECONDS,
+    MISTRAL_HTTP_KEEPALIVE_EXPIRY_SECONDS,
+    MISTRAL_HTTP_MAX_CONNECTIONS,
+    MISTRAL_HTTP_MAX_KEEPALIVE_CONNECTIONS,
+    MISTRAL_MAX_RETRIES,
+    MISTRAL_SERVER_URL,
+    MISTRAL_TIMEOUT_SECONDS,
+    api_key,
+)
+from scheduler import PRIORITY_INTERACTIVE, request_scheduler
+from tracing import record_span
+from utils import estimate_tokens, normalize_reply_content
+
+
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+_http_limits = httpx.Limits(
+    max_connections=MISTRAL_HTTP_MAX_CONNECTIONS,
+    max_keepalive_connections=MISTRAL_HTTP_MAX_KEEPALIVE_CONNECTIONS,
+    keepalive_expiry=MISTRAL_HTTP_KEEPALIVE_EXPIRY_SECONDS,
+)
+_http_timeout = httpx.Timeout(MISTRAL_TIMEOUT_SECONDS, connect=10.0)
+
+client = Mistral(
+    api_key=api_key,
+    server_url=MISTRAL_SERVER_URL,
+    client=httpx.Client(limits=_http_limits, timeout=_http_timeout),
+    async_client=httpx.AsyncClient(limits=_http_limits, timeout=_http_timeout),
+)
+
+_hedge_executor = ThreadPoolExecutor(max_workers=MISTRAL_HTTP_MAX_CONNECTIONS, thread_name_prefix="mistral-hedge")
+
+_metrics_lock = threading.Lock()
+_metrics = {
+    "calls": 0,
+    "failures": 0,
+    "retries": 0,
+    "hedged_calls": 0,
+    "hedge_wins": 0,
+    "cache_hits": 0,
+    "cache_misses": 0,
+    "latency_seconds_total": 0.0,
+}
+_recent_calls = collections.deque(maxlen=200)
+
+llm_response_cache = PersistentTTLCache(
+    "llm_response",
+    max_entries=LLM_CACHE_MAX_ENTRIES,
+    ttl_seconds=LLM_CACHE_TTL_SECONDS,
+)
+
+
+def get_client_metrics():
+    with _metrics_lock:
+        snapshot = dict(_metrics)
+        snapshot["recent_calls"] = list(_recent_calls)
+    return snapshot
+
+
+def _estimate_request_tokens(kwargs):
+    # Rough prompt + completion size for rate limiting; images count as a flat
+    # estimate instead of the length of their data URL.
+    total = int(kwargs.get("max_tokens") or 0)
+    for message in kwargs.get("messages") or []:
+        content = message.get("content") if isinstance(message, dict) else getattr(message, "content", "")
+        if isinstance(content, list):
+            for part in content:
+                if isinstance(part, dict) and part.get("type") == "image_url":
+                    total += CONTEXT_IMAGE_TOKEN_ESTIMATE
+                else:
+                    total += estimate_tokens(json.dumps(part, default=str))
+        else:
+            total += estimate_tokens(content or "")
+    if kwargs.get("tools"):
+        total += estimate_tokens(json.dumps(kwargs["tools"], default=str))
+    return total
+
+
+def _new_call_stats(kind, kwargs, priority=PRIORITY_INTERACTIVE, session_id=None):
+    return {
+        "kind": kind,
+        "model": kwargs.get("model", ""),
+        "started": time.monotonic(),
+        "retries": 0,
+        "hedged": False,
+        "hedge_won": False,
+        "priority": priority,
+        "session_id": session_id,
+        "reserved_tokens": _estimate_request_tokens(kwargs),
+        "queue_wait_seconds": 0.0,
+    }
+
+
+def _usage_attributes(usage):
+    if usage is None:
+        return {}
+    return {
+        "prompt_tokens": getattr(usage, "prompt_tokens", None) or 0,
+        "completion_tokens": getattr(usage, "completion_tokens", None) or 0,
+    }
+
+
+def _trace_call(stats, ok, usage=None):
+    record_span(
+        "llm",
+        f"chat.{stats['kind']}",
+        time.monotonic() - stats["started"],
+        status="ok" if ok else "error",
+        model=stats["model"],
+        retries=stats["retries"],
+        hedged=stats["hedged"],
+        queue_wait_seconds=round(stats["queue_wait_seconds"], 4),
+        **_usage_attributes(usage),
+    )
 
-from config import api_key
-from utils import normalize_reply_content
 
+def _settle_tokens(stats, usage):
+    if usage is None:
+        return
+    actual = (getattr(usage, "prompt_tokens", None) or 0) + (getattr(usage, "completion_tokens", None) or 0)
+    if actual:
+        request_scheduler.settle(stats["model"], stats["reserved_tokens"], actual)
 
-client = Mistral(api_key=api_key)
 
+def _record_call(stats, ok):
+    record = {
+        "kind": stats["kind"],
+        "model": stats["model"],
+        "latency_seconds": time.monotonic() - stats["started"],
+        "retries": stats["retries"],
+        "hedged": stats["hedged"],
+        "hedge_won": stats["hedge_won"],
+        "ok": ok,
+    }
+    with _metrics_lock:
+        _metrics["calls"] += 1
+        _metrics["failures"] += 0 if ok else 1
+        _metrics["retries"] += record["retries"]
+        _metrics["hedged_calls"] += 1 if record["hedged"] else 0
+        _metrics["hedge_wins"] += 1 if record["hedge_won"] else 0
+        _metrics["latency_seconds_total"] += record["latency_seconds"]
+        _recent_calls.append(record)
+    return record
 
-def safe_chat_complete(**kwargs):
+
+def response_cache_key(kwargs):
+    # Stable hash of everything that determines the completion: model, messages
+    # and sampling/tool parameters.
+    payload = json.dumps(kwargs, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def _cached_response(cache_key, kwargs):
+    if cache_key is None:
+        return None
+    cached = llm_response_cache.get(cache_key)
+    with _metrics_lock:
+        _metrics["cache_misses" if cached is None else "cache_hits"] += 1
+    if cached is None:
+        return None
     try:
-        return client.chat.complete(**kwargs)
-    except (httpx.ConnectTimeout, httpx.ReadTimeout, TimeoutError):
-        raise RuntimeError("Network timeout while contacting Mistral API. Please retry in a few seconds.")
-    except Exception as e:
-        raise RuntimeError(f"Mistral API request failed: {e}")
+        response = ChatCompletionResponse.model_validate(cached[0])
+    except Exception:
+        return None
+    record_span("llm", "chat.cache", 0.0, model=kwargs.get("model", ""), cached=True)
+    return response
+
+
+def _store_response(cache_key, response):
+    if cache_key is None:
+        return
+    choices = getattr(response, "choices", None) or []
+    # Only cache usable answers; empty or tool-call-only replies are retried next time.
+    if choices and normalize_reply_content(getattr(choices[0].message, "content", None)).strip():
+        llm_response_cache.set(cache_key, response.model_dump(mode="json"))
 
 
-def safe_chat_stream(**kwargs):
+def _is_retryable(exc):
+    if isinstance(exc, (httpx.TransportError, TimeoutError)):
+        return True
+    return getattr(exc, "status_code", None) in RETRYABLE_STATUS_CODES
+
+
+def _backoff_delay(attempt, exc):
+    delay = random.uniform(0, min(MISTRAL_BACKOFF_MAX_SECONDS, MISTRAL_BACKOFF_BASE_SECONDS * (2 ** attempt)))
+    raw_response = getattr(exc, "raw_response", None)
+    retry_after = getattr(raw_response, "headers", {}).get("retry-after") if raw_response is not None else None
     try:
-        return client.chat.stream(**kwargs)
-    except (httpx.ConnectTimeout, httpx.ReadTimeout, TimeoutError):
-        raise RuntimeError("Network timeout while contacting Mistral API. Please retry in a few seconds.")
-    except Exception as e:
-        raise RuntimeError(f"Mistral API request failed: {e}")
+        delay = max(delay, float(retry_after))
+    except (TypeError, ValueError):
+        pass
+    return min(delay, MISTRAL_BACKOFF_MAX_SECONDS)
 
 
-def collect_streamed_response(stream):
-    content_parts = []
-    tool_calls_by_index = {}
+def _as_runtime_error(exc):
+    if isinstance(exc, (httpx.ConnectTimeout, httpx.ReadTimeout, TimeoutError)):
+        return RuntimeError("Network timeout while contacting Mistral API. Please retry in a few seconds.")
+    return RuntimeError(f"Mistral API request failed: {exc}")
+
+
+def _hedged_complete(stats, kwargs):
+    # Fire a duplicate request if the first one is still pending after the hedge
+    # delay and keep whichever answers first.
+    first = _hedge_executor.submit(client.chat.complete, **kwargs)
+    done, _ = wait([first], timeout=MISTRAL_HEDGE_AFTER_SECONDS)
+    if done:
+        return first.result()
+    # Hedges are extra load: only send one if the rate limit has room right now.
+    if not request_scheduler.try_acquire(stats["model"], stats["reserved_tokens"]):
+        return first.result()
+    stats["hedged"] = True
+    second = _hedge_executor.submit(client.chat.complete, **kwargs)
+    done, pending = wait([first, second], return_when=FIRST_COMPLETED)
+    winner = next(iter(done))
+    if winner.exception() is not None and pending:
+        winner = pending.pop()
+    for future in pending:
+        future.cancel()
+    stats["hedge_won"] = winner is second
+    return winner.result()
+
+
+async def _hedged_complete_async(stats, kwargs):
+    first = asyncio.ensure_future(client.chat.complete_async(**kwargs))
+    done, _ = await asyncio.wait([first], timeout=MISTRAL_HEDGE_AFTER_SECONDS)
+    if done:
+        return first.result()
+    if not request_scheduler.try_acquire(stats["model"], stats["reserved_tokens"]):
+        return await first
+    stats["hedged"] = True
+    second = asyncio.ensure_future(client.chat.complete_async(**kwargs))
+    done, pending = await asyncio.wait([first, second], return_when=asyncio.FIRST_COMPLETED)
+    winner = next(iter(done))
+    if winner.exception() is not None and pending:
+        winner = pending.pop()
+        await asyncio.wait([winner])
+    for task in pending:
+        task.cancel()
+    stats["hedge_won"] = winner is second
+    return winner.result()
+
+
+def _admit(stats):
+    stats["queue_wait_seconds"] += request_scheduler.acquire(
+        stats["model"], stats["reserved_tokens"], stats["priority"], stats["session_id"]
+    )
+
+
+async def _admit_async(stats):
+    stats["queue_wait_seconds"] += await request_scheduler.acquire_async(
+        stats["model"], stats["reserved_tokens"], stats["priority"], stats["session_id"]
+    )
 
-    for chunk in stream:
-        data = getattr(chunk, "data", chunk)
-        choices = getattr(data, "choices", None) or []
-        if not choices:
-            continue
-        delta = getattr(choices[0], "delta", None)
-        if not delta:
-            continue
-
-        delta_content = getattr(delta, "content", None)
-        if delta_content:
-            content_parts.append(normalize_reply_content(delta_content))
-
-        delta_tool_calls = getattr(delta, "tool_calls", None) or []
-        for tc in delta_tool_calls:
-            idx = getattr(tc, "index", None)
-            if idx is None:
-                idx = len(tool_calls_by_index)
-            entry = tool_calls_by_index.setdefault(
-                idx, {"id": "", "name": "", "arguments": ""}
-            )
-            tc_id = getattr(tc, "id", None)
-            if tc_id:
-                entry["id"] = tc_id
-            fn = getattr(tc, "function", None)
-            if fn:
-                fn_name = getattr(fn, "name", None)
-                if fn_name:
-                    entry["name"] = fn_name
-                fn_args = getattr(fn, "arguments", None)
-                if fn_args:
-                    entry["arguments"] += fn_args
 
+def _call_with_retries(stats, send):
+    # Every attempt, including retries, waits for a scheduler slot first.
+    while True:
+        _admit(stats)
+        try:
+            response = send()
+            _record_call(stats, ok=True)
+            if stats["kind"] != "stream":
+                _settle_tokens(stats, getattr(response, "usage", None))
+                _trace_call(stats, ok=True, usage=getattr(response, "usage", None))
+            return response
+        except Exception as e:
+            if stats["retries"] >= MISTRAL_MAX_RETRIES or not _is_retryable(e):
+                _record_call(stats, ok=False)
+                _trace_call(stats, ok=False)
+                raise _as_runtime_error(e)
+            time.sleep(_backoff_delay(stats["retries"], e))
+            stats["retries"] += 1
+
+
+async def _call_with_retries_async(stats, send):
+    while True:
+        await _admit_async(stats)
+        try:
+            response = await send()
+            _record_call(stats, ok=True)
+            if stats["kind"] != "stream":
+                _settle_tokens(stats, getattr(response, "usage", None))
+                _trace_call(stats, ok=True, usage=getattr(response, "usage", None))
+            return response
+        except Exception as e:
+            if stats["retries"] >= MISTRAL_MAX_RETRIES or not _is_retryable(e):
+                _record_call(stats, ok=False)
+                _trace_call(stats, ok=False)
+                raise _as_runtime_error(e)
+            await asyncio.sleep(_backoff_delay(stats["retries"], e))
+            stats["retries"] += 1
+
+
+def safe_chat_complete(hedge=False, cache=False, priority=PRIORITY_INTERACTIVE, session_id=None, **kwargs):
+    # cache=True serves identical requests from llm_response_cache; only opt in
+    # where the prompt fully determines an acceptable answer.
+    cache_key = response_cache_key(kwargs) if cache else None
+    cached = _cached_response(cache_key, kwargs)
+    if cached is not None:
+        return cached
+    stats = _new_call_stats("complete", kwargs, priority, session_id)
+    if hedge:
+        response = _call_with_retries(stats, lambda: _hedged_complete(stats, kwargs))
+    else:
+        response = _call_with_retries(stats, lambda: client.chat.complete(**kwargs))
+    _store_response(cache_key, response)
+    return response
+
+
+def _traced_stream(stream, stats):
+    # Streams are traced when fully consumed, so the span covers generation time
+    # and picks up the usage block sent with the final chunk.
+    usage = None
+    ok = False
+    try:
+        for chunk in stream:
+            usage = getattr(getattr(chunk, "data", chunk), "usage", None) or usage
+            yield chunk
+        ok = True
+    finally:
+        _settle_tokens(stats, usage)
+        _trace_call(stats, ok=ok, usage=usage)
+
+
+async def _traced_stream_async(stream, stats):
+    usage = None
+    ok = False
+    try:
+        async for chunk in stream:
+            usage = getattr(getattr(chunk, "data", chunk), "usage", None) or usage
+            yield chunk
+        ok = True
+    finally:
+        _settle_tokens(stats, usage)
+        _trace_call(stats, ok=ok, usage=usage)
+
+
+def safe_chat_stream(priority=PRIORITY_INTERACTIVE, session_id=None, **kwargs):
+    # Retries cover opening the stream; a stream that fails midway is not replayed.
+    stats = _new_call_stats("stream", kwargs, priority, session_id)
+    return _traced_stream(_call_with_retries(stats, lambda: client.chat.stream(**kwargs)), stats)
+
+
+async def safe_chat_complete_async(hedge=False, cache=False, priority=PRIORITY_INTERACTIVE, session_id=None, **kwargs):
+    cache_key = response_cache_key(kwargs) if cache else None
+    cached = _cached_response(cache_key, kwargs)
+    if cached is not None:
+        return cached
+    stats = _new_call_stats("complete", kwargs, priority, session_id)
+    if hedge:
+        response = await _call_with_retries_async(stats, lambda: _hedged_complete_async(stats, kwargs))
+    else:
+        response = await _call_with_retries_async(stats, lambda: client.chat.complete_async(**kwargs))
+    _store_response(cache_key, response)
+    return response
+
+
+async def safe_chat_stream_async(priority=PRIORITY_INTERACTIVE, session_id=None, **kwargs):
+    stats = _new_call_stats("stream", kwargs, priority, session_id)
+    return _traced_stream_async(
+        await _call_with_retries_async(stats, lambda: client.chat.stream_async(**kwargs)), stats
+    )
+
+
+def _normalized_tool_call(idx, call):
+    return {
+        "id": call["id"] or f"tool_call_{idx}",
+        "name": call["name"],
+        "arguments": call["arguments"] or "{}",
+    }
+
+
+def _tool_call_ready(call):
+    # A call is complete once its arguments parse as a JSON object: any further
+    # fragment would make the accumulated text invalid. It also needs its real
+    # id, which the early handle is keyed by; a call whose id never arrives is
+    # handed over by _finalize_stream under the same fallback id as the result.
+    arguments = call["arguments"].rstrip()
+    if not call["id"] or not call["name"] or not arguments.endswith("}"):
+        return False
+    try:
+        return isinstance(json.loads(arguments), dict)
+    except ValueError:
+        return False
+
+
+def _accumulate_chunk(chunk, content_parts, tool_calls_by_index, on_delta, on_tool_call=None):
+    data = getattr(chunk, "data", chunk)
+    choices = getattr(data, "choices", None) or []
+    if not choices:
+        return
+    delta = getattr(choices[0], "delta", None)
+    if not delta:
+        return
+
+    delta_content = getattr(delta, "content", None)
+    if delta_content:
+        text_delta = normalize_reply_content(delta_content)
+        content_parts.append(text_delta)
+        if on_delta and text_delta:
+            on_delta(text_delta)
+
+    delta_tool_calls = getattr(delta, "tool_calls", None) or []
+    for tc in delta_tool_calls:
+        idx = getattr(tc, "index", None)
+        if idx is None:
+            idx = len(tool_calls_by_index)
+        entry = tool_calls_by_index.setdefault(
+            idx, {"id": "", "name": "", "arguments": ""}
+        )
+        tc_id = getattr(tc, "id", None)
+        if tc_id:
+            entry["id"] = tc_id
+        fn = getattr(tc, "function", None)
+        if fn:
+            fn_name = getattr(fn, "name", None)
+            if fn_name:
+                entry["name"] = fn_name
+            fn_args = getattr(fn, "arguments", None)
+            if fn_args:
+                entry["arguments"] += fn_args if isinstance(fn_args, str) else json.dumps(fn_args)
+        if on_tool_call and not entry.get("emitted") and _tool_call_ready(entry):
+            entry["emitted"] = True
+            on_tool_call(_normalized_tool_call(idx, entry))
+
+
+def _finalize_stream(content_parts, tool_calls_by_index, on_tool_call=None):
     normalized_calls = []
     for idx in sorted(tool_calls_by_index.keys()):
         call = tool_calls_by_index[idx]
-        normalized_calls.append(
-            {
-                "id": call["id"] or f"tool_call_{idx}",
-                "name": call["name"],
-                "arguments": call["arguments"] or "{}",
-            }
-        )
+        normalized_calls.append(_normalized_tool_call(idx, call))
+        if on_tool_call and not call.get("emitted"):
+            # Calls whose arguments never parsed are still handed over at the end.
+            call["emitted"] = True
+            on_tool_call(normalized_calls[-1])
 
     full_text = "".join([p for p in content_parts if p]).strip()
     if not full_text:
         full_text = ""
     return full_text, normalized_calls
 
+
+def collect_streamed_response(stream, on_delta=None, on_tool_call=None):
+    # on_tool_call receives each normalized tool call as soon as its arguments are
+    # complete, while the rest of the response is still streaming. The return
+    # value is unchanged: (full_text, normalized_calls) once the stream ends.
+    content_parts = []
+    tool_calls_by_index = {}
+    for chunk in stream:
+        _accumulate_chunk(chunk, content_parts, tool_calls_by_index, on_delta, on_tool_call)
+    return _finalize_stream(content_parts, tool_calls_by_index, on_tool_call)
+
+
+async def collect_streamed_response_async(stream, on_delta=None, on_tool_call=None):
+    content_parts = []
+    tool_calls_by_index = {}
+    async for chunk in stream:
+        _accumulate_chunk(chunk, content_parts, tool_calls_by_index, on_delta, on_tool_call)
+    return _finalize_stream(content_parts, tool_calls_by_index, on_tool_call)
@@ -0,0 +1,223 @@
+import itertools
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from utils import estimate_tokens
+
+
+DEFAULT_LATENCY_SECONDS = {
+    "planner": 0.4,
+    "agent": 0.3,
+    "critic": 0.3,
+    "summary": 0.3,
+    "other": 0.2,
+}
+DEFAULT_STREAM_CHUNK_SECONDS = 0.01
+
+
+def classify_request(body):
+    messages = body.get("messages") or []
+    if body.get("tools"):
+        return "agent"
+    first = messages[0] if messages else {}
+    first_text = first.get("content") if isinstance(first.get("content"), str) else ""
+    if first.get("role") == "system" and first_text.startswith("You are a helpful summarizer."):
+        return "summary"
+    if first_text.startswith("Review this answer"):
+        return "critic"
+    if first_text.startswith("You are a helpful multimodal agent. Create a minimal"):
+        return "planner"
+    return "other"
+
+
+class MockScript:
+    # Scripted replies for one benchmark case. Each kind maps to a list of
+    # replies consumed in order; the last reply repeats once the list runs out.
+    # Agent replies are {"content": "..."} or {"tool_calls": [{"name", "arguments"}]}.
+    def __init__(self, script=None):
+        script = script or {}
+        self._replies = {
+            "planner": list(script.get("planner") or ["1. Answer the question directly."]),
+            "agent": list(script.get("agent") or [{"content": "Done."}]),
+            "critic": list(script.get("critic") or ["GOOD"]),
+            "summary": list(script.get("summary") or ["The user asked a question and got an answer."]),
+            "other": list(script.get("other") or ["OK"]),
+        }
+        self._positions = {kind: 0 for kind in self._replies}
+        self._lock = threading.Lock()
+
+    def next_reply(self, kind):
+        with self._lock:
+            replies = self._replies[kind]
+            position = self._positions[kind]
+            self._positions[kind] = position + 1
+            return replies[min(position, len(replies) - 1)]
+
+
+class MockMistralServer:
+    def __init__(self, latency_seconds=None, stream_chunk_seconds=DEFAULT_STREAM_CHUNK_SECONDS, host="127.0.0.1", port=0):
+        self.latency_seconds = dict(DEFAULT_LATENCY_SECONDS, **(latency_seconds or {}))
+        self.stream_chunk_seconds = stream_chunk_seconds
+        self.script = MockScript()
+        self.calls = []
+        self._calls_lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._httpd = ThreadingHTTPServer((host, port), self._handler_class())
+        self._httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def reset(self, script=None):
+        self.script = MockScript(script)
+        with self._calls_lock:
+            self.calls = []
+
+    def calls_snapshot(self):
+        with self._calls_lock:
+            return list(self.calls)
+
+    def _record(self, kind, body, raw_body):
+        with self._calls_lock:
+            self.calls.append(
+                {
+                    "kind": kind,
+                    "model": body.get("model", ""),
+                    "stream": bool(body.get("stream")),
+                    "request_bytes": len(raw_body),
+                    "tokens_sent": estimate_tokens(json.dumps(body.get("messages") or [])),
+                }
+            )
+
+    def _completion_id(self):
+        return f"mock-{next(self._ids)}"
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_POST(self):
+                if not self.path.rstrip("/").endswith("/chat/completions"):
+                    self.send_error(404)
+                    return
+                raw_body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+                body = json.loads(raw_body or b"{}")
+                kind = classify_request(body)
+                server._record(kind, body, raw_body)
+                reply = server.script.next_reply(kind)
+                time.sleep(server.latency_seconds.get(kind, 0.0))
+                if body.get("stream"):
+                    self._send_stream(body, reply)
+                else:
+                    self._send_completion(body, reply)
+
+            def _message_payload(self, reply):
+                if isinstance(reply, str):
+                    return {"content": reply, "tool_calls": None}
+                tool_calls = [
+                    {
+                        "id": f"call_{i}_{server._completion_id()}",
+                        "type": "function",
+                        "function": {
+                            "name": call["name"],
+                            "arguments": call["arguments"] if isinstance(call["arguments"], str) else json.dumps(call["arguments"]),
+                        },
+                        "index": i,
+                    }
+                    for i, call in enumerate(reply.get("tool_calls") or [])
+                ]
+                return {"content": reply.get("content", ""), "tool_calls": tool_calls or None}
+
+            def _usage(self, body, content):
+                prompt_tokens = estimate_tokens(json.dumps(body.get("messages") or []))
+                completion_tokens = estimate_tokens(content or "")
+                return {
+                    "prompt_tokens": prompt_tokens,
+                    "completion_tokens": completion_tokens,
+                    "total_tokens": prompt_tokens + completion_tokens,
+                }
+
+            def _send_completion(self, body, reply):
+                payload = self._message_payload(reply)
+                response = {
+                    "id": server._completion_id(),
+                    "object": "chat.completion",
+                    "model": body.get("model", ""),
+                    "created": int(time.time()),
+                    "usage": self._usage(body, payload["content"]),
+                    "choices": [
+                        {
+                            "index": 0,
+                            "message": {"role": "assistant", **payload},
+                            "finish_reason": "tool_calls" if payload["tool_calls"] else "stop",
+                        }
+                    ],
+                }
+                data = json.dumps(response).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _send_stream(self, body, reply):
+                payload = self._message_payload(reply)
+                completion_id = server._completion_id()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Connection", "close")
+                self.end_headers()
+
+                def emit(delta, finish_reason=None, usage=None):
+                    chunk = {
+                        "id": completion_id,
+                        "object": "chat.completion.chunk",
+                        "model": body.get("model", ""),
+                        "created": int(time.time()),
+                        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+                    }
+                    if usage:
+                        chunk["usage"] = usage
+                    self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+                    self.wfile.flush()
+
+                emit({"role": "assistant", "content": ""})
+                content = payload["content"] or ""
+                words = content.split(" ")
+                for i, word in enumerate(words):
+                    if not word and i:
+                        continue
+                    emit({"content": word if i == len(words) - 1 else word + " "})
+                    time.sleep(server.stream_chunk_seconds)
+                for call in payload["tool_calls"] or []:
+                    emit({"tool_calls": [call]})
+                    time.sleep(server.stream_chunk_seconds)
+                emit(
+                    {"content": ""},
+                    finish_reason="tool_calls" if payload["tool_calls"] else "stop",
+                    usage=self._usage(body, content),
+                )
+                self.wfile.write(b"data: [DONE]\n\n")
+                self.wfile.flush()
+                self.close_connection = True
+
+        return Handler
@@ -1,6 +1,7 @@
+from artifacts import ARTIFACT_DIR
 from main import demo
 
 
 if __name__ == "__main__":
-    demo.launch(share=False)
+    demo.launch(share=False, allowed_paths=[ARTIFACT_DIR])
 
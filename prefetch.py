@@ -0,0 +1,88 @@
+import json
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from config import PREFETCH_ENABLED, PREFETCH_MATCH_THRESHOLD, PREFETCH_MAX_WORKERS
+from tools import execute_tool_by_name_and_args, normalize_search_query
+from tracing import increment
+
+
+_prefetch_executor = ThreadPoolExecutor(max_workers=PREFETCH_MAX_WORKERS, thread_name_prefix="prefetch")
+
+_QUERY_STOPWORDS = {
+    "a", "an", "and", "about", "are", "can", "find", "for", "from", "give", "how", "in", "is", "it",
+    "look", "me", "of", "on", "online", "please", "search", "summarize", "tell", "the", "to", "up",
+    "web", "what", "whats", "with", "you",
+}
+
+
+def _count(outcome):
+    # started, hits, wasted or cancelled; exported on /metrics.
+    increment("agent_prefetch_total", outcome=outcome)
+
+
+def _query_terms(query):
+    return {t for t in re.findall(r"\w+", normalize_search_query(query)) if t not in _QUERY_STOPWORDS}
+
+
+def _parse_args(raw_args):
+    if isinstance(raw_args, dict):
+        return raw_args
+    try:
+        args = json.loads(raw_args)
+    except (TypeError, ValueError):
+        return None
+    return args if isinstance(args, dict) else None
+
+
+def _args_match(name, prefetched_args, requested_args):
+    if name == "web_search":
+        requested = _query_terms(requested_args.get("query", ""))
+        prefetched = _query_terms(prefetched_args.get("query", ""))
+        if not requested or not prefetched:
+            return False
+        # Share of the agent's query that the speculative query already covers.
+        return len(requested & prefetched) / len(requested) >= PREFETCH_MATCH_THRESHOLD
+    return prefetched_args == requested_args
+
+
+class SpeculativePrefetcher:
+    # Per-run: starts likely tool work while the planner is still thinking and
+    # hands the result to the matching tool call, if the agent makes one.
+    def __init__(self):
+        self._entries = []
+        self._lock = threading.Lock()
+
+    def start_for_query(self, query_text, required_tools):
+        if not PREFETCH_ENABLED:
+            return
+        if "web_search" in (required_tools or []) and (query_text or "").strip():
+            self.start("web_search", {"query": query_text.strip()})
+
+    def start(self, name, args):
+        future = _prefetch_executor.submit(execute_tool_by_name_and_args, name, args)
+        with self._lock:
+            self._entries.append({"name": name, "args": args, "future": future, "claimed": False})
+        _count("started")
+
+    def claim(self, name, raw_args):
+        requested_args = _parse_args(raw_args)
+        if requested_args is None:
+            return None
+        with self._lock:
+            for entry in self._entries:
+                if entry["claimed"] or entry["name"] != name:
+                    continue
+                if _args_match(name, entry["args"], requested_args):
+                    entry["claimed"] = True
+                    _count("hits")
+                    return entry["future"]
+        return None
+
+    def finish(self):
+        with self._lock:
+            unclaimed = [entry for entry in self._entries if not entry["claimed"]]
+            self._entries = []
+        for entry in unclaimed:
+            _count("cancelled" if entry["future"].cancel() else "wasted")
@@ -0,0 +1,170 @@
+import collections
+import re
+import threading
+import time
+
+from config import CRITIC_PRESCREEN_ACCEPT_SCORE, CRITIC_PRESCREEN_LOG_SIZE
+from tracing import increment, observe, record_span
+from utils import is_math_query
+
+
+# Soft checks lower the score by their weight; hard checks reject outright.
+CHECK_WEIGHTS = {
+    "too_short": 0.3,
+    "too_long": 0.3,
+    "no_tool_reference": 0.4,
+    "unacknowledged_tool_failure": 0.3,
+    "image_mention_without_image": 0.4,
+    "placeholder_data": 0.5,
+}
+HARD_CHECKS = {
+    "empty_answer": "The answer is empty.",
+    "raw_tool_json": "The answer contains raw tool-call JSON; state the result in plain text instead.",
+    "denies_image": "An image is attached, but the answer claims it cannot see it; analyze the image directly.",
+}
+# (min words, max words) per request type.
+LENGTH_LIMITS = {
+    "math": (1, 40),
+    "explanation": (8, 400),
+    "default": (2, 300),
+}
+SCORE_BUCKETS = (0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0)
+
+_EXPLANATION_WORDS = ("explain", "describe", "why", "how ", "analy", "summar", "compare", "trend")
+_RAW_TOOL_JSON = re.compile(r'[\[{]\s*"(?:name|arguments|tool_calls|expression|query|code)"\s*:', re.IGNORECASE)
+_DENIES_IMAGE = re.compile(
+    r"\b(?:can(?:no|')t|unable to|do not|don't) (?:see|view|access|open|analy[sz]e) (?:the |this |any )?(?:image|picture|chart)"
+    r"|\bno (?:image|picture) (?:was |is )?(?:attached|provided|uploaded)",
+    re.IGNORECASE,
+)
+_MENTIONS_IMAGE = re.compile(r"\b(?:the|this|your|attached|uploaded) (?:image|picture|photo|screenshot)\b", re.IGNORECASE)
+_PLACEHOLDER_DATA = re.compile(r"\b(?:hypothetical|placeholder|dummy|made-up|fictional|sample) (?:data|values|numbers|figures)\b", re.IGNORECASE)
+_ACKNOWLEDGES_FAILURE = re.compile(r"\b(?:unavailable|could not|couldn't|unable|failed|error|not available)\b", re.IGNORECASE)
+_NUMBER = re.compile(r"-?\d+(?:\.\d+)?")
+_WORD = re.compile(r"[a-z][a-z\-]{4,}")
+_COMMON_WORDS = {
+    "about", "above", "after", "again", "based", "below", "could", "every", "first", "found", "other",
+    "result", "results", "search", "should", "source", "their", "there", "these", "those", "using",
+    "which", "while", "would", "output", "query", "calculation", "executed",
+}
+_TOOL_FAILURE_TEXT = "Tool unavailable - proceeding without this step."
+# Bookkeeping lines added around tool output ("Code output:", "[2 figure(s) captured ...]").
+_TOOL_NOTE_LINE = re.compile(r"^\s*(?:\[.*\]|\(.*\)|Code output:|Executed \(no output\))\s*$")
+
+_decisions = collections.deque(maxlen=CRITIC_PRESCREEN_LOG_SIZE)
+_decisions_lock = threading.Lock()
+
+
+def request_type(user_text):
+    t = (user_text or "").lower()
+    if is_math_query(t):
+        return "math"
+    if any(word in t for word in _EXPLANATION_WORDS):
+        return "explanation"
+    return "default"
+
+
+def _numbers_match(tool_number, answer_number):
+    # "28.27" matches a tool's 28.274333882308138 when rounded to the answer's precision.
+    try:
+        decimals = len(answer_number.split(".")[1]) if "." in answer_number else 0
+        return round(float(tool_number), decimals) == float(answer_number)
+    except ValueError:
+        return False
+
+
+def references_tool_output(answer, tool_outputs):
+    # None when the tool output has nothing distinctive to look for.
+    tool_text = "\n".join(
+        line
+        for output in tool_outputs
+        if output and output != _TOOL_FAILURE_TEXT
+        for line in output.splitlines()
+        if not _TOOL_NOTE_LINE.match(line)
+    )
+    tool_numbers = set(_NUMBER.findall(tool_text))
+    tool_words = {w for w in _WORD.findall(tool_text.lower()) if w not in _COMMON_WORDS}
+    if not tool_numbers and not tool_words:
+        return None
+    answer_numbers = set(_NUMBER.findall(answer))
+    if any(_numbers_match(t, a) for t in tool_numbers for a in answer_numbers):
+        return True
+    return bool(tool_words & set(_WORD.findall(answer.lower())))
+
+
+def prescreen_answer(answer, user_text, tool_outputs=(), has_image=False):
+    # Local scoring of an answer that passed the rule checks in agent.rule_critique.
+    # Returns a decision record: "reject" (hard check failed), "accept" (score at or
+    # above CRITIC_PRESCREEN_ACCEPT_SCORE) or "escalate" (ask the model critic).
+    started = time.perf_counter()
+    answer = (answer or "").strip()
+    kind = request_type(user_text)
+    words = len(answer.split())
+    failed = []
+
+    if not answer or answer == "(No text response)":
+        failed.append("empty_answer")
+    if _RAW_TOOL_JSON.search(answer):
+        failed.append("raw_tool_json")
+    if has_image and _DENIES_IMAGE.search(answer):
+        failed.append("denies_image")
+
+    min_words, max_words = LENGTH_LIMITS[kind]
+    if answer and words < min_words:
+        failed.append("too_short")
+    if words > max_words:
+        failed.append("too_long")
+    if answer and references_tool_output(answer, tool_outputs) is False:
+        failed.append("no_tool_reference")
+    if _TOOL_FAILURE_TEXT in tool_outputs and not _ACKNOWLEDGES_FAILURE.search(answer):
+        failed.append("unacknowledged_tool_failure")
+    if not has_image and _MENTIONS_IMAGE.search(answer):
+        failed.append("image_mention_without_image")
+    if _PLACEHOLDER_DATA.search(answer):
+        failed.append("placeholder_data")
+
+    score = max(0.0, 1.0 - sum(CHECK_WEIGHTS.get(check, 0.0) for check in failed))
+    if any(check in HARD_CHECKS for check in failed):
+        decision = "reject"
+    elif score >= CRITIC_PRESCREEN_ACCEPT_SCORE:
+        decision = "accept"
+    else:
+        decision = "escalate"
+
+    return {
+        "decision": decision,
+        "score": round(score, 3),
+        "failed": failed,
+        "request_type": kind,
+        "words": words,
+        "tools": len(tool_outputs),
+        "has_image": has_image,
+        # Set by the critic when the model reviews an escalated answer.
+        "model_verdict": None,
+        "seconds": time.perf_counter() - started,
+    }
+
+
+def log_decision(record, graph="full"):
+    # Every decision goes to metrics, the trace log (as a "prescreen" span) and the
+    # in-process log read by drain_decisions, so thresholds can be tuned against
+    # the model verdicts.
+    increment("agent_critic_prescreen_total", decision=record["decision"], request_type=record["request_type"])
+    observe("agent_critic_prescreen_score", record["score"], buckets=SCORE_BUCKETS, request_type=record["request_type"])
+    # On the express graph an "escalate" decision is accepted without the model.
+    attrs = dict({k: v for k, v in record.items() if k != "seconds"}, graph=graph)
+    record_span("critic", "prescreen", record["seconds"], **attrs)
+    with _decisions_lock:
+        _decisions.append(attrs)
+
+
+def rejection_feedback(record):
+    return "\n".join(f"- {HARD_CHECKS[check]}" for check in record["failed"] if check in HARD_CHECKS)
+
+
+def drain_decisions():
+    # Returns and clears the recent decision records (eval.py reports them per case).
+    with _decisions_lock:
+        records = list(_decisions)
+        _decisions.clear()
+    return records
@@ -0,0 +1,31 @@
+from config import MODEL, MODEL_ROUTES, MODEL_ROUTING_ENABLED
+from tracing import increment
+
+
+def _route_fits(route, has_image, required_tools, query_text):
+    if has_image and not route.get("allow_image", False):
+        return "image"
+    max_chars = route.get("max_query_chars")
+    if max_chars is not None and len(query_text or "") > max_chars:
+        return "long_query"
+    allowed_tools = route.get("tools")
+    if allowed_tools is not None and any(tool not in allowed_tools for tool in required_tools or []):
+        return "tools"
+    return None
+
+
+def route_model(node, has_image=False, required_tools=(), query_text="", retry_count=0):
+    # Picks the model for one node call. Returns (model, reason); the reason is
+    # "routed" when the node's smaller model is used, otherwise why it was not.
+    route = MODEL_ROUTES.get(node) if MODEL_ROUTING_ENABLED else None
+    if route is None:
+        model, reason = MODEL, "default"
+    elif retry_count and route.get("escalate", True):
+        # The critic rejected an answer this turn: retry on the large model.
+        model, reason = MODEL, "escalated"
+    else:
+        reason = _route_fits(route, has_image, required_tools, query_text)
+        model = MODEL if reason else route["model"]
+        reason = reason or "routed"
+    increment("agent_model_route_total", node=node, model=model, reason=reason)
+    return model, reason
@@ -1,25 +1,67 @@
+import atexit
+import collections
 import json
+import os
+import queue
+import shutil
 import subprocess
+import tempfile
+import threading
+import time
 
-from config import SANDBOX_TIMEOUT_SECONDS
+from artifacts import put_artifact_file
+from config import (
+    SANDBOX_FIGURE_DPI,
+    SANDBOX_FIGURE_FORMAT,
+    SANDBOX_KERNEL_IDLE_SECONDS,
+    SANDBOX_KERNEL_MAX_SESSIONS,
+    SANDBOX_KERNEL_MEMORY_LIMIT_MB,
+    SANDBOX_MAX_FIGURES,
+    SANDBOX_MAX_JOBS_PER_WORKER,
+    SANDBOX_PERSISTENT_KERNELS,
+    SANDBOX_POOL_SIZE,
+    SANDBOX_PYTHON,
+    SANDBOX_TIMEOUT_SECONDS,
+    SANDBOX_WORKER_START_TIMEOUT_SECONDS,
+)
 
 
-def run_code_in_sandbox(user_code, timeout_seconds=SANDBOX_TIMEOUT_SECONDS):
-    payload = json.dumps(user_code)
-    sandbox_script = f"""
-import io, contextlib, traceback, base64, json, os, time, pathlib
-user_code = {payload}
-sanitized_code = user_code.replace("plt.show()", "").replace("matplotlib.pyplot.show()", "")
-stdout_buffer = io.StringIO()
-local = {{"os": os, "time": time, "pathlib": pathlib}}
-allowed_roots = {{"math","statistics","numpy","matplotlib","seaborn","pandas","os","time","pathlib"}}
+RESULT_PREFIX = "SANDBOX_RESULT:"
+READY_LINE = "SANDBOX_READY"
+
+# Long-lived worker: pays the numpy/pandas/matplotlib/seaborn import cost once,
+# then executes one JSON job per stdin line and answers with one SANDBOX_RESULT line.
+# Persistent jobs share one namespace across calls (per-session kernels); the
+# others get a fresh namespace and a full state reset (cwd, environment, plot and
+# pandas options, the numpy RNG, and attributes patched onto the preloaded
+# modules; submodules a job imported stay imported). Open figures are written
+# to the job's artifact_dir and only their paths travel back over stdout.
+WORKER_SCRIPT = """
+import io, contextlib, traceback, json, os, sys, time, pathlib, types, warnings
+os.environ.setdefault("MPLBACKEND", "Agg")
+for _module in ("math", "statistics", "numpy", "pandas", "matplotlib", "matplotlib.pyplot", "seaborn"):
+    try:
+        __import__(_module)
+    except Exception:
+        pass
+_snapshot_modules = ("os", "time", "pathlib", "math", "statistics", "numpy", "pandas", "matplotlib", "matplotlib.pyplot", "seaborn")
+module_snapshots = {name: dict(vars(sys.modules[name])) for name in _snapshot_modules if name in sys.modules}
+environ_snapshot = dict(os.environ)
+memory_limit_mb = int(os.environ.get("SANDBOX_MEMORY_LIMIT_MB") or 0)
+if memory_limit_mb:
+    try:
+        import resource
+        resource.setrlimit(resource.RLIMIT_AS, (memory_limit_mb * 1024 * 1024,) * 2)
+    except Exception:
+        pass
+allowed_roots = {"math","statistics","numpy","matplotlib","seaborn","pandas","os","time","pathlib"}
 real_import = __import__
 def safe_import(name, globals=None, locals=None, fromlist=(), level=0):
     root = name.split(".")[0]
     if root not in allowed_roots:
-        raise ImportError(f"Import '{{name}}' is blocked in sandbox.")
+        raise ImportError(f"Import '{name}' is blocked in sandbox.")
     return real_import(name, globals, locals, fromlist, level)
-safe_builtins = {{
+safe_builtins = {
     "__import__": safe_import,
     "print": print,
     "range": range,
@@ -38,50 +80,520 @@ safe_builtins = {{
     "tuple": tuple,
     "enumerate": enumerate,
     "zip": zip,
-}}
-try:
-    with contextlib.redirect_stdout(stdout_buffer):
-        exec(sanitized_code, {{"__builtins__": safe_builtins}}, local)
-    output = stdout_buffer.getvalue().strip() or local.get("result", "Executed (no output)")
-    plot_base64 = None
+}
+protocol_out = sys.stdout
+home_dir = os.getcwd()
+kernel_namespace = None
+no_result = object()
+
+def emit(line):
+    protocol_out.write(line + "\\n")
+    protocol_out.flush()
+
+def restore_modules():
+    for name, saved in module_snapshots.items():
+        current = vars(sys.modules[name])
+        for key in [k for k, v in current.items() if k not in saved and not isinstance(v, types.ModuleType)]:
+            del current[key]
+        for key, value in saved.items():
+            if current.get(key) is not value:
+                current[key] = value
+
+def reset_state():
+    os.chdir(home_dir)
+    restore_modules()
+    if dict(os.environ) != environ_snapshot:
+        os.environ.clear()
+        os.environ.update(environ_snapshot)
+    try:
+        import numpy
+        numpy.random.seed()
+    except Exception:
+        pass
+    try:
+        import matplotlib
+        import matplotlib.pyplot as plt
+        plt.close("all")
+        matplotlib.rcdefaults()
+    except Exception:
+        pass
+    try:
+        import pandas
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            pandas.reset_option("all")
+    except Exception:
+        pass
+
+def current_rss_bytes():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except Exception:
+        pass
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+    except Exception:
+        return 0
+
+def new_namespace():
+    return {"__builtins__": dict(safe_builtins), "os": os, "time": time, "pathlib": pathlib}
+
+def close_figures():
     try:
         import matplotlib.pyplot as plt
-        if plt.get_fignums():
-            buf = io.BytesIO()
-            plt.gcf().savefig(buf, format="png", bbox_inches="tight")
-            buf.seek(0)
-            plot_base64 = base64.b64encode(buf.read()).decode("utf-8")
+        plt.close("all")
     except Exception:
         pass
+
+def save_figures(job):
+    artifact_dir = job.get("artifact_dir")
+    if not artifact_dir:
+        return [], 0
+    try:
+        import matplotlib.pyplot as plt
+        fignums = plt.get_fignums()
+    except Exception:
+        return [], 0
+    max_figures = int(job.get("max_figures") or len(fignums))
+    saved = []
+    for num in fignums[:max_figures]:
+        figure = plt.figure(num)
+        for fmt in (job.get("figure_format") or "png", "png"):
+            path = os.path.join(artifact_dir, f"figure_{len(saved) + 1}.{fmt}")
+            try:
+                figure.savefig(path, format=fmt, dpi=job.get("figure_dpi") or 100, bbox_inches="tight")
+                saved.append(path)
+                break
+            except Exception:
+                continue
+    return saved, max(0, len(fignums) - max_figures)
+
+def run_job(job):
+    user_code = job.get("code", "")
+    persistent = bool(job.get("persistent"))
+    global kernel_namespace
+    sanitized_code = user_code.replace("plt.show()", "").replace("matplotlib.pyplot.show()", "")
+    stdout_buffer = io.StringIO()
+    if persistent:
+        if kernel_namespace is None:
+            kernel_namespace = new_namespace()
+        local = kernel_namespace
+        previous_result = local.get("result", no_result)
+    else:
+        local = {"os": os, "time": time, "pathlib": pathlib}
+        previous_result = no_result
+    try:
+        with contextlib.redirect_stdout(stdout_buffer):
+            if persistent:
+                exec(sanitized_code, local)
+            else:
+                exec(sanitized_code, {"__builtins__": dict(safe_builtins)}, local)
+        result = local.get("result", no_result)
+        if result is previous_result:
+            result = "Executed (no output)"
+        output = stdout_buffer.getvalue().strip() or result
+        figures, figures_dropped = save_figures(job)
+        return {
+            "ok": True,
+            "text": "Code output:\\n" + str(output),
+            "figures": figures,
+            "figures_dropped": figures_dropped,
+        }
+    except Exception:
+        return {"ok": False, "text": "Code error:\\n" + traceback.format_exc(limit=2), "figures": []}
     finally:
-        try:
-            plt.close("all")
-        except Exception:
-            pass
-    print("SANDBOX_RESULT:" + json.dumps({{"ok": True, "text": "Code output:\\n" + str(output), "plot_base64": plot_base64}}))
-except Exception:
-    print("SANDBOX_RESULT:" + json.dumps({{"ok": False, "text": "Code error:\\n" + traceback.format_exc(limit=2), "plot_base64": None}}))
+        # Kernels keep cwd, options and variables; plots are captured per call.
+        if persistent:
+            close_figures()
+        else:
+            reset_state()
+
+emit("SANDBOX_READY")
+for raw_job in sys.stdin:
+    result = run_job(json.loads(raw_job))
+    result["rss_bytes"] = current_rss_bytes()
+    emit("SANDBOX_RESULT:" + json.dumps(result))
 """
-    try:
-        completed = subprocess.run(
-            ["py", "-3.11", "-c", sandbox_script],
-            capture_output=True,
+
+
+class SandboxWorkerError(Exception):
+    pass
+
+
+class SandboxTimeout(SandboxWorkerError):
+    pass
+
+
+class SandboxWorker:
+    def __init__(self, memory_limit_mb=0):
+        self.jobs_run = 0
+        self.last_rss_bytes = 0
+        self._lines = queue.Queue()
+        self._stderr_tail = collections.deque(maxlen=50)
+        self._ready = False
+        self.process = subprocess.Popen(
+            SANDBOX_PYTHON + ["-u", "-c", WORKER_SCRIPT],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
             text=True,
-            timeout=timeout_seconds,
+            bufsize=1,
+            env=dict(os.environ, SANDBOX_MEMORY_LIMIT_MB=str(memory_limit_mb)) if memory_limit_mb else None,
         )
-    except subprocess.TimeoutExpired:
-        return "Code error: sandbox timeout after {0} seconds.".format(timeout_seconds), None
-    except Exception as e:
-        return f"Code error: sandbox launch failed: {e}", None
+        threading.Thread(target=self._pump_stdout, daemon=True).start()
+        threading.Thread(target=self._pump_stderr, daemon=True).start()
+
+    def _pump_stdout(self):
+        for line in self.process.stdout:
+            self._lines.put(line.rstrip("\n"))
+        self._lines.put(None)
+
+    def _pump_stderr(self):
+        for line in self.process.stderr:
+            self._stderr_tail.append(line)
+
+    def stderr_text(self):
+        return "".join(self._stderr_tail).strip()
 
-    lines = (completed.stdout or "").splitlines()
-    for line in reversed(lines):
-        if line.startswith("SANDBOX_RESULT:"):
+    def is_alive(self):
+        return self.process.poll() is None
+
+    def _read_until(self, predicate, timeout_seconds, timeout_message):
+        try:
+            while True:
+                line = self._lines.get(timeout=timeout_seconds)
+                if line is None:
+                    raise SandboxWorkerError("sandbox terminated without parsable output")
+                if predicate(line):
+                    return line
+        except queue.Empty:
+            raise SandboxTimeout(timeout_message)
+
+    def wait_ready(self, timeout_seconds=SANDBOX_WORKER_START_TIMEOUT_SECONDS):
+        if not self._ready:
+            self._read_until(lambda line: line == READY_LINE, timeout_seconds, "sandbox worker failed to start")
+            self._ready = True
+
+    def _send(self, job, timeout_seconds):
+        try:
+            self.process.stdin.write(json.dumps(job) + "\n")
+            self.process.stdin.flush()
+        except (BrokenPipeError, OSError, ValueError):
+            raise SandboxWorkerError("sandbox terminated without parsable output")
+        line = self._read_until(lambda l: l.startswith(RESULT_PREFIX), timeout_seconds, "sandbox timeout")
+        try:
+            result = json.loads(line[len(RESULT_PREFIX):])
+        except Exception:
+            raise SandboxWorkerError("sandbox terminated without parsable output")
+        self.last_rss_bytes = result.get("rss_bytes") or 0
+        return result
+
+    def run(self, user_code, timeout_seconds, persistent=False, artifact_dir=None):
+        # Returns (text, figure_paths); figures are files written into artifact_dir.
+        self.jobs_run += 1
+        job = {
+            "code": user_code,
+            "persistent": persistent,
+            "artifact_dir": artifact_dir,
+            "figure_format": SANDBOX_FIGURE_FORMAT,
+            "figure_dpi": SANDBOX_FIGURE_DPI,
+            "max_figures": SANDBOX_MAX_FIGURES,
+        }
+        result = self._send(job, timeout_seconds)
+        text = result.get("text", "Code error: unknown sandbox output.")
+        if result.get("figures_dropped"):
+            text += f"\n({result['figures_dropped']} more figure(s) were not captured; the limit is {SANDBOX_MAX_FIGURES}.)"
+        return text, result.get("figures") or []
+
+    def close(self):
+        try:
+            self.process.kill()
+        except Exception:
+            pass
+
+
+class SandboxPool:
+    def __init__(self, size=SANDBOX_POOL_SIZE, max_jobs_per_worker=SANDBOX_MAX_JOBS_PER_WORKER):
+        self.size = size
+        self.max_jobs_per_worker = max_jobs_per_worker
+        self._idle = queue.Queue()
+        self._slots = threading.BoundedSemaphore(size)
+        self._closed = False
+        for _ in range(size):
+            self._spawn_idle_async()
+
+    def _spawn_idle(self):
+        try:
+            worker = SandboxWorker()
+        except Exception:
+            return
+        self._release(worker)
+
+    def _spawn_idle_async(self):
+        threading.Thread(target=self._spawn_idle, daemon=True).start()
+
+    def _release(self, worker):
+        if self._closed or self._idle.qsize() >= self.size or not worker.is_alive():
+            worker.close()
+            return
+        self._idle.put(worker)
+
+    def _checkout(self):
+        while True:
             try:
-                result = json.loads(line[len("SANDBOX_RESULT:"):])
-                return result.get("text", "Code error: unknown sandbox output."), result.get("plot_base64")
-            except Exception:
+                worker = self._idle.get_nowait()
+            except queue.Empty:
+                return SandboxWorker()
+            if worker.is_alive():
+                return worker
+            worker.close()
+
+    def _recycle(self, worker):
+        worker.close()
+        self._spawn_idle_async()
+
+    def run(self, user_code, timeout_seconds=SANDBOX_TIMEOUT_SECONDS, artifact_dir=None):
+        # The timeout covers waiting for a free slot and a started worker too.
+        deadline = time.monotonic() + timeout_seconds
+        if not self._slots.acquire(timeout=timeout_seconds):
+            return _timeout_result(timeout_seconds)
+        try:
+            try:
+                worker = self._checkout()
+            except Exception as e:
+                return f"Code error: sandbox launch failed: {e}", []
+            result, healthy = _run_on_worker(
+                worker, user_code, timeout_seconds, artifact_dir=artifact_dir, deadline=deadline
+            )
+            if not healthy or worker.jobs_run >= self.max_jobs_per_worker:
+                self._recycle(worker)
+            else:
+                self._release(worker)
+            return result
+        finally:
+            self._slots.release()
+
+    def shutdown(self):
+        self._closed = True
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
                 break
-    if completed.stderr:
-        return "Code error:\n" + completed.stderr.strip(), None
-    return "Code error: sandbox terminated without parsable output.", None
+
+
+class SandboxKernels:
+    # One persistent worker per session whose namespace survives between calls.
+    # Kernels idle for idle_seconds are closed, and a kernel whose resident memory
+    # passes the cap (also enforced with RLIMIT_AS where available) is restarted.
+    # At most max_sessions kernels exist: a new session evicts the least recently
+    # used kernel not in use, or waits for one (up to the call's timeout).
+    def __init__(
+        self,
+        max_sessions=SANDBOX_KERNEL_MAX_SESSIONS,
+        idle_seconds=SANDBOX_KERNEL_IDLE_SECONDS,
+        memory_limit_mb=SANDBOX_KERNEL_MEMORY_LIMIT_MB,
+    ):
+        self.max_sessions = max_sessions
+        self.idle_seconds = idle_seconds
+        self.memory_limit_mb = memory_limit_mb
+        self._kernels = {}
+        self._lock = threading.Lock()
+        self._freed = threading.Condition(self._lock)
+        self._closed = False
+        threading.Thread(target=self._reap_idle, daemon=True).start()
+
+    def _evict_lru(self):
+        # Only kernels no call is using; returns False when every kernel is busy.
+        idle = [(k["last_used"], sid) for sid, k in self._kernels.items() if not k["users"]]
+        if not idle:
+            return False
+        _, session_id = min(idle)
+        self._kernels.pop(session_id)["worker"].close()
+        return True
+
+    def _kernel_for(self, session_id, timeout_seconds):
+        # Returns the session's kernel marked as in use, or None when no kernel
+        # could be freed for it within timeout_seconds.
+        deadline = time.monotonic() + timeout_seconds
+        with self._lock:
+            while True:
+                kernel = self._kernels.get(session_id)
+                if kernel is not None and kernel["worker"].is_alive():
+                    kernel["users"] += 1
+                    return kernel
+                if kernel is not None:
+                    del self._kernels[session_id]
+                    kernel["worker"].close()
+                if len(self._kernels) < self.max_sessions or self._evict_lru():
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self._freed.wait(remaining)
+            kernel = {
+                "worker": SandboxWorker(memory_limit_mb=self.memory_limit_mb),
+                "lock": threading.Lock(),
+                "last_used": time.monotonic(),
+                "users": 1,
+            }
+            self._kernels[session_id] = kernel
+            return kernel
+
+    def _done_with(self, kernel):
+        with self._lock:
+            kernel["users"] -= 1
+            self._freed.notify_all()
+
+    def _discard(self, session_id, kernel):
+        with self._lock:
+            if self._kernels.get(session_id) is kernel:
+                del self._kernels[session_id]
+                self._freed.notify_all()
+        kernel["worker"].close()
+
+    def run(self, session_id, user_code, timeout_seconds=SANDBOX_TIMEOUT_SECONDS, artifact_dir=None):
+        try:
+            kernel = self._kernel_for(session_id, timeout_seconds)
+        except Exception as e:
+            return f"Code error: sandbox launch failed: {e}", []
+        if kernel is None:
+            return (
+                f"Code error: all {self.max_sessions} Python sessions are busy; "
+                f"none became free within {timeout_seconds} seconds.",
+                [],
+            )
+        try:
+            with kernel["lock"]:
+                worker = kernel["worker"]
+                (text, figures), healthy = _run_on_worker(worker, user_code, timeout_seconds, True, artifact_dir)
+                kernel["last_used"] = time.monotonic()
+                over_memory = self.memory_limit_mb and worker.last_rss_bytes > self.memory_limit_mb * 1024 * 1024
+        finally:
+            self._done_with(kernel)
+        if not healthy or over_memory:
+            self._discard(session_id, kernel)
+            reason = "exceeded its memory limit" if over_memory and healthy else "stopped"
+            text += f"\nNote: the Python session {reason} and was restarted; earlier variables are gone."
+        return text, figures
+
+    def reset(self, session_id):
+        with self._lock:
+            kernel = self._kernels.pop(session_id, None)
+            self._freed.notify_all()
+        if kernel is not None:
+            kernel["worker"].close()
+
+    def _reap_idle(self):
+        while not self._closed:
+            time.sleep(max(1.0, min(60.0, self.idle_seconds / 4)))
+            cutoff = time.monotonic() - self.idle_seconds
+            with self._lock:
+                expired = [sid for sid, k in self._kernels.items() if k["last_used"] < cutoff and not k["users"]]
+                for session_id in expired:
+                    self._kernels.pop(session_id)["worker"].close()
+                if expired:
+                    self._freed.notify_all()
+
+    def shutdown(self):
+        self._closed = True
+        with self._lock:
+            for kernel in self._kernels.values():
+                kernel["worker"].close()
+            self._kernels.clear()
+
+
+def _timeout_result(timeout_seconds):
+    return "Code error: sandbox timeout after {0} seconds.".format(timeout_seconds), []
+
+
+def _run_on_worker(worker, user_code, timeout_seconds, persistent=False, artifact_dir=None, deadline=None):
+    # With a deadline, the wait for the worker to start counts against the call's
+    # timeout; a worker still starting when it passes is healthy and kept.
+    ready_timeout = SANDBOX_WORKER_START_TIMEOUT_SECONDS
+    if deadline is not None:
+        ready_timeout = min(ready_timeout, max(0.0, deadline - time.monotonic()))
+    try:
+        worker.wait_ready(ready_timeout)
+    except SandboxTimeout as e:
+        if deadline is not None and ready_timeout < SANDBOX_WORKER_START_TIMEOUT_SECONDS:
+            return _timeout_result(timeout_seconds), worker.is_alive()
+        return (f"Code error: sandbox launch failed: {worker.stderr_text() or e}", []), False
+    except SandboxWorkerError as e:
+        return (f"Code error: sandbox launch failed: {worker.stderr_text() or e}", []), False
+    run_timeout = timeout_seconds if deadline is None else max(0.0, deadline - time.monotonic())
+    try:
+        result = worker.run(user_code, run_timeout, persistent, artifact_dir)
+    except SandboxTimeout:
+        return _timeout_result(timeout_seconds), False
+    except SandboxWorkerError as e:
+        stderr_text = worker.stderr_text()
+        if stderr_text:
+            return ("Code error:\n" + stderr_text, []), False
+        return (f"Code error: {e}.", []), False
+    return result, worker.is_alive()
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_sandbox_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = SandboxPool()
+            atexit.register(_pool.shutdown)
+        return _pool
+
+
+_kernels = None
+
+
+def get_sandbox_kernels():
+    global _kernels
+    with _pool_lock:
+        if _kernels is None:
+            _kernels = SandboxKernels()
+            atexit.register(_kernels.shutdown)
+        return _kernels
+
+
+def reset_session_kernel(session_id):
+    if _kernels is not None and session_id:
+        _kernels.reset(session_id)
+
+
+def _run_code(user_code, timeout_seconds, session_id, artifact_dir):
+    if SANDBOX_PERSISTENT_KERNELS and session_id:
+        return get_sandbox_kernels().run(session_id, user_code, timeout_seconds, artifact_dir)
+    if SANDBOX_POOL_SIZE > 0:
+        return get_sandbox_pool().run(user_code, timeout_seconds, artifact_dir)
+
+    # Pooling disabled: one throwaway worker per call.
+    try:
+        worker = SandboxWorker()
+    except Exception as e:
+        return f"Code error: sandbox launch failed: {e}", []
+    try:
+        result, _ = _run_on_worker(worker, user_code, timeout_seconds, artifact_dir=artifact_dir)
+        return result
+    finally:
+        worker.close()
+
+
+def run_code_in_sandbox(user_code, timeout_seconds=SANDBOX_TIMEOUT_SECONDS, session_id=None):
+    # Returns (text, artifacts): artifact references for every captured figure.
+    artifact_dir = tempfile.mkdtemp(prefix="sandbox_artifacts_")
+    try:
+        text, figure_paths = _run_code(user_code, timeout_seconds, session_id, artifact_dir)
+        artifacts = []
+        for path in figure_paths:
+            if os.path.exists(path):
+                artifacts.append(put_artifact_file(path, os.path.splitext(path)[1]))
+        return text, artifacts
+    finally:
+        shutil.rmtree(artifact_dir, ignore_errors=True)
@@ -0,0 +1,183 @@
+import asyncio
+import itertools
+import threading
+import time
+
+from config import (
+    DEFAULT_MISTRAL_RATE_LIMIT,
+    MISTRAL_RATE_LIMITS,
+    SCHEDULER_MAX_QUEUE,
+    SCHEDULER_MAX_WAIT_SECONDS,
+)
+from tracing import increment, observe, set_gauge
+
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 1
+PRIORITY_BATCH = 2
+PRIORITY_NAMES = {
+    PRIORITY_INTERACTIVE: "interactive",
+    PRIORITY_BACKGROUND: "background",
+    PRIORITY_BATCH: "batch",
+}
+
+
+class SchedulerRejected(RuntimeError):
+    pass
+
+
+class TokenBucket:
+    def __init__(self, rate_per_second, capacity):
+        self.rate_per_second = rate_per_second
+        self.capacity = capacity
+        self.level = capacity
+        self._updated = time.monotonic()
+
+    def _refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self._updated) * self.rate_per_second)
+        self._updated = now
+
+    def wait_time(self, amount, now):
+        # A request larger than the bucket only has to wait for a full bucket.
+        self._refill(now)
+        amount = min(amount, self.capacity)
+        if self.level >= amount:
+            return 0.0
+        return (amount - self.level) / self.rate_per_second
+
+    def take(self, amount):
+        self.level -= min(amount, self.capacity)
+
+    def adjust(self, delta):
+        # Positive delta charges more (actual usage above the estimate); the level
+        # may go negative, which simply delays the next requests.
+        self.level = min(self.capacity, self.level - delta)
+
+
+class _ModelLimiter:
+    def __init__(self, limit):
+        rps = float(limit["requests_per_second"])
+        tpm = float(limit["tokens_per_minute"])
+        self.requests = TokenBucket(rps, max(1.0, rps))
+        self.tokens = TokenBucket(tpm / 60.0, tpm)
+
+    def wait_time(self, tokens, now):
+        return max(self.requests.wait_time(1, now), self.tokens.wait_time(tokens, now))
+
+    def take(self, tokens):
+        self.requests.take(1)
+        self.tokens.take(tokens)
+
+
+class RequestScheduler:
+    # Admission control in front of the Mistral API. Each model has request/s and
+    # tokens/min buckets. Waiters are served by priority, then round-robin across
+    # sessions (a session's n-th queued request goes after every other session's
+    # earlier ones), then arrival order. The queue is bounded and waits time out.
+    def __init__(
+        self,
+        limits=MISTRAL_RATE_LIMITS,
+        default_limit=DEFAULT_MISTRAL_RATE_LIMIT,
+        max_queue=SCHEDULER_MAX_QUEUE,
+        max_wait_seconds=SCHEDULER_MAX_WAIT_SECONDS,
+    ):
+        self.limits = dict(limits)
+        self.default_limit = default_limit
+        self.max_queue = max_queue
+        self.max_wait_seconds = max_wait_seconds
+        self._limiters = {}
+        self._waiting = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+
+    def _limiter(self, model):
+        limiter = self._limiters.get(model)
+        if limiter is None:
+            limiter = self._limiters[model] = _ModelLimiter(self.limits.get(model, self.default_limit))
+        return limiter
+
+    def _publish_depth(self, model):
+        depth = sum(1 for w in self._waiting if w["model"] == model)
+        set_gauge("agent_scheduler_queue_depth", depth, model=model)
+
+    def _try_grant(self, waiter, now):
+        # Only the best-ranked waiter for a model may take capacity. Returns the
+        # time to sleep before checking again, or None once granted.
+        head = min(
+            (w for w in self._waiting if w["model"] == waiter["model"]),
+            key=lambda w: (w["priority"], w["turn"], w["seq"]),
+        )
+        limiter = self._limiter(waiter["model"])
+        if head is not waiter:
+            return self.max_wait_seconds
+        delay = limiter.wait_time(waiter["tokens"], now)
+        if delay > 0:
+            return delay
+        limiter.take(waiter["tokens"])
+        return None
+
+    def _finish(self, waiter, granted):
+        self._waiting.remove(waiter)
+        self._publish_depth(waiter["model"])
+        self._cond.notify_all()
+        waited = time.monotonic() - waiter["enqueued"]
+        priority = PRIORITY_NAMES.get(waiter["priority"], str(waiter["priority"]))
+        if granted:
+            observe("agent_scheduler_wait_seconds", waited, model=waiter["model"], priority=priority)
+        return waited
+
+    def acquire(self, model, tokens, priority=PRIORITY_INTERACTIVE, session_id=None):
+        # Blocks until the request may be sent; returns the time spent queued.
+        with self._cond:
+            if len(self._waiting) >= self.max_queue:
+                increment("agent_scheduler_rejected_total", model=model, reason="queue_full")
+                raise SchedulerRejected("Mistral request queue is full. Please retry in a few seconds.")
+            waiter = {
+                "model": model,
+                "tokens": tokens,
+                "priority": priority,
+                "session_id": session_id,
+                "turn": sum(
+                    1
+                    for w in self._waiting
+                    if w["model"] == model and w["priority"] == priority and w["session_id"] == session_id
+                ),
+                "seq": next(self._seq),
+                "enqueued": time.monotonic(),
+            }
+            self._waiting.append(waiter)
+            self._publish_depth(model)
+            deadline = waiter["enqueued"] + self.max_wait_seconds
+            while True:
+                now = time.monotonic()
+                delay = self._try_grant(waiter, now)
+                if delay is None:
+                    return self._finish(waiter, granted=True)
+                if now >= deadline:
+                    self._finish(waiter, granted=False)
+                    increment("agent_scheduler_rejected_total", model=model, reason="timeout")
+                    raise SchedulerRejected("Timed out waiting for a Mistral request slot. Please retry in a few seconds.")
+                self._cond.wait(min(delay, deadline - now))
+
+    async def acquire_async(self, model, tokens, priority=PRIORITY_INTERACTIVE, session_id=None):
+        return await asyncio.to_thread(self.acquire, model, tokens, priority, session_id)
+
+    def try_acquire(self, model, tokens):
+        # Non-blocking grab for optional extra requests (hedges); never jumps the queue.
+        with self._cond:
+            if any(w["model"] == model for w in self._waiting):
+                return False
+            limiter = self._limiter(model)
+            if limiter.wait_time(tokens, time.monotonic()) > 0:
+                return False
+            limiter.take(tokens)
+            return True
+
+    def settle(self, model, reserved_tokens, actual_tokens):
+        # Corrects the token bucket once the API reports real usage.
+        with self._cond:
+            self._limiter(model).tokens.adjust(actual_tokens - reserved_tokens)
+            self._cond.notify_all()
+
+
+request_scheduler = RequestScheduler()
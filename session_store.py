@@ -0,0 +1,365 @@
+import base64
+import binascii
+import collections
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+from langchain_core.messages import HumanMessage, messages_from_dict, messages_to_dict
+
+from artifacts import put_artifact_bytes
+from config import (
+    SESSION_DB_PATH,
+    SESSION_GLOBAL_MAX_MEMORY_BYTES,
+    SESSION_LIVE_MAX_MESSAGES,
+    SESSION_LIVE_TOKEN_BUDGET,
+    SESSION_LIVE_UI_ENTRIES,
+    SESSION_MAX_IN_MEMORY,
+    SESSION_MAX_MEMORY_BYTES,
+    SESSION_TTL_SECONDS,
+)
+from tracing import increment, set_gauge
+from utils import estimate_tokens
+
+
+def new_session():
+    # messages and ui_history hold only the recent, in-memory part of the model
+    # history and the chat transcript; the first spilled_count messages and
+    # ui_spilled_count transcript entries are in the session database.
+    # summarized_count: how many leading messages (of the whole history) the
+    # summary already covers.
+    return {
+        "messages": [],
+        "ui_history": [],
+        "summary": "",
+        "summarized_count": 0,
+        "spilled_count": 0,
+        "ui_spilled_count": 0,
+        "image_data": "",
+        "updated_at": 0.0,
+    }
+
+
+def _serialize(session):
+    return json.dumps(
+        {
+            "messages": messages_to_dict(session["messages"]),
+            "ui_history": session["ui_history"],
+            "summary": session["summary"],
+            "summarized_count": session["summarized_count"],
+            "spilled_count": session["spilled_count"],
+            "ui_spilled_count": session["ui_spilled_count"],
+            "image_data": session["image_data"],
+        }
+    )
+
+
+def _deserialize(payload, updated_at):
+    data = json.loads(payload)
+    messages = messages_from_dict(data.get("messages") or [])
+    spilled_count = int(data.get("spilled_count", 0))
+    return {
+        "messages": messages,
+        "ui_history": data.get("ui_history") or [],
+        "summary": data.get("summary") or "",
+        # Sessions saved before rolling summaries were summarized every turn.
+        "summarized_count": int(data.get("summarized_count", spilled_count + len(messages))),
+        "spilled_count": spilled_count,
+        "ui_spilled_count": int(data.get("ui_spilled_count", 0)),
+        "image_data": data.get("image_data") or "",
+        "updated_at": updated_at,
+    }
+
+
+def _externalize_plots(msg):
+    # Older sessions carried figures inline as base64; move them to the artifact store.
+    plot_b64 = msg.additional_kwargs.get("plot_base64")
+    if not plot_b64:
+        return msg
+    kwargs = {k: v for k, v in msg.additional_kwargs.items() if k != "plot_base64"}
+    try:
+        ref = put_artifact_bytes(base64.b64decode(plot_b64), "png")
+        kwargs["artifacts"] = list(kwargs.get("artifacts") or []) + [ref]
+    except (binascii.Error, ValueError, OSError):
+        pass
+    return msg.model_copy(update={"additional_kwargs": kwargs})
+
+
+def _message_size(msg):
+    # (bytes, estimated prompt tokens) of one message.
+    content = msg.content if isinstance(msg.content, str) else json.dumps(msg.content, default=str)
+    extra = json.dumps(msg.additional_kwargs, default=str) if msg.additional_kwargs else ""
+    return len(content.encode("utf-8")) + len(extra), estimate_tokens(content) + estimate_tokens(extra)
+
+
+def _entry_size(entry):
+    return len(json.dumps(entry, default=str).encode("utf-8"))
+
+
+def _window_start(starts, count, sizes, max_entries, max_bytes):
+    # The oldest turn start whose tail fits the limits, or the last one.
+    for start in starts:
+        if count - start <= max_entries and sum(sizes[start:]) <= max_bytes:
+            return start
+    return starts[-1]
+
+
+def live_window_start(messages):
+    # Index of the oldest message to keep in memory. The window starts at a user
+    # message, so an assistant tool call is never separated from its results, and
+    # always includes the latest turn even when that turn alone is over the limits.
+    starts = [i for i, msg in enumerate(messages) if isinstance(msg, HumanMessage)]
+    if not starts:
+        return 0
+    sizes = [_message_size(msg) for msg in messages]
+    count = len(messages)
+    return max(
+        _window_start(starts, count, [size[0] for size in sizes], SESSION_LIVE_MAX_MESSAGES, SESSION_MAX_MEMORY_BYTES),
+        _window_start(starts, count, [size[1] for size in sizes], SESSION_LIVE_MAX_MESSAGES, SESSION_LIVE_TOKEN_BUDGET),
+    )
+
+
+def transcript_window_start(ui_history, max_bytes):
+    # Same for the chat transcript, cut before a user entry; it gets the part of
+    # the per-session byte ceiling the live messages leave.
+    starts = [i for i, entry in enumerate(ui_history) if isinstance(entry, dict) and entry.get("role") == "user"]
+    if not starts:
+        return 0
+    sizes = [_entry_size(entry) for entry in ui_history]
+    return _window_start(starts, len(ui_history), sizes, SESSION_LIVE_UI_ENTRIES, max_bytes)
+
+
+def _session_size(session):
+    return sum(_message_size(msg)[0] for msg in session["messages"]) + sum(
+        _entry_size(entry) for entry in session["ui_history"]
+    )
+
+
+class SessionStore:
+    # Conversation state keyed by session ID: an in-memory LRU of live sessions,
+    # written through to SQLite so several app processes can share sessions.
+    # Sessions untouched for ttl_seconds are dropped. Messages that fall out of
+    # the prompt window, and older chat transcript entries, are spilled to the
+    # session_messages/session_transcript tables and read back by load_messages
+    # (the summarizer) and load_transcript (the "Show Earlier Messages" button).
+    def __init__(
+        self,
+        max_sessions=SESSION_MAX_IN_MEMORY,
+        ttl_seconds=SESSION_TTL_SECONDS,
+        db_path=SESSION_DB_PATH,
+        max_memory_bytes=SESSION_GLOBAL_MAX_MEMORY_BYTES,
+    ):
+        self.max_sessions = max_sessions
+        self.ttl_seconds = ttl_seconds
+        self.max_memory_bytes = max_memory_bytes
+        self._memory = collections.OrderedDict()
+        self._memory_sizes = {}
+        self._lock = threading.Lock()
+        self._update_lock = threading.Lock()
+        self._saves = 0
+        self._db = None
+        if db_path:
+            try:
+                os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+                self._db = sqlite3.connect(db_path, check_same_thread=False, timeout=5)
+                self._db.execute("PRAGMA journal_mode=WAL")
+                self._db.execute(
+                    "CREATE TABLE IF NOT EXISTS sessions ("
+                    "session_id TEXT PRIMARY KEY, updated_at REAL NOT NULL, payload TEXT NOT NULL)"
+                )
+                self._db.execute(
+                    "CREATE TABLE IF NOT EXISTS session_messages ("
+                    "session_id TEXT NOT NULL, position INTEGER NOT NULL, payload TEXT NOT NULL, "
+                    "PRIMARY KEY (session_id, position))"
+                )
+                self._db.execute(
+                    "CREATE TABLE IF NOT EXISTS session_transcript ("
+                    "session_id TEXT NOT NULL, position INTEGER NOT NULL, payload TEXT NOT NULL, "
+                    "PRIMARY KEY (session_id, position))"
+                )
+                self._db.commit()
+            except sqlite3.Error:
+                self._db = None
+
+    @staticmethod
+    def new_session_id():
+        return uuid.uuid4().hex
+
+    def _remember(self, session_id, session):
+        self._memory[session_id] = session
+        self._memory.move_to_end(session_id)
+        self._memory_sizes[session_id] = _session_size(session)
+        # Least recently used sessions leave memory first; with a database they
+        # are read back on their next load.
+        while len(self._memory) > 1 and (
+            len(self._memory) > self.max_sessions or sum(self._memory_sizes.values()) > self.max_memory_bytes
+        ):
+            evicted, _ = self._memory.popitem(last=False)
+            self._memory_sizes.pop(evicted, None)
+            increment("agent_session_evictions_total")
+        set_gauge("agent_session_memory_bytes", sum(self._memory_sizes.values()))
+
+    def _forget(self, session_id):
+        self._memory.pop(session_id, None)
+        self._memory_sizes.pop(session_id, None)
+
+    def _disk_updated_at(self, session_id):
+        try:
+            row = self._db.execute("SELECT updated_at FROM sessions WHERE session_id = ?", (session_id,)).fetchone()
+        except sqlite3.Error:
+            return None
+        return row[0] if row else None
+
+    def _load_from_disk(self, session_id):
+        try:
+            row = self._db.execute(
+                "SELECT updated_at, payload FROM sessions WHERE session_id = ?", (session_id,)
+            ).fetchone()
+        except sqlite3.Error:
+            return None
+        if row is None:
+            return None
+        try:
+            return _deserialize(row[1], row[0])
+        except (ValueError, KeyError, TypeError):
+            return None
+
+    def load(self, session_id):
+        # Returns a copy of the session, or a fresh one for unknown/expired IDs.
+        now = time.time()
+        with self._lock:
+            session = self._memory.get(session_id)
+            if self._db is not None:
+                # Another process may have advanced or cleared the session since we cached it.
+                disk_updated_at = self._disk_updated_at(session_id)
+                if disk_updated_at is None:
+                    session = None
+                elif session is None or disk_updated_at > session["updated_at"]:
+                    session = self._load_from_disk(session_id)
+            if session is None or now - session["updated_at"] > self.ttl_seconds:
+                self._forget(session_id)
+                return new_session()
+            self._remember(session_id, session)
+            return dict(session, messages=list(session["messages"]), ui_history=list(session["ui_history"]))
+
+    def _append_rows(self, table, session_id, first, payloads):
+        self._db.executemany(
+            f"INSERT OR REPLACE INTO {table} (session_id, position, payload) VALUES (?, ?, ?)",
+            [(session_id, first + i, payload) for i, payload in enumerate(payloads)],
+        )
+
+    def _spill(self, session_id, session):
+        # Moves messages before the live window, and transcript entries over what
+        # is left of the byte ceiling, to disk. Without a database they are
+        # dropped; the summary still covers the messages once summarized.
+        messages = [_externalize_plots(msg) for msg in session["messages"]]
+        start = live_window_start(messages)
+        live_bytes = sum(_message_size(msg)[0] for msg in messages[start:])
+        ui_history = session["ui_history"]
+        ui_start = transcript_window_start(ui_history, max(SESSION_MAX_MEMORY_BYTES - live_bytes, 0))
+        if self._db is not None:
+            if start:
+                payloads = [json.dumps(data) for data in messages_to_dict(messages[:start])]
+                self._append_rows("session_messages", session_id, session["spilled_count"], payloads)
+            if ui_start:
+                payloads = [json.dumps(entry, default=str) for entry in ui_history[:ui_start]]
+                self._append_rows("session_transcript", session_id, session["ui_spilled_count"], payloads)
+        if start:
+            increment("agent_session_spilled_messages_total", start)
+        if ui_start:
+            increment("agent_session_spilled_transcript_total", ui_start)
+        return dict(
+            session,
+            messages=messages[start:],
+            spilled_count=session["spilled_count"] + start,
+            ui_history=ui_history[ui_start:],
+            ui_spilled_count=session["ui_spilled_count"] + ui_start,
+        )
+
+    def save(self, session_id, session):
+        session = dict(session, updated_at=time.time())
+        with self._lock:
+            self._saves += 1
+            try:
+                session = self._spill(session_id, session)
+            except sqlite3.Error:
+                pass
+            self._remember(session_id, session)
+            if self._db is None:
+                return
+            try:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO sessions (session_id, updated_at, payload) VALUES (?, ?, ?)",
+                    (session_id, session["updated_at"], _serialize(session)),
+                )
+                if self._saves % 100 == 0:
+                    cutoff = session["updated_at"] - self.ttl_seconds
+                    for table in ("session_messages", "session_transcript"):
+                        self._db.execute(
+                            f"DELETE FROM {table} WHERE session_id IN "
+                            "(SELECT session_id FROM sessions WHERE updated_at < ?)",
+                            (cutoff,),
+                        )
+                    self._db.execute("DELETE FROM sessions WHERE updated_at < ?", (cutoff,))
+                self._db.commit()
+            except sqlite3.Error:
+                pass
+
+    def _load_rows(self, table, session_id, start, end):
+        if self._db is None or end <= start:
+            return []
+        with self._lock:
+            try:
+                rows = self._db.execute(
+                    f"SELECT payload FROM {table} WHERE session_id = ? AND position >= ? AND position < ? "
+                    "ORDER BY position",
+                    (session_id, start, end),
+                ).fetchall()
+            except sqlite3.Error:
+                return []
+        return [json.loads(row[0]) for row in rows]
+
+    def load_messages(self, session_id, start, end):
+        # Spilled messages [start, end) of the whole history, read back on demand.
+        rows = self._load_rows("session_messages", session_id, start, end)
+        increment("agent_session_reloaded_messages_total", len(rows))
+        return messages_from_dict(rows)
+
+    def load_transcript(self, session_id):
+        # The whole chat transcript: spilled entries followed by the live ones.
+        session = self.load(session_id)
+        rows = self._load_rows("session_transcript", session_id, 0, session["ui_spilled_count"])
+        increment("agent_session_reloaded_transcript_total", len(rows))
+        return rows + session["ui_history"]
+
+    def update(self, session_id, apply):
+        # Read-modify-write for writers that own different fields (a turn's messages,
+        # the background summary) so neither overwrites the other. `apply` gets the
+        # current session and returns the fields to change, or None to leave it.
+        with self._update_lock:
+            session = self.load(session_id)
+            changes = apply(session)
+            if changes is None:
+                return None
+            session.update(changes)
+            self.save(session_id, session)
+            return session
+
+    def clear(self, session_id):
+        with self._lock:
+            self._forget(session_id)
+            if self._db is None:
+                return
+            try:
+                self._db.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+                self._db.execute("DELETE FROM session_messages WHERE session_id = ?", (session_id,))
+                self._db.execute("DELETE FROM session_transcript WHERE session_id = ?", (session_id,))
+                self._db.commit()
+            except sqlite3.Error:
+                pass
+
+
+session_store = SessionStore()
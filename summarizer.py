@@ -0,0 +1,114 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from langchain_core.messages import AIMessage, HumanMessage
+
+from agent import is_internal_control_message
+from config import SUMMARY_MAX_MESSAGE_CHARS, SUMMARY_MAX_WORKERS, SUMMARY_MIN_NEW_CHARS
+from mistral_client import safe_chat_complete
+from routing import route_model
+from scheduler import PRIORITY_BACKGROUND
+from session_store import session_store
+from utils import normalize_reply_content
+
+
+_summary_executor = ThreadPoolExecutor(max_workers=SUMMARY_MAX_WORKERS, thread_name_prefix="summary")
+_running_lock = threading.Lock()
+_running = {}
+_rerun = set()
+
+
+def readable_lines(messages):
+    lines = []
+    for m in messages:
+        if isinstance(m, HumanMessage):
+            text = normalize_reply_content(m.content)
+            if not is_internal_control_message(text):
+                lines.append(f"User: {text[:SUMMARY_MAX_MESSAGE_CHARS]}")
+        elif isinstance(m, AIMessage) and not m.additional_kwargs.get("tool_calls"):
+            text = normalize_reply_content(m.content).strip()
+            if text:
+                lines.append(f"Assistant: {text[:SUMMARY_MAX_MESSAGE_CHARS]}")
+    return lines
+
+
+def fold_summary(summary, new_messages, priority=PRIORITY_BACKGROUND, session_id=None):
+    # Folds messages added since the last summary into it. Returns None when
+    # they are too short to be worth a model call; they are folded in later.
+    lines = readable_lines(new_messages)
+    if sum(len(line) for line in lines) < SUMMARY_MIN_NEW_CHARS:
+        return None
+
+    summary_prompt = (
+        "Update the conversation summary with the new messages. "
+        "Keep it to 2-3 sentences covering the key points of the whole conversation.\n\n"
+        f"Current summary: {summary or 'None yet.'}\n\n"
+        "New messages:\n" + "\n".join(lines)
+    )
+    model, _ = route_model("summarize")
+    reply = safe_chat_complete(
+        hedge=True,
+        cache=True,
+        priority=priority,
+        session_id=session_id,
+        model=model,
+        messages=[
+            {"role": "system", "content": "You are a helpful summarizer."},
+            {"role": "user", "content": summary_prompt},
+        ],
+        max_tokens=150
+    ).choices[0].message.content
+    return normalize_reply_content(reply).strip() or None
+
+
+def _summarize_once(session_id):
+    session = session_store.load(session_id)
+    # Counts are over the whole history; the first spilled_count messages are on disk.
+    offset = session["spilled_count"]
+    end = offset + len(session["messages"])
+    start = min(session["summarized_count"], end)
+    pending = session_store.load_messages(session_id, start, offset) + session["messages"][max(start - offset, 0):]
+    new_summary = fold_summary(session["summary"], pending, session_id=session_id)
+    if new_summary is None:
+        return session["summary"]
+
+    def apply(current):
+        # Drop the result if the session was cleared or another summary landed first.
+        if (
+            current["summarized_count"] != session["summarized_count"]
+            or current["spilled_count"] + len(current["messages"]) < end
+        ):
+            return None
+        return {"summary": new_summary, "summarized_count": end}
+
+    session_store.update(session_id, apply)
+    return new_summary
+
+
+def _summarize_session(session_id):
+    try:
+        while True:
+            summary = _summarize_once(session_id)
+            with _running_lock:
+                if session_id not in _rerun:
+                    _running.pop(session_id, None)
+                    return summary
+                _rerun.discard(session_id)
+    except Exception:
+        # Best effort: the messages stay pending and are folded in after a later turn.
+        with _running_lock:
+            _running.pop(session_id, None)
+            _rerun.discard(session_id)
+        return None
+
+
+def schedule_summary(session_id):
+    # Updates the session summary in the background once a turn has been saved.
+    # One job per session; turns finishing while it runs trigger one more pass.
+    with _running_lock:
+        future = _running.get(session_id)
+        if future is not None:
+            _rerun.add(session_id)
+            return future
+        future = _running[session_id] = _summary_executor.submit(_summarize_session, session_id)
+        return future
@@ -1,15 +1,34 @@
-import contextlib
-import io
+import contextvars
 import json
+import logging
 import math
 import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 
 try:
     from ddgs import DDGS
 except ImportError:
     from duckduckgo_search import DDGS
 
+from artifacts import put_artifact_bytes
+from cache import PersistentTTLCache
+from compaction import compact_tool_output
+from config import (
+    DEFAULT_TOOL_CALL_TIMEOUT_SECONDS,
+    SANDBOX_PERSISTENT_KERNELS,
+    TOOL_CALL_TIMEOUT_SECONDS,
+    TOOL_CONCURRENCY_LIMITS,
+    TOOL_MAX_WORKERS,
+    TOOL_MEMO_ENABLED,
+    TOOL_MEMO_EXCLUDED_TOOLS,
+    WEB_SEARCH_CACHE_MAX_ENTRIES,
+    WEB_SEARCH_CACHE_STALE_SECONDS,
+    WEB_SEARCH_CACHE_TTL_SECONDS,
+)
 from sandbox import run_code_in_sandbox
+from tracing import increment, span
 from utils import is_math_query
 
 
@@ -46,7 +65,15 @@ tools = [
         "type": "function",
         "function": {
             "name": "code_interpreter",
-            "description": "Execute simple Python code and return output. Use for plotting, math, or analysis.",
+            "description": (
+                "Execute simple Python code and return output. Use for plotting, math, or analysis."
+                + (
+                    " Variables, DataFrames and imports persist between calls in this conversation;"
+                    " reuse them instead of repeating setup code."
+                    if SANDBOX_PERSISTENT_KERNELS
+                    else ""
+                )
+            ),
             "parameters": {
                 "type": "object",
                 "properties": {
@@ -111,7 +138,91 @@ def infer_required_tools_from_plan(plan_text: str):
     return required
 
 
-def execute_tool_by_name_and_args(name, raw_args):
+for _logger_name in ("primp", "ddgs", "duckduckgo_search"):
+    logging.getLogger(_logger_name).setLevel(logging.ERROR)
+
+web_search_cache = PersistentTTLCache(
+    "web_search",
+    max_entries=WEB_SEARCH_CACHE_MAX_ENTRIES,
+    ttl_seconds=WEB_SEARCH_CACHE_TTL_SECONDS,
+    stale_seconds=WEB_SEARCH_CACHE_STALE_SECONDS,
+)
+_web_search_refreshing = set()
+_web_search_refresh_lock = threading.Lock()
+
+
+def normalize_search_query(query):
+    return " ".join(str(query or "").lower().split())
+
+
+def _fetch_web_results(query):
+    # Searches run concurrently (tool calls, prefetch, background refresh), so the
+    # library's noise is silenced through logging, not by swapping sys.stdout.
+    with DDGS() as ddgs:
+        results = [r for r in ddgs.text(query, max_results=3)]
+    return [{"title": r["title"], "body": r["body"], "href": r["href"]} for r in results]
+
+
+def _refresh_web_results(cache_key, query):
+    try:
+        results = _fetch_web_results(query)
+        if results:
+            web_search_cache.set(cache_key, results)
+    except Exception:
+        pass
+    finally:
+        with _web_search_refresh_lock:
+            _web_search_refreshing.discard(cache_key)
+
+
+def cached_web_results(query):
+    cache_key = normalize_search_query(query)
+    cached = web_search_cache.get(cache_key, allow_stale=WEB_SEARCH_CACHE_STALE_SECONDS > 0)
+    if cached is not None:
+        results, stale = cached
+        if stale:
+            # Stale-while-revalidate: answer now, refresh in the background.
+            with _web_search_refresh_lock:
+                start_refresh = cache_key not in _web_search_refreshing
+                _web_search_refreshing.add(cache_key)
+            if start_refresh:
+                threading.Thread(target=_refresh_web_results, args=(cache_key, query), daemon=True).start()
+        return results
+
+    results = _fetch_web_results(query)
+    # Empty result sets are often transient (rate limiting), so they are not cached.
+    if results:
+        web_search_cache.set(cache_key, results)
+    return results
+
+
+_FAILURE_PREFIXES = ("Tool execution failed", "Code error", "Invalid tool")
+
+
+def _is_failure(result):
+    return isinstance(result, str) and result.startswith(_FAILURE_PREFIXES)
+
+
+def execute_tool_by_name_and_args(name, raw_args, session_id=None):
+    with span("tool", name or "unknown") as attrs:
+        result, artifacts = _execute_tool(name, raw_args, session_id)
+        attrs["failed"] = _is_failure(result)
+        compacted = compact_tool_output(name, result)
+        if compacted != result:
+            # The prompt gets the compacted text; the UI can still show all of it.
+            attrs["output_chars"] = len(result)
+            try:
+                artifacts = (artifacts or []) + [put_artifact_bytes(result.encode("utf-8"), "txt")]
+            except OSError:
+                # The tool still succeeded; only the link to the full output is lost.
+                compacted = compact_tool_output(name, result, full_output_saved=False)
+            attrs["compacted_chars"] = len(compacted)
+            result = compacted
+        attrs["artifacts"] = len(artifacts or [])
+        return result, artifacts
+
+
+def _execute_tool(name, raw_args, session_id=None):
     try:
         args = json.loads(raw_args) if isinstance(raw_args, str) else raw_args
         if not isinstance(args, dict):
@@ -134,9 +245,7 @@ def execute_tool_by_name_and_args(name, raw_args):
             return f"Calculation result: {result}", None
 
         if name == "web_search":
-            with contextlib.redirect_stderr(io.StringIO()), contextlib.redirect_stdout(io.StringIO()):
-                with DDGS() as ddgs:
-                    results = [r for r in ddgs.text(args["query"], max_results=3)]
+            results = cached_web_results(args["query"])
             if not results:
                 return f"web_search(query={args.get('query', '')}) -> No relevant results found.", None
             summaries = [f"- {r['title']}: {r['body'][:300]}... Source: {r['href']}" for r in results]
@@ -146,8 +255,110 @@ def execute_tool_by_name_and_args(name, raw_args):
             user_code = args.get("code", "")
             if not isinstance(user_code, str) or not user_code.strip():
                 return "Code error: missing 'code' string.", None
-            return run_code_in_sandbox(user_code)
+            text, artifacts = run_code_in_sandbox(user_code, session_id=session_id)
+            if artifacts:
+                text += f"\n[{len(artifacts)} figure(s) captured and shown to the user.]"
+            return text, artifacts
 
         return "Unknown tool.", None
     except Exception as e:
         return f"Tool execution failed: {str(e)}", None
+
+
+_tool_executor = ThreadPoolExecutor(max_workers=TOOL_MAX_WORKERS, thread_name_prefix="tool")
+_tool_semaphores = {
+    name: threading.BoundedSemaphore(limit) for name, limit in TOOL_CONCURRENCY_LIMITS.items()
+}
+
+
+def _run_tool_call(name, raw_args, session_id=None):
+    semaphore = _tool_semaphores.get(name)
+    if semaphore is None:
+        return execute_tool_by_name_and_args(name, raw_args, session_id)
+    with semaphore:
+        return execute_tool_by_name_and_args(name, raw_args, session_id)
+
+
+def tool_memo_key(name, raw_args):
+    try:
+        args = json.loads(raw_args) if isinstance(raw_args, str) else raw_args
+        canonical = json.dumps(args, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    except (TypeError, ValueError):
+        canonical = str(raw_args).strip()
+    return name, canonical
+
+
+def _reusable(future):
+    # Calls that failed or were cancelled run again instead of replaying the failure.
+    if future.cancelled():
+        return False
+    if not future.done():
+        return True
+    if future.exception() is not None:
+        return False
+    return not _is_failure(future.result()[0])
+
+
+def start_tool_call(tool_call, prefetcher=None, session_id=None, memo=None):
+    # Submits one call (or claims its prefetched result) and returns a handle for
+    # tool_call_result. The timeout runs from submission. `memo` is a per-run dict
+    # from build_run_config; an identical earlier call's future is reused.
+    name = tool_call.get("name", "")
+    raw_args = tool_call.get("arguments", "{}")
+    timeout = TOOL_CALL_TIMEOUT_SECONDS.get(name, DEFAULT_TOOL_CALL_TIMEOUT_SECONDS)
+    if not TOOL_MEMO_ENABLED or name in TOOL_MEMO_EXCLUDED_TOOLS:
+        memo = None
+    memo_key = tool_memo_key(name, raw_args) if memo is not None else None
+    future = memo.get(memo_key) if memo is not None else None
+    if future is not None and _reusable(future):
+        increment("agent_tool_memo_hits_total", tool=name)
+    else:
+        future = prefetcher.claim(name, raw_args) if prefetcher is not None else None
+        if future is None:
+            # Run in a copy of the caller's context so tool spans nest under the node span.
+            future = _tool_executor.submit(contextvars.copy_context().run, _run_tool_call, name, raw_args, session_id)
+        if memo is not None:
+            memo[memo_key] = future
+    return {
+        "call": tool_call,
+        "future": future,
+        "deadline": time.monotonic() + timeout,
+        "timeout": timeout,
+        "memo": memo,
+        "memo_key": memo_key,
+    }
+
+
+def _forget(pending):
+    memo = pending.get("memo")
+    if memo is not None and memo.get(pending["memo_key"]) is pending["future"]:
+        memo.pop(pending["memo_key"], None)
+
+
+def tool_call_result(pending):
+    name = pending["call"].get("name", "")
+    future = pending["future"]
+    try:
+        return future.result(timeout=max(0.0, pending["deadline"] - time.monotonic()))
+    except FutureTimeoutError:
+        future.cancel()
+        _forget(pending)
+        return f"Tool execution failed: {name} timed out after {pending['timeout']} seconds.", None
+    except Exception as e:
+        _forget(pending)
+        return f"Tool execution failed: {str(e)}", None
+
+
+def execute_tool_calls(tool_calls, prefetcher=None, session_id=None, started=None, memo=None):
+    # Calls from one assistant turn run concurrently; results keep the call order
+    # so each ToolMessage still lines up with its tool_call_id. `started` maps
+    # tool_call ids to handles from start_tool_call for calls already running.
+    started = started if started is not None else {}
+    pending = []
+    for tool_call in tool_calls:
+        early = started.pop(tool_call.get("id", ""), None)
+        if early is not None and early["call"] == tool_call:
+            pending.append(early)
+        else:
+            pending.append(start_tool_call(tool_call, prefetcher, session_id, memo))
+    return [tool_call_result(p) for p in pending]
@@ -0,0 +1,228 @@
+import contextlib
+import contextvars
+import inspect
+import json
+import os
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from config import TRACE_LOG_PATH
+
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_current_span = contextvars.ContextVar("current_span", default=None)
+_current_trace_id = contextvars.ContextVar("current_trace_id", default=None)
+
+_metrics_lock = threading.Lock()
+_counters = {}
+_gauges = {}
+_histograms = {}
+_help = {
+    "agent_spans_total": "Finished spans by kind, name and status.",
+    "agent_span_duration_seconds": "Span duration in seconds.",
+    "agent_llm_tokens_total": "Tokens reported by the Mistral API.",
+    "agent_llm_retries_total": "Retried Mistral API requests.",
+    "agent_scheduler_queue_depth": "Mistral requests waiting for a rate-limit slot.",
+    "agent_scheduler_wait_seconds": "Time Mistral requests spent queued in the scheduler.",
+    "agent_scheduler_rejected_total": "Mistral requests rejected by the scheduler (queue full or timeout).",
+    "agent_cache_lookups_total": "Cache lookups by namespace, result (hit, stale_hit, miss) and source.",
+    "agent_cache_sets_total": "Values written to the cache by namespace.",
+    "agent_cache_evictions_total": "Entries evicted from the in-memory cache LRU by namespace.",
+    "agent_prefetch_total": "Speculative tool prefetches by outcome (started, hits, wasted, cancelled).",
+    "agent_tool_memo_hits_total": "Tool calls answered from an identical earlier call in the same run.",
+    "agent_critic_prescreen_total": "Critic pre-screen decisions (accept, reject, escalate to the model).",
+    "agent_critic_prescreen_score": "Critic pre-screen answer scores.",
+    "agent_model_route_total": "Model chosen per node call, with the routing reason.",
+    "agent_session_spilled_messages_total": "Messages moved from memory to the session database.",
+    "agent_session_reloaded_messages_total": "Spilled messages read back from the session database.",
+    "agent_session_spilled_transcript_total": "Chat transcript entries moved from memory to the session database.",
+    "agent_session_reloaded_transcript_total": "Spilled chat transcript entries read back from the session database.",
+    "agent_session_evictions_total": "Sessions evicted from memory by the session count or byte ceilings.",
+    "agent_session_memory_bytes": "Approximate bytes of message history held in memory across sessions.",
+}
+
+_log_lock = threading.Lock()
+_log_file = None
+
+
+def _label_key(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def increment(metric, value=1, **labels):
+    with _metrics_lock:
+        key = (metric, _label_key(labels))
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def set_gauge(metric, value, **labels):
+    with _metrics_lock:
+        _gauges[(metric, _label_key(labels))] = value
+
+
+def observe(metric, value, buckets=DURATION_BUCKETS, **labels):
+    with _metrics_lock:
+        key = (metric, _label_key(labels))
+        hist = _histograms.get(key)
+        if hist is None:
+            hist = _histograms[key] = {"buckets": buckets, "counts": [0] * len(buckets), "sum": 0.0, "count": 0}
+        for i, bound in enumerate(hist["buckets"]):
+            if value <= bound:
+                hist["counts"][i] += 1
+        hist["sum"] += value
+        hist["count"] += 1
+
+
+def _format_labels(label_key, extra=()):
+    pairs = list(label_key) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}"
+
+
+def render_prometheus():
+    lines = []
+    with _metrics_lock:
+        for metric_type, series in (("counter", _counters), ("gauge", _gauges)):
+            for name in sorted({name for name, _ in series}):
+                if name in _help:
+                    lines.append(f"# HELP {name} {_help[name]}")
+                lines.append(f"# TYPE {name} {metric_type}")
+                for (series_name, labels), value in sorted(series.items()):
+                    if series_name == name:
+                        lines.append(f"{name}{_format_labels(labels)} {value}")
+        for name in sorted({name for name, _ in _histograms}):
+            if name in _help:
+                lines.append(f"# HELP {name} {_help[name]}")
+            lines.append(f"# TYPE {name} histogram")
+            for (series_name, labels), hist in sorted(_histograms.items()):
+                if series_name != name:
+                    continue
+                for bound, count in zip(hist["buckets"], hist["counts"]):
+                    lines.append(f"{name}_bucket{_format_labels(labels, [('le', bound)])} {count}")
+                lines.append(f"{name}_bucket{_format_labels(labels, [('le', '+Inf')])} {hist['count']}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {hist['sum']}")
+                lines.append(f"{name}_count{_format_labels(labels)} {hist['count']}")
+    return "\n".join(lines) + "\n"
+
+
+def _write_trace_line(record):
+    global _log_file
+    if not TRACE_LOG_PATH:
+        return
+    with _log_lock:
+        try:
+            if _log_file is None:
+                os.makedirs(os.path.dirname(TRACE_LOG_PATH) or ".", exist_ok=True)
+                _log_file = open(TRACE_LOG_PATH, "a", encoding="utf-8")
+            _log_file.write(json.dumps(record, default=str) + "\n")
+            _log_file.flush()
+        except OSError:
+            pass
+
+
+def _export(record):
+    labels = {"kind": record["kind"], "name": record["name"]}
+    increment("agent_spans_total", status=record["status"], **labels)
+    observe("agent_span_duration_seconds", record["duration_seconds"], **labels)
+    attrs = record["attributes"]
+    if record["kind"] == "llm":
+        model = attrs.get("model", "")
+        for token_type in ("prompt_tokens", "completion_tokens"):
+            if attrs.get(token_type):
+                increment("agent_llm_tokens_total", attrs[token_type], model=model, type=token_type.split("_")[0])
+        if attrs.get("retries"):
+            increment("agent_llm_retries_total", attrs["retries"], model=model)
+    _write_trace_line(record)
+
+
+def _new_record(kind, name, attrs):
+    parent = _current_span.get()
+    trace_id = _current_trace_id.get() or (parent["trace_id"] if parent else None) or uuid.uuid4().hex
+    return {
+        "trace_id": trace_id,
+        "span_id": uuid.uuid4().hex[:16],
+        "parent_id": parent["span_id"] if parent else None,
+        "kind": kind,
+        "name": name,
+        "start_time": time.time(),
+        "duration_seconds": 0.0,
+        "status": "ok",
+        "attributes": attrs,
+    }
+
+
+@contextlib.contextmanager
+def span(kind, name, **attrs):
+    # Yields the attribute dict so callers can attach results (tokens, tool name, ...).
+    record = _new_record(kind, name, attrs)
+    token = _current_span.set(record)
+    started = time.perf_counter()
+    try:
+        yield record["attributes"]
+    except BaseException as e:
+        record["status"] = "error"
+        record["attributes"]["error"] = str(e)[:300]
+        raise
+    finally:
+        _current_span.reset(token)
+        record["duration_seconds"] = time.perf_counter() - started
+        _export(record)
+
+
+def record_span(kind, name, duration_seconds, status="ok", **attrs):
+    # For operations timed elsewhere (e.g. a stream consumed after the call returned).
+    record = _new_record(kind, name, attrs)
+    record["start_time"] = time.time() - duration_seconds
+    record["duration_seconds"] = duration_seconds
+    record["status"] = status
+    _export(record)
+
+
+@contextlib.contextmanager
+def trace_context(trace_id):
+    token = _current_trace_id.set(trace_id)
+    try:
+        yield
+    finally:
+        _current_trace_id.reset(token)
+
+
+def traced_node(name, fn):
+    # Wraps a LangGraph node in a span. The wrapper always accepts config so the
+    # run's trace_id (from build_run_config) groups every node of one turn.
+    accepts_config = "config" in inspect.signature(fn).parameters
+
+    def node(state, config):
+        trace_id = ((config or {}).get("configurable") or {}).get("trace_id")
+        with trace_context(trace_id), span("node", name, retry_count=int(state.get("retry_count", 0) or 0)):
+            return fn(state, config) if accepts_config else fn(state)
+
+    node.__name__ = getattr(fn, "__name__", name)
+    return node
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        payload = render_prometheus().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+def start_metrics_server(port, host="127.0.0.1"):
+    httpd = ThreadingHTTPServer((host, port), _MetricsHandler)
+    httpd.daemon_threads = True
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return httpd
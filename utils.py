@@ -1,12 +1,8 @@
-import base64
+import ast
+import functools
+import math
+import operator
 import re
-from io import BytesIO
-
-
-def encode_image(image_pil):
-    buffered = BytesIO()
-    image_pil.save(buffered, format="JPEG")
-    return base64.b64encode(buffered.getvalue()).decode("utf-8")
 
 
 def normalize_reply_content(content):
@@ -23,6 +19,24 @@ def normalize_reply_content(content):
     return str(content)
 
 
+def estimate_tokens(text):
+    # Rough local estimate (~4 characters per token for Mistral tokenizers);
+    # good enough for budgeting without a tokenizer round trip.
+    if not text:
+        return 0
+    return max(1, (len(text) + 3) // 4)
+
+
+def clean_final_reply(text):
+    text = re.sub(r"\n?\[Critique:.*?\)]", "", text, flags=re.DOTALL)
+    text = re.sub(r"\n?Stopped after retry limit.*", "", text, flags=re.DOTALL)
+    text = re.sub(r'\[\{\"name\".*?\}\]', "", text, flags=re.DOTALL)
+    text = re.sub(r'\[?\{\"name\": \"code_interpreter\".*', "", text, flags=re.DOTALL)
+    text = re.sub(r"^\s*\*{0,2}revised answer:?\*{0,2}\s*", "", text, flags=re.IGNORECASE)
+    text = re.sub(r"!\[[^\]]*\]\(attachment:[^)]+\)", "", text, flags=re.IGNORECASE)
+    return re.sub(r"\n{3,}", "\n\n", text).strip()
+
+
 def is_math_query(text):
     if not text:
         return False
@@ -45,3 +59,84 @@ def is_math_query(text):
         return True
     return bool(re.search(r"[\d\)\]]\s*[\+\-\*/\^]\s*[\d\(\[]", t))
 
+
+
+_ARITHMETIC_PREFIX = re.compile(
+    r"^\s*(?:please\s+)?(?:compute|calculate|evaluate|what\s+is|what's)?\s*:?\s*",
+    re.IGNORECASE,
+)
+_ARITHMETIC_BODY = re.compile(r"^[\d\s.+\-*/^%()]+$")
+_ARITHMETIC_BINOPS = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Div: operator.truediv,
+    ast.FloorDiv: operator.floordiv,
+    ast.Mod: operator.mod,
+    ast.Pow: operator.pow,
+}
+_ARITHMETIC_UNARYOPS = {ast.UAdd: operator.pos, ast.USub: operator.neg}
+# Integer operands and results are kept under this many bits (~1200 digits), so
+# nested powers like ((9^1000)^1000)^1000 are refused before any big-int work.
+MAX_ARITHMETIC_BITS = 4096
+# "2024-1-15", "15/01/2024": dates, not subtractions or divisions.
+_DATE_LIKE = re.compile(r"^\d{1,4}\s*([-/.])\s*\d{1,2}\s*\1\s*\d{1,4}$")
+# A lone (signed) number has nothing to compute.
+_LONE_NUMBER = re.compile(r"^[\s()+\-]*[\d.]+[\s()]*$")
+
+
+def extract_arithmetic_expression(text):
+    candidate = _ARITHMETIC_PREFIX.sub("", text or "", count=1).strip().rstrip("?=!").strip()
+    if not candidate or not _ARITHMETIC_BODY.match(candidate):
+        return None
+    if not re.search(r"\d", candidate) or not re.search(r"[+\-*/^%]", candidate):
+        return None
+    if _DATE_LIKE.match(candidate) or _LONE_NUMBER.match(candidate):
+        return None
+    return candidate
+
+
+def _check_magnitude(value):
+    if isinstance(value, int) and value.bit_length() > MAX_ARITHMETIC_BITS:
+        raise ValueError("Arithmetic operand too large")
+    return value
+
+
+def _bounded_binop(op, left, right):
+    # Operands are already bounded, so only a power can blow up: a^n has at least
+    # (bits(a) - 1) * n bits, which is checked before computing it.
+    if isinstance(op, ast.Pow) and isinstance(left, int) and isinstance(right, int) and right > 0:
+        if (abs(left).bit_length() - 1) * right > MAX_ARITHMETIC_BITS:
+            raise ValueError("Arithmetic result too large")
+    return _check_magnitude(_ARITHMETIC_BINOPS[type(op)](left, right))
+
+
+def _evaluate_arithmetic_node(node):
+    if isinstance(node, ast.Expression):
+        return _evaluate_arithmetic_node(node.body)
+    if isinstance(node, ast.Constant) and isinstance(node.value, (int, float)) and not isinstance(node.value, bool):
+        return _check_magnitude(node.value)
+    if isinstance(node, ast.UnaryOp) and type(node.op) in _ARITHMETIC_UNARYOPS:
+        return _ARITHMETIC_UNARYOPS[type(node.op)](_evaluate_arithmetic_node(node.operand))
+    if isinstance(node, ast.BinOp) and type(node.op) in _ARITHMETIC_BINOPS:
+        return _bounded_binop(node.op, _evaluate_arithmetic_node(node.left), _evaluate_arithmetic_node(node.right))
+    raise ValueError("Unsupported arithmetic expression")
+
+
+@functools.lru_cache(maxsize=1024)
+def evaluate_arithmetic(expression):
+    # Walks the AST instead of calling eval, so every intermediate result is
+    # size-checked; returns None for anything unsupported or too large.
+    try:
+        value = _evaluate_arithmetic_node(ast.parse(expression.replace("^", "**"), mode="eval"))
+        if isinstance(value, complex):
+            return None
+        if isinstance(value, float):
+            if not math.isfinite(value):
+                return None
+            if value.is_integer() and abs(value) < 1e15:
+                return str(int(value))
+            return f"{value:.12g}"
+        return str(value)
+    except (SyntaxError, ValueError, ArithmeticError, TypeError, RecursionError):
+        return None